@@ -1,2 +1,18 @@
 # TODO move to client config after refactor
-MAX_FILE_SIZE_MB = 10
+# files larger than syftbox.lib.chunks.CHUNKED_FILE_THRESHOLD are synced in chunks
+MAX_FILE_SIZE_MB = 100 * 1024
+
+# Max number of files per page when listing remote state
+REMOTE_STATE_PAGE_SIZE = 5000
+
+# contents of remote files up to this size are requested with listings, the server can use a lower limit
+INLINE_CONTENT_MAX_SIZE = 4096
+
+# remote creates and modifications of files up to this size, and remote deletes, are sent in batches
+BATCH_MAX_FILE_SIZE = 1024 * 1024
+# limits of a single batch request, the server accepts at most 1000 files per /sync/upload_bulk request
+BATCH_MAX_FILES = 500
+BATCH_MAX_BYTES = 16 * 1024 * 1024
+
+# with placeholders enabled, files are pinned after this many materializations, see sync.placeholders
+PIN_AFTER_MATERIALIZATIONS = 3
@@ -1,12 +1,14 @@
+import contextlib
 import zipfile
 from io import BytesIO
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, Optional
 
 import httpx
 from loguru import logger
 
 from syftbox.client.exceptions import SyftServerError
+from syftbox.client.plugins.sync.constants import BATCH_MAX_BYTES, BATCH_MAX_FILES
 from syftbox.client.plugins.sync.datasite_state import DatasiteState
 from syftbox.client.plugins.sync.exceptions import (
     FatalSyncError,
@@ -14,25 +16,57 @@ from syftbox.client.plugins.sync.exceptions import (
     SyncEnvironmentError,
     SyncValidationError,
 )
+from syftbox.client.plugins.sync.local_snapshot import LocalSnapshot
 from syftbox.client.plugins.sync.local_state import LocalState
 from syftbox.client.plugins.sync.queue import SyncQueue, SyncQueueItem
-from syftbox.client.plugins.sync.sync_action import SyncAction, determine_sync_action
+from syftbox.client.plugins.sync.sync_action import (
+    BatchableSyncAction,
+    SyncAction,
+    determine_sync_action,
+    write_local_file,
+)
 from syftbox.client.plugins.sync.sync_client import SyncClient
-from syftbox.client.plugins.sync.types import SyncActionType
-from syftbox.lib.hash import hash_file
+from syftbox.client.plugins.sync.types import SyncActionType, SyncStatus
+from syftbox.lib.chunks import is_chunked
 from syftbox.lib.ignore import filter_ignored_paths
 from syftbox.server.models.sync_models import FileMetadata
 
 
-def create_local_batch(sync_client: SyncClient, paths_to_download: list[Path]) -> list[str]:
+def create_local_batch(
+    sync_client: SyncClient,
+    paths_to_download: list[Path],
+    remote_metadata: Optional[dict[Path, FileMetadata]] = None,
+) -> list[str]:
+    """
+    Download files in a single request and write them to the local datasites dir.
+
+    Args:
+        sync_client (SyncClient): Client to download the files with.
+        paths_to_download (list[Path]): Paths of the files to download.
+        remote_metadata (Optional[dict[Path, FileMetadata]], optional): Remote metadata of the downloaded files,
+            used to add the files to the hash cache without hashing them. Defaults to None.
+
+    Returns:
+        list[str]: Paths of the files that were written.
+    """
+    if not paths_to_download:
+        return []
+    remote_metadata = remote_metadata or {}
     try:
         content_bytes = sync_client.download_bulk(paths_to_download)
     except SyftServerError as e:
         logger.error(e)
         return []
     zip_file = zipfile.ZipFile(BytesIO(content_bytes))
-    zip_file.extractall(sync_client.workspace.datasites)
-    return zip_file.namelist()
+    written = []
+    for name in zip_file.namelist():
+        path = Path(name)
+        if name.endswith("/") or path.is_absolute() or ".." in path.parts:
+            logger.warning(f"Skipping invalid path in downloaded zip: {name}")
+            continue
+        write_local_file(sync_client, path, zip_file.read(name), remote_metadata.get(path))
+        written.append(name)
+    return written
 
 
 class SyncConsumer:
@@ -40,6 +74,8 @@ class SyncConsumer:
         self.client = client
         self.queue = queue
         self.local_state = local_state
+        # local snapshots of the current sync cycle, by datasite
+        self.snapshots: dict[str, LocalSnapshot] = {}
 
     def validate_sync_environment(self):
         if not Path(self.client.workspace.datasites).is_dir():
@@ -48,29 +84,70 @@ class SyncConsumer:
             raise SyncEnvironmentError("Your previous sync state has been deleted by a different process.")
 
     def consume_all(self):
+        # actions that can be batched are collected per action type, and sent in batches
+        batches: dict[SyncActionType, list[BatchableSyncAction]] = {}
+        batch_sizes: dict[SyncActionType, int] = {}
         while not self.queue.empty():
             self.validate_sync_environment()
             item = self.queue.get(timeout=0.1)
             try:
-                self.process_filechange(item)
+                action = self.determine_action(item)
+                if not (isinstance(action, BatchableSyncAction) and action.can_batch()):
+                    self.complete_action(action)
+                    continue
+                batch = batches.setdefault(action.action_type, [])
+                batch.append(action)
+                batch_size = batch_sizes.get(action.action_type, 0)
+                batch_size += action.local_metadata.file_size if action.local_metadata else 0
+                batch_sizes[action.action_type] = batch_size
+                if len(batch) >= BATCH_MAX_FILES or batch_size >= BATCH_MAX_BYTES:
+                    del batches[action.action_type], batch_sizes[action.action_type]
+                    self.process_batch(batch)
             except FatalSyncError as e:
                 # Fatal error, syncing should be interrupted
                 raise e
             except Exception as e:
                 logger.error(f"Failed to sync file {item.data.path}, it will be retried in the next sync. Reason: {e}")
 
+        for batch in batches.values():
+            try:
+                self.process_batch(batch)
+            except FatalSyncError as e:
+                raise e
+            except Exception as e:
+                logger.error(f"Failed to sync {len(batch)} files, they will be retried in the next sync. Reason: {e}")
+
     def download_all_missing(self, datasite_states: list[DatasiteState]):
         try:
-            missing_files: list[Path] = []
+            placeholders = self.client.placeholders
+            missing_files: dict[Path, FileMetadata] = {}
             for datasite_state in datasite_states:
                 for file in datasite_state.remote_state:
                     path = file.path
+                    if placeholders is not None and placeholders.defers(path):
+                        # not downloaded until it is materialized, the producer adds a placeholder
+                        continue
                     if not self.local_state.states.get(path):
-                        missing_files.append(path)
-            missing_files = filter_ignored_paths(self.client.workspace.datasites, missing_files)
+                        missing_files[path] = file
+            # large files are downloaded in chunks by the consumer
+            paths_to_download = filter_ignored_paths(
+                self.client.workspace.datasites,
+                [path for path, file in missing_files.items() if not is_chunked(file)],
+            )
+
+            # small files are inlined in the listing, only the other files are downloaded
+            received_files = []
+            to_download = []
+            for path in paths_to_download:
+                inline_content = self.client.get_inline_content(missing_files[path])
+                if inline_content is None:
+                    to_download.append(path)
+                    continue
+                write_local_file(self.client, path, inline_content, missing_files[path])
+                received_files.append(path.as_posix())
 
-            logger.info(f"Downloading {len(missing_files)} files in batch")
-            received_files = create_local_batch(self.client, missing_files)
+            logger.info(f"Downloading {len(to_download)} files in batch")
+            received_files += create_local_batch(self.client, to_download, missing_files)
             for path in received_files:
                 path = Path(path)
                 state = self.get_current_local_metadata(path)
@@ -98,9 +175,10 @@ class SyncConsumer:
             current_remote_metadata=current_remote_metadata,
         )
 
-    def process_action(self, action: SyncAction) -> SyncAction:
+    @contextlib.contextmanager
+    def handle_action_errors(self, action: SyncAction) -> Iterator[None]:
         """
-        Execute an action and handle any exceptions that may occur. Actions are either:
+        Handle the exceptions of executing an action. Actions are either:
         - Executed successfully (status = SYNCED)
         - Rejected by the server (status = REJECTED). Rejection behaviour is defined by the action.
             For example, a rejected local deletion will be reverted by creating the file again.
@@ -108,9 +186,7 @@ class SyncConsumer:
             Errors could be either validation errors (file is too large, etc.) or server errors (connection issues, etc.)
         """
         try:
-            logger.info(action.info_message)
-            action.validate(self.client)
-            action.execute(self.client)
+            yield
         except SyftPermissionError as e:
             action.process_rejection(self.client, reason=str(e))
         except SyncValidationError as e:
@@ -121,10 +197,52 @@ class SyncConsumer:
             action.error(e)
             logger.error(f"Failed to sync file {action.path}, it will be retried in the next sync. Reason: {e}")
 
+    def process_action(self, action: SyncAction) -> SyncAction:
+        """Execute an action and handle any exceptions that may occur, see `handle_action_errors`."""
+        with self.handle_action_errors(action):
+            logger.info(action.info_message)
+            action.validate(self.client)
+            action.execute(self.client)
         return action
 
+    def process_batch(self, actions: list[BatchableSyncAction]) -> None:
+        """
+        Execute multiple actions of the same type with a single request, like `process_action` for every action.
+        Every action succeeds or fails on its own, and every action is added to the local state.
+        """
+        action_cls = type(actions[0])
+        to_execute = []
+        for action in actions:
+            with self.handle_action_errors(action):
+                logger.info(action.info_message)
+                action.validate(self.client)
+                to_execute.append(action)
+
+        if to_execute:
+            logger.info(f"Syncing {len(to_execute)} files with action {action_cls.action_type.name} in batch")
+            try:
+                results = action_cls.execute_batch(self.client, to_execute)
+            except (SyftServerError, httpx.RequestError) as e:
+                logger.error(
+                    f"Failed to sync {len(to_execute)} files, they will be retried in the next sync. Reason: {e}"
+                )
+                for action in to_execute:
+                    action.error(e)
+            else:
+                for action in to_execute:
+                    # actions that failed before the request are already marked with their error
+                    if action.status == SyncStatus.PROCESSING:
+                        with self.handle_action_errors(action):
+                            action.complete_batch(self.client, results.get(action.path))
+
+        for action in actions:
+            self.local_state.insert_completed_action(action)
+
     def process_filechange(self, item: SyncQueueItem) -> None:
-        action = self.determine_action(item)
+        self.complete_action(self.determine_action(item))
+
+    def complete_action(self, action: SyncAction) -> None:
+        """Process an action and add the result to the local state."""
         if action.is_noop():
             return
 
@@ -132,15 +250,22 @@ class SyncConsumer:
         self.local_state.insert_completed_action(action)
 
     def get_current_local_metadata(self, path: Path) -> Optional[FileMetadata]:
+        snapshot = self.snapshots.get(path.parts[0])
+        if snapshot is not None:
+            return snapshot.get_metadata(path)
+
         abs_path = self.client.workspace.datasites / path
         if not abs_path.is_file():
             return None
-        return hash_file(abs_path, root_dir=self.client.workspace.datasites)
+        return self.client.hash_cache.hash_file(abs_path, root_dir=self.client.workspace.datasites)
 
     def get_previous_local_metadata(self, path: Path) -> Optional[FileMetadata]:
         return self.local_state.states.get(path, None)
 
     def get_current_remote_metadata(self, path: Path) -> Optional[FileMetadata]:
+        if path in self.client.inline_contents:
+            # inlined files are listed in this sync cycle, their content matches the listed metadata
+            return self.client.inline_contents[path][0]
         try:
             return self.client.get_metadata(path)
         except SyftServerError:
@@ -1,13 +1,14 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import List, Optional
 
 from loguru import logger
 
+from syftbox.client.plugins.sync.local_snapshot import LocalSnapshot
 from syftbox.client.plugins.sync.sync_client import SyncClient
 from syftbox.client.plugins.sync.types import FileChangeInfo, SyncSide
-from syftbox.lib.hash import collect_files, hash_dir
-from syftbox.lib.ignore import filter_ignored_paths, get_syftignore_matches
+from syftbox.lib.ignore import filter_ignored_paths
+from syftbox.lib.merkle import MerkleTree
 from syftbox.lib.permissions import SyftPermission
 from syftbox.server.models.sync_models import FileMetadata
 
@@ -39,10 +40,18 @@ def format_paths(path_list: list[Path]) -> str:
 class DatasiteChanges:
     permissions: list[FileChangeInfo]
     files: list[FileChangeInfo]
+    # remote metadata of deferred files, None to remove a placeholder, see sync.placeholders
+    placeholders: dict[Path, Optional[FileMetadata]] = field(default_factory=dict)
 
 
 class DatasiteState:
-    def __init__(self, client: SyncClient, email: str, remote_state: Optional[list[FileMetadata]] = None) -> None:
+    def __init__(
+        self,
+        client: SyncClient,
+        email: str,
+        remote_state: Optional[list[FileMetadata]] = None,
+        remote_tree_hash: Optional[str] = None,
+    ) -> None:
         """A class to represent the state of a datasite
 
         Args:
@@ -50,10 +59,15 @@ class DatasiteState:
             email (str): Email of the datasite
             remote_state (Optional[list[FileMetadata]], optional): Remote state of the datasite.
                 If not provided, it will be fetched from the server. Defaults to None.
+            remote_tree_hash (Optional[str], optional): Merkle root hash of the remote datasite. If provided
+                without remote_state, only the directories that differ are fetched from the server. Defaults to None.
         """
         self.client = client
         self.email: str = email
         self.remote_state: Optional[list[FileMetadata]] = remote_state
+        self.remote_tree_hash: Optional[str] = remote_tree_hash
+        # local files, from the last scan of the datasite dir
+        self.snapshot: Optional[LocalSnapshot] = None
 
     def __repr__(self) -> str:
         return f"DatasiteState<{self.email}>"
@@ -71,32 +85,93 @@ class DatasiteState:
         p = self.client.workspace.datasites / self.email
         return p.expanduser().resolve()
 
+    def scan(self) -> LocalSnapshot:
+        """Walk the local datasite dir, the snapshot is kept until the next scan."""
+        self.snapshot = LocalSnapshot(
+            self.client.workspace.datasites,
+            self.path,
+            self.client.hash_cache,
+            hash_pool=self.client.hash_pool,
+        )
+        return self.snapshot
+
     def get_current_local_state(self) -> list[FileMetadata]:
-        return hash_dir(self.path, root_dir=self.client.workspace.datasites)
+        """Local files of the datasite, only the subscribed files if the user has subscriptions."""
+        local_state = self.scan().local_state
+        if self.client.subscriptions is None:
+            return local_state
+        return list(self.client.subscriptions.filter(local_state))
+
+    def get_placeholders(self) -> dict[Path, FileMetadata]:
+        """Subscribed placeholders of the datasite, see `sync.placeholders`."""
+        if self.client.placeholders is None:
+            return {}
+        placeholders = self.client.placeholders.files_in(self.email).values()
+        if self.client.subscriptions is not None:
+            placeholders = self.client.subscriptions.filter(placeholders)
+        return {file.path: file for file in placeholders}
 
     def get_remote_state(self) -> list[FileMetadata]:
         if self.remote_state is None:
-            self.remote_state = self.client.get_remote_state(Path(self.email))
+            self.remote_state = list(self.client.get_remote_state(Path(self.email)))
         return self.remote_state
 
+    def get_changed_subtrees(self, local_state: list[FileMetadata]) -> tuple[list[FileMetadata], list[FileMetadata]]:
+        """
+        Compare the local and remote Merkle trees of the datasite, starting from the root, and return
+        the (local files, remote files) in all subtrees that differ.
+
+        Only directories with different hashes are requested from the server, a single changed file
+        costs one request per directory level.
+        """
+        root = Path(self.email)
+        local_tree = MerkleTree(root, local_state)
+        if local_tree.root_hash == self.remote_tree_hash:
+            return [], []
+
+        local_files: list[FileMetadata] = []
+        remote_files: list[FileMetadata] = []
+        dirs_to_compare = [root]
+        while dirs_to_compare:
+            directory = dirs_to_compare.pop()
+            local_children = {entry.name: entry for entry in local_tree.children(directory)}
+            remote_children = {entry.name: entry for entry in self.client.get_tree_node(directory).children}
+
+            for name in local_children.keys() | remote_children.keys():
+                path = directory / name
+                local_entry = local_children.get(name)
+                remote_entry = remote_children.get(name)
+                if local_entry is not None and remote_entry is not None:
+                    if local_entry.is_dir == remote_entry.is_dir and local_entry.hash == remote_entry.hash:
+                        continue
+                    if local_entry.is_dir and remote_entry.is_dir:
+                        dirs_to_compare.append(path)
+                        continue
+
+                if local_entry is not None:
+                    local_files.extend(local_tree.iter_files(path) if local_entry.is_dir else [local_entry.metadata])
+                if remote_entry is not None and remote_entry.is_dir:
+                    # dir_state matches on path prefix, skip siblings that share the prefix
+                    remote_files.extend(f for f in self.client.get_remote_state(path) if path in f.path.parents)
+                elif remote_entry is not None:
+                    remote_files.append(remote_entry.metadata)
+
+        return local_files, remote_files
+
     def is_in_sync(self) -> bool:
         changes = self.get_datasite_changes()
         return len(changes.files) == 0 and len(changes.permissions) == 0
 
     def get_syftignore_matches(self) -> List[Path]:
         """
-        Return the paths that are ignored by the syftignore file
+        Return the paths that are ignored by the syftignore file, from the last scan of the datasite.
+        Directories that match the ignore rules are returned as a single path.
 
         NOTE: symlinks and hidden files are ignored by default, and not added here.
         This is to avoid spamming the logs with .venv and .git folders.
         """
-        all_paths = collect_files(self.path)
-        relative_paths = [file.relative_to(self.client.workspace.datasites) for file in all_paths]
-        return get_syftignore_matches(
-            datasites_dir=self.client.workspace.datasites,
-            relative_paths=relative_paths,
-            include_symlinks=False,
-        )
+        snapshot = self.snapshot or self.scan()
+        return snapshot.ignored
 
     def get_datasite_changes(
         self,
@@ -114,15 +189,31 @@ class DatasiteState:
             logger.error(f"Failed to get local state for {self.email}: {e}")
             return DatasiteChanges(permissions=[], files=[])
 
+        # placeholders are part of the local tree, so unchanged placeholders do not make the trees differ
+        local_paths = {file.path for file in local_state}
+        placeholders = self.get_placeholders()
+        # files that exist locally were materialized, their placeholders are removed
+        deferred: dict[Path, Optional[FileMetadata]] = {path: None for path in placeholders if path in local_paths}
+        # pinned placeholders are left out of the local tree, so they are downloaded
+        placeholders = {
+            path: file
+            for path, file in placeholders.items()
+            if path not in local_paths and self.client.placeholders.defers(path)
+        }
         try:
-            remote_state = self.get_remote_state()
+            if self.remote_state is None and self.remote_tree_hash is not None:
+                local_state, remote_state = self.get_changed_subtrees(local_state + list(placeholders.values()))
+                placeholders = {file.path: file for file in local_state if file.path in placeholders}
+                local_state = [file for file in local_state if file.path in local_paths]
+            else:
+                remote_state = self.get_remote_state()
         except Exception as e:
             logger.error(f"Failed to get remote state for {self.email}: {e}")
             return DatasiteChanges(permissions=[], files=[])
 
         local_state_dict = {file.path: file for file in local_state}
         remote_state_dict = {file.path: file for file in remote_state}
-        all_files = set(local_state_dict.keys()) | set(remote_state_dict.keys())
+        all_files = set(local_state_dict.keys()) | set(remote_state_dict.keys()) | set(placeholders.keys())
         all_files_filtered = filter_ignored_paths(
             datasites_dir=self.client.workspace.datasites,
             relative_paths=list(all_files),
@@ -134,6 +225,10 @@ class DatasiteState:
         for afile in all_files_filtered:
             local_info = local_state_dict.get(afile)
             remote_info = remote_state_dict.get(afile)
+            if local_info is None and self.client.placeholders is not None and self.client.placeholders.defers(afile):
+                if remote_info != placeholders.get(afile):
+                    deferred[afile] = remote_info
+                continue
 
             try:
                 change_info = compare_fileinfo(self.client.workspace.datasites, afile, local_info, remote_info)
@@ -150,6 +245,7 @@ class DatasiteState:
         return DatasiteChanges(
             permissions=permission_changes,
             files=file_changes,
+            placeholders=deferred,
         )
 
 
@@ -0,0 +1,122 @@
+import os
+import stat as stat_module
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+
+from loguru import logger
+
+from syftbox.lib.hash import HashCache, HashPool, hash_file, is_unchanged, walk_files
+from syftbox.lib.ignore import get_ignore_matcher
+from syftbox.server.models.sync_models import FileMetadata, datetime_to_ns
+
+
+class LocalSnapshot:
+    """
+    Local files of a datasite, from a single walk of the datasite dir.
+
+    One snapshot is taken per datasite per sync cycle, and serves the local state, the ignored paths and the
+    consumer's lookups of current local metadata. Unchanged files are served from the hash cache.
+    """
+
+    def __init__(
+        self,
+        datasites_dir: Path,
+        datasite_dir: Path,
+        hash_cache: HashCache,
+        hash_pool: Optional[HashPool] = None,
+    ) -> None:
+        """
+        Args:
+            datasites_dir (Path): Directory containing all datasites, paths are relative to this directory.
+            datasite_dir (Path): Directory of the datasite to scan.
+            hash_cache (HashCache): Cache of local file metadata.
+            hash_pool (Optional[HashPool], optional): Workers for hashing changed files. If None, files are hashed
+                on the calling thread. Defaults to None.
+        """
+        self.datasites_dir = datasites_dir
+        self.datasite_dir = datasite_dir
+        self.hash_cache = hash_cache
+        self.hash_pool = hash_pool
+        # files that are synced, by relative path
+        self.files: dict[Path, FileMetadata] = {}
+        # paths that match the ignore rules or are rejected, excluding hidden files and symlinks
+        self.ignored: list[Path] = []
+        self.scan()
+
+    def scan(self) -> None:
+        start = time.perf_counter()
+        matcher = get_ignore_matcher(self.datasites_dir)
+        pruned_dirs: list[Path] = []
+        entries = {
+            Path(entry.path).relative_to(self.datasites_dir): entry
+            for entry in walk_files(
+                self.datasite_dir,
+                ignore_rules=matcher.rules,
+                root_dir=self.datasites_dir,
+                pruned_dirs=pruned_dirs,
+            )
+        }
+        classification = matcher.classify(list(entries))
+        walk_done = time.perf_counter()
+
+        self.files = {}
+        to_hash: list[tuple[Path, os.stat_result]] = []
+        for path in classification.included:
+            abs_path = self.datasites_dir / path
+            try:
+                stat = entries[path].stat()
+            except OSError:
+                continue
+            metadata = self.hash_cache.get(abs_path, stat)
+            if metadata is None:
+                to_hash.append((abs_path, stat))
+            else:
+                self.files[path] = metadata
+
+        for metadata in self._hash_files(to_hash):
+            self.files[metadata.path] = metadata
+        num_hashed = len(to_hash)
+        # files deleted since the last scan, the cache would otherwise keep their metadata and signatures forever
+        self.hash_cache.prune(self.datasite_dir.name, {self.datasites_dir / path for path in entries})
+        self.ignored = classification.ignored + classification.rejected + pruned_dirs
+
+        end = time.perf_counter()
+        logger.debug(
+            f"Scanned {self.datasite_dir.name}: {len(self.files)} files ({num_hashed} hashed), "
+            f"{len(self.ignored)} ignored in {end - start:.3f}s "
+            f"(walk {walk_done - start:.3f}s, hash {end - walk_done:.3f}s)"
+        )
+
+    def _hash_files(self, files: list[tuple[Path, os.stat_result]]) -> Iterator[FileMetadata]:
+        if self.hash_pool is None:
+            results = ((abs_path, hash_file(abs_path, self.datasites_dir)) for abs_path, _ in files)
+        else:
+            results = self.hash_pool.hash_files(files, self.datasites_dir)
+        for abs_path, metadata in results:
+            if metadata is not None:
+                self.hash_cache.put(abs_path, metadata)
+                yield metadata
+
+    @property
+    def local_state(self) -> list[FileMetadata]:
+        return list(self.files.values())
+
+    def get_metadata(self, path: Path) -> Optional[FileMetadata]:
+        """
+        Current metadata of a local file, None if it does not exist.
+
+        The file is stat'ed again so changes since the scan are never missed, but it is only hashed if it changed.
+        """
+        abs_path = self.datasites_dir / path
+        try:
+            stat = abs_path.stat()
+        except OSError:
+            return None
+        if not stat_module.S_ISREG(stat.st_mode):
+            return None
+
+        metadata = self.files.get(path)
+        if metadata is not None and is_unchanged(stat, metadata.file_size, datetime_to_ns(metadata.last_modified)):
+            return metadata
+        return self.hash_cache.hash_file(abs_path, self.datasites_dir, stat=stat)
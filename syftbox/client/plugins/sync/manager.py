@@ -1,5 +1,7 @@
 import time
-from threading import Thread
+from datetime import datetime, timezone
+from pathlib import Path
+from threading import Lock, Thread
 from typing import Optional
 
 from loguru import logger
@@ -9,16 +11,22 @@ from syftbox.client.exceptions import SyftAuthenticationError
 from syftbox.client.plugins.sync.consumer import SyncConsumer
 from syftbox.client.plugins.sync.exceptions import FatalSyncError, SyncEnvironmentError
 from syftbox.client.plugins.sync.local_state import LocalState
+from syftbox.client.plugins.sync.placeholders import Placeholders
 from syftbox.client.plugins.sync.producer import SyncProducer
 from syftbox.client.plugins.sync.queue import SyncQueue, SyncQueueItem
 from syftbox.client.plugins.sync.sync_client import SyncClient
-from syftbox.client.plugins.sync.types import FileChangeInfo
+from syftbox.client.plugins.sync.types import FileChangeInfo, SyncSide
+from syftbox.lib.hash import HashPool
 
 
 class SyncManager:
     def __init__(self, client: SyftClientInterface, health_check_interval: int = 300):
-        self.sync_client = SyncClient(client)
+        # hashing workers are kept alive between sync cycles
+        self.hash_pool = HashPool()
+        self.sync_client = SyncClient(client, hash_pool=self.hash_pool)
         self.local_state = LocalState.for_client(client)
+        self.placeholders = Placeholders.for_client(client)
+        self.sync_client.placeholders = self.placeholders
         self.queue = SyncQueue()
         self.producer = SyncProducer(client=self.sync_client, queue=self.queue, local_state=self.local_state)
         self.consumer = SyncConsumer(client=self.sync_client, queue=self.queue, local_state=self.local_state)
@@ -29,12 +37,15 @@ class SyncManager:
         self.sync_run_once = False
         self.last_health_check = 0
         self.health_check_interval = health_check_interval
+        # held during a sync cycle, and while apps materialize or evict files
+        self.lock = Lock()
 
         self.setup()
 
     def setup(self):
         try:
             self.local_state.load()
+            self.placeholders.load()
         except Exception as e:
             raise SyncEnvironmentError(f"Failed to load previous sync state: {e}") from e
 
@@ -59,6 +70,7 @@ class SyncManager:
                     break
                 except Exception as e:
                     logger.error(f"Syncing encountered an error: {e}. Retrying in {manager.sync_interval} seconds.")
+            manager.hash_pool.shutdown()
 
         self.is_stop_requested = False
         t = Thread(target=_start, args=(self,), daemon=True)
@@ -84,24 +96,135 @@ class SyncManager:
             _ = self.sync_client.whoami()
             logger.debug("Health check succeeded, server is available.")
             self.last_health_check = time.time()
+            self.refresh_subscriptions()
         except SyftAuthenticationError as e:
             # Auth errors will never recover, sync should be stopped
             raise FatalSyncError(f"Health check failed, {e}") from e
         except Exception as e:
             logger.error(f"Health check failed: {e}. Retrying in {self.health_check_interval} seconds.")
 
-    def run_single_thread(self):
-        datasite_states = self.producer.get_datasite_states()
-        logger.debug(f"Syncing {len(datasite_states)} datasites")
+    def refresh_subscriptions(self) -> None:
+        """Other clients of the same user can change the subscriptions, they are refreshed with every health check."""
+        try:
+            self.sync_client.get_subscriptions()
+        except Exception as e:
+            logger.error(f"Failed to get subscriptions, using the previous subscriptions. Reason: {e}")
+
+    def set_placeholders_enabled(self, enabled: bool) -> None:
+        """Enable or disable metadata-only sync of other datasites, see `sync.placeholders`."""
+        with self.lock:
+            self.placeholders.enabled = enabled
+            if not enabled:
+                # the next cycle downloads all placeholders
+                self.placeholders.files = {}
+            self.placeholders.save()
+
+    def materialize(self, path: Path, pin: bool = False) -> list[Path]:
+        """
+        Download the placeholders under `path` now, they are kept in sync like any other local file afterwards.
+
+        Args:
+            path (Path): File or directory to download, relative to the datasites dir.
+            pin (bool, optional): Also download files that are created under `path` later. Defaults to False.
+
+        Returns:
+            list[Path]: Files under `path` that exist locally.
+        """
+        with self.lock:
+            paths = self.placeholders.files_under(path)
+            if not paths and not (self.sync_client.workspace.datasites / path).exists():
+                # not listed yet, or not deferred
+                paths = [path]
+            for file_path in paths:
+                abs_path = self.sync_client.workspace.datasites / file_path
+                if not abs_path.exists():
+                    # a previous local copy was evicted, it should be downloaded instead of deleted remotely
+                    self.local_state.states.pop(file_path, None)
+                    change = FileChangeInfo(
+                        local_sync_folder=self.sync_client.workspace.datasites,
+                        path=file_path,
+                        side_last_modified=SyncSide.REMOTE,
+                        date_last_modified=datetime.now(tz=timezone.utc),
+                    )
+                    self.consumer.process_filechange(SyncQueueItem(priority=change.get_priority(), data=change))
+                if abs_path.is_file():
+                    self.placeholders.files.pop(file_path, None)
+
+            abs_path = self.sync_client.workspace.datasites / path
+            if pin:
+                self.placeholders.pin(path)
+            elif abs_path.is_file():
+                self.placeholders.add_materialization(path)
+            self.placeholders.save()
+
+            if abs_path.is_dir():
+                files = abs_path.rglob("*")
+            else:
+                files = [abs_path] if abs_path.is_file() else []
+            return [file.relative_to(self.sync_client.workspace.datasites) for file in files if file.is_file()]
+
+    def evict(self, path: Path) -> list[Path]:
+        """
+        Delete the local copies of unpinned files under `path` in other datasites, and turn them back into placeholders.
+        Files with local changes that are not synced yet are kept.
+
+        Returns:
+            list[Path]: Evicted files.
+        """
+        evicted = []
+        with self.lock:
+            synced_files = [file for file in self.local_state.states if file == path or path in file.parents]
+            for file_path in synced_files:
+                if not self.placeholders.defers(file_path):
+                    continue
+                abs_path = self.sync_client.workspace.datasites / file_path
+                synced_metadata = self.local_state.states[file_path]
+                if abs_path.is_file():
+                    local_metadata = self.sync_client.hash_cache.hash_file(
+                        abs_path, root_dir=self.sync_client.workspace.datasites
+                    )
+                    if local_metadata != synced_metadata:
+                        continue
+                    abs_path.unlink()
+                    self.sync_client.hash_cache.pop(abs_path)
+                self.local_state.states.pop(file_path)
+                self.placeholders.files[file_path] = synced_metadata
+                evicted.append(file_path)
+            self.local_state.save()
+            self.placeholders.save()
+        return evicted
 
+    def run_single_thread(self):
+        with self.lock:
+            self._run_single_thread()
+
+    def _run_single_thread(self):
+        # contents inlined in the listings of the previous cycle can be outdated
+        self.sync_client.inline_contents.clear()
+        if self.sync_client.subscriptions is None:
+            self.refresh_subscriptions()
         if not self.sync_run_once:
+            datasite_states = self.producer.get_datasite_states()
             # Download all missing files at the start
             self.consumer.download_all_missing(datasite_states=datasite_states)
+        else:
+            # Afterwards, only compare the directories that changed
+            datasite_states = self.producer.get_datasite_trees()
+        logger.debug(f"Syncing {len(datasite_states)} datasites")
 
         for datasite_state in datasite_states:
             self.producer.enqueue_datasite_changes(datasite_state)
 
-        # TODO stop consumer if self.is_stop_requested
-        self.consumer.consume_all()
+        # the consumer looks up local files in the snapshots taken by the producer
+        self.consumer.snapshots = {
+            datasite_state.email: datasite_state.snapshot
+            for datasite_state in datasite_states
+            if datasite_state.snapshot is not None
+        }
+        try:
+            # TODO stop consumer if self.is_stop_requested
+            self.consumer.consume_all()
+        finally:
+            self.consumer.snapshots = {}
 
         self.sync_run_once = True
@@ -0,0 +1,90 @@
+"""
+Metadata-only sync of other datasites.
+
+With placeholders enabled, new remote files in other datasites are not downloaded. Their metadata is kept in a local
+manifest instead, and apps download them on demand with `SyncManager.materialize`. Files that exist locally, files
+under pinned paths, permission files and the own datasite are synced as usual.
+
+Files that are materialized often are pinned. Unpinned files can be evicted, which deletes the local copy and turns
+the file back into a placeholder. Deleting the local copy of a file in another datasite also evicts it, the remote
+file is not deleted.
+
+Placeholders are not thread-safe, the sync thread and apps only use them while holding `SyncManager.lock`.
+"""
+
+from pathlib import Path
+from typing import Optional
+
+from loguru import logger
+from pydantic import BaseModel, Field, PrivateAttr
+from typing_extensions import Self, Type
+
+from syftbox.client.base import SyftClientInterface
+from syftbox.client.plugins.sync.constants import PIN_AFTER_MATERIALIZATIONS
+from syftbox.lib.permissions import SyftPermission
+from syftbox.server.models.sync_models import FileMetadata
+
+PLACEHOLDERS_FILENAME = "placeholders.json"
+
+
+class Placeholders(BaseModel):
+    path: Path = Field(description="Path to the Placeholders file")
+    enabled: bool = False
+    # remote files that are not downloaded, by path
+    files: dict[Path, FileMetadata] = {}
+    # files and directories that are always downloaded
+    pinned: list[Path] = []
+    # number of times each file was materialized
+    materializations: dict[Path, int] = {}
+
+    _email: Optional[str] = PrivateAttr(default=None)
+
+    @classmethod
+    def for_client(cls: Type[Self], client: SyftClientInterface) -> Self:
+        placeholders = cls(path=client.workspace.plugins / PLACEHOLDERS_FILENAME)
+        placeholders._email = client.email
+        return placeholders
+
+    def is_pinned(self, path: Path) -> bool:
+        pinned = set(self.pinned)
+        return path in pinned or any(parent in pinned for parent in path.parents)
+
+    def defers(self, path: Path) -> bool:
+        """True if the remote file at `path` should not be downloaded until it is materialized."""
+        return (
+            self.enabled
+            and path.parts[0] != self._email
+            and not SyftPermission.is_permission_file(path)
+            and not self.is_pinned(path)
+        )
+
+    def files_in(self, datasite: str) -> dict[Path, FileMetadata]:
+        return {path: metadata for path, metadata in self.files.items() if path.parts[0] == datasite}
+
+    def files_under(self, path: Path) -> list[Path]:
+        return [file for file in self.files if file == path or path in file.parents]
+
+    def pin(self, path: Path) -> None:
+        if not self.is_pinned(path):
+            # pinning a directory also pins everything in it
+            self.pinned = [pinned for pinned in self.pinned if path not in pinned.parents] + [path]
+
+    def add_materialization(self, path: Path) -> None:
+        """Count a materialization of a file, frequently used files are pinned."""
+        self.materializations[path] = self.materializations.get(path, 0) + 1
+        if self.materializations[path] >= PIN_AFTER_MATERIALIZATIONS:
+            self.pin(path)
+
+    def save(self):
+        try:
+            self.path.write_text(self.model_dump_json())
+        except Exception as e:
+            logger.exception(f"Failed to save {self.path}: {e}")
+
+    def load(self):
+        if self.path.exists():
+            loaded = self.model_validate_json(self.path.read_text())
+            self.enabled = loaded.enabled
+            self.files = loaded.files
+            self.pinned = loaded.pinned
+            self.materializations = loaded.materializations
@@ -1,3 +1,6 @@
+from pathlib import Path
+from typing import Optional
+
 from loguru import logger
 
 from syftbox.client.plugins.sync.datasite_state import DatasiteState
@@ -5,6 +8,8 @@ from syftbox.client.plugins.sync.local_state import LocalState
 from syftbox.client.plugins.sync.queue import SyncQueue, SyncQueueItem
 from syftbox.client.plugins.sync.sync_client import SyncClient
 from syftbox.client.plugins.sync.types import FileChangeInfo, SyncStatus
+from syftbox.lib.merkle import EMPTY_TREE_HASH
+from syftbox.server.models.sync_models import FileMetadata
 
 
 class SyncProducer:
@@ -14,20 +19,40 @@ class SyncProducer:
         self.local_state = local_state
 
     def get_datasite_states(self) -> list[DatasiteState]:
+        datasite_states = []
         try:
-            remote_datasite_states = self.client.get_datasite_states()
+            for email, remote_state in self.client.get_datasite_states():
+                datasite_states.append(DatasiteState(self.client, email, remote_state=remote_state))
         except Exception as e:
             logger.error(f"Failed to retrieve datasites from server, only syncing own datasite. Reason: {e}")
-            remote_datasite_states = {}
+            datasite_states = []
 
         # Ensure we are always syncing own datasite
-        if self.client.email not in remote_datasite_states:
-            remote_datasite_states[self.client.email] = []
+        if self.client.email not in {datasite_state.email for datasite_state in datasite_states}:
+            datasite_states.append(DatasiteState(self.client, self.client.email, remote_state=[]))
+
+        return datasite_states
+
+    def get_datasite_trees(self) -> list[DatasiteState]:
+        """
+        Get the Merkle root hash of every datasite, without listing any files.
+        Remote files are only requested for datasites and directories that differ from the local state.
+
+        Falls back to `get_datasite_states` if the server does not support Merkle trees.
+        """
+        try:
+            root = self.client.get_tree_node(Path("."))
+        except Exception as e:
+            logger.debug(f"Failed to retrieve datasite trees, listing all remote files instead. Reason: {e}")
+            return self.get_datasite_states()
 
         datasite_states = [
-            DatasiteState(self.client, email, remote_state=remote_state)
-            for email, remote_state in remote_datasite_states.items()
+            DatasiteState(self.client, entry.name, remote_tree_hash=entry.hash) for entry in root.children
         ]
+        # Ensure we are always syncing own datasite
+        if self.client.email not in {datasite_state.email for datasite_state in datasite_states}:
+            datasite_states.append(DatasiteState(self.client, self.client.email, remote_tree_hash=EMPTY_TREE_HASH))
+
         return datasite_states
 
     def add_ignored_to_local_state(self, datasite: DatasiteState) -> None:
@@ -63,7 +88,22 @@ class SyncProducer:
         for change in datasite_changes.permissions + datasite_changes.files:
             self.enqueue(change)
 
+        if datasite_changes.placeholders:
+            self.update_placeholders(datasite_changes.placeholders)
         self.add_ignored_to_local_state(datasite)
 
+    def update_placeholders(self, changes: dict[Path, Optional[FileMetadata]]) -> None:
+        """Add, update or remove (if None) placeholders of files that are not downloaded, see `sync.placeholders`."""
+        placeholders = self.client.placeholders
+        for path, remote_metadata in changes.items():
+            if remote_metadata is None:
+                placeholders.files.pop(path, None)
+                continue
+            placeholders.files[path] = remote_metadata
+            # a deleted local copy is evicted, it should not delete the remote file if placeholders are disabled
+            self.local_state.states.pop(path, None)
+        placeholders.save()
+        self.local_state.save()
+
     def enqueue(self, change: FileChangeInfo) -> None:
         self.queue.put(SyncQueueItem(priority=change.get_priority(), data=change))
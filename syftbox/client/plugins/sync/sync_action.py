@@ -1,19 +1,25 @@
+import base64
 import hashlib
+import os
 import shutil
+import uuid
 from abc import ABC, abstractmethod
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import ClassVar, Optional
+from typing import BinaryIO, Callable, ClassVar, Optional
 
-import py_fast_rsync
 from loguru import logger
 
-from syftbox.client.plugins.sync.constants import MAX_FILE_SIZE_MB
+from syftbox.client.plugins.sync.constants import BATCH_MAX_FILE_SIZE, MAX_FILE_SIZE_MB
 from syftbox.client.plugins.sync.exceptions import SyftPermissionError, SyncValidationError
 from syftbox.client.plugins.sync.sync_client import SyncClient
 from syftbox.client.plugins.sync.types import SyncActionType, SyncSide, SyncStatus
+from syftbox.lib.chunks import chunk_file, is_chunked, read_chunk
 from syftbox.lib.constants import REJECTED_FILE_SUFFIX
+from syftbox.lib.delta import apply_delta, compute_delta, map_file
+from syftbox.lib.hash import hash_data
 from syftbox.lib.permissions import SyftPermission
-from syftbox.server.models.sync_models import FileMetadata
+from syftbox.server.models.sync_models import ApplyDiffRequest, BatchResult, DiffResponse, FileMetadata
 
 
 def determine_sync_action(
@@ -79,6 +85,172 @@ def determine_sync_action(
     return action
 
 
+def _write_local_file_atomic(abs_path: Path, write: Callable[[BinaryIO], None]) -> os.stat_result:
+    """
+    Write a file through a hidden temporary file and an atomic rename, the file is not replaced if `write` raises.
+
+    Returns:
+        os.stat_result: Stat of the written file.
+    """
+    abs_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = abs_path.with_name(f".{abs_path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(temp_path, "wb") as f:
+            write(f)
+        # rename keeps the mtime, so the stat matches the file after the rename
+        stat = temp_path.stat()
+        os.replace(temp_path, abs_path)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    return stat
+
+
+def write_local_file(
+    client: SyncClient,
+    path: Path,
+    data: bytes,
+    remote_metadata: Optional[FileMetadata] = None,
+) -> FileMetadata:
+    """
+    Write a file to the local datasites dir through a hidden temporary file and an atomic rename,
+    so a partially written file is never picked up as a local change.
+
+    The file is added to the hash cache, so it is not hashed again by the next sync. If `remote_metadata`
+    matches `data`, its signature is reused instead of computing it.
+
+    Returns:
+        FileMetadata: Metadata of the local file.
+    """
+    abs_path = client.workspace.datasites / path
+    stat = _write_local_file_atomic(abs_path, lambda f: f.write(data))
+
+    if remote_metadata is not None and remote_metadata.hash == hashlib.sha256(data).hexdigest():
+        metadata = _with_remote_signature(path, stat, remote_metadata)
+    else:
+        metadata = hash_data(data, path, stat)
+    client.hash_cache.put(abs_path, metadata)
+    return metadata
+
+
+def apply_local_diff(
+    client: SyncClient,
+    path: Path,
+    diff: DiffResponse,
+    remote_metadata: Optional[FileMetadata] = None,
+) -> FileMetadata:
+    """
+    Apply a diff from the server to a local file, like `write_local_file`.
+
+    The old file is memory mapped and the new file is streamed to disk, so neither is loaded in memory.
+    The file is only replaced if the result matches `diff.hash`.
+
+    Raises:
+        ValueError: If the diff is invalid or the result does not match `diff.hash`.
+
+    Returns:
+        FileMetadata: Metadata of the local file.
+    """
+    abs_path = client.workspace.datasites / path
+
+    def write(f: BinaryIO) -> None:
+        with map_file(abs_path) as base:
+            new_hash = apply_delta(base, diff.diff_bytes, f)
+        if new_hash != diff.hash:
+            # TODO error handling
+            raise ValueError("Hash mismatch after applying diff")
+
+    stat = _write_local_file_atomic(abs_path, write)
+
+    if remote_metadata is not None and remote_metadata.hash == diff.hash:
+        metadata = _with_remote_signature(path, stat, remote_metadata)
+        client.hash_cache.put(abs_path, metadata)
+        return metadata
+    # the signature needs the whole file, only compute it if the server did not send it
+    client.hash_cache.pop(abs_path)
+    return client.hash_cache.hash_file(abs_path, client.workspace.datasites, stat=stat)
+
+
+def download_chunked(client: SyncClient, path: Path, remote_metadata: Optional[FileMetadata] = None) -> FileMetadata:
+    """
+    Download a large remote file one chunk at a time, like `write_local_file`.
+
+    Chunks that the local file already has are copied from the local file instead of downloaded.
+
+    Raises:
+        ValueError: If the downloaded file does not match the remote hash.
+
+    Returns:
+        FileMetadata: Metadata of the local file.
+    """
+    abs_path = client.workspace.datasites / path
+    manifest = client.get_chunk_manifest(path)
+    local_chunks = {}
+    if abs_path.is_file():
+        _, chunks = chunk_file(abs_path)
+        local_chunks = {chunk.hash: chunk for chunk in chunks}
+
+    def write(f: BinaryIO) -> None:
+        file_hash = hashlib.sha256()
+        for index, chunk in enumerate(manifest.chunks):
+            try:
+                data = read_chunk(abs_path, local_chunks[chunk.hash])
+            except (KeyError, ValueError):
+                data = client.download_chunk(path, manifest.hash, index)
+                if hashlib.sha256(data).hexdigest() != chunk.hash:
+                    raise ValueError(f"Hash mismatch in downloaded chunk {index} of {path}")
+            file_hash.update(data)
+            f.write(data)
+        if file_hash.hexdigest() != manifest.hash:
+            raise ValueError("Hash mismatch after downloading chunks")
+
+    stat = _write_local_file_atomic(abs_path, write)
+
+    if remote_metadata is not None and remote_metadata.hash == manifest.hash:
+        metadata = _with_remote_signature(path, stat, remote_metadata)
+        client.hash_cache.put(abs_path, metadata)
+        return metadata
+    client.hash_cache.pop(abs_path)
+    return client.hash_cache.hash_file(abs_path, client.workspace.datasites, stat=stat)
+
+
+def upload_chunked(client: SyncClient, path: Path) -> None:
+    """
+    Upload a large local file one chunk at a time.
+
+    The chunk hashes are sent to the server first, and only the chunks the server does not have are uploaded.
+    Depending on the server, these are chunks of the current remote file or of any file on the server.
+
+    Raises:
+        ValueError: If the local file changed during the upload.
+    """
+    abs_path = client.workspace.datasites / path
+    file_hash, chunks = chunk_file(abs_path)
+    chunks_by_hash = {chunk.hash: chunk for chunk in chunks}
+
+    result = client.commit_chunks(path, chunks, file_hash)
+    for _ in range(2):
+        if not result.missing_chunks:
+            return
+        logger.debug(f"Uploading {len(result.missing_chunks)} of {len(chunks)} chunks of {path}")
+        for chunk_hash in result.missing_chunks:
+            client.upload_chunk(chunk_hash, read_chunk(abs_path, chunks_by_hash[chunk_hash]))
+        # chunks can still be missing if a file on the server changed after the first commit
+        result = client.commit_chunks(path, chunks, file_hash)
+    if result.missing_chunks:
+        raise ValueError(f"Failed to upload chunks of {path}, {len(result.missing_chunks)} chunks are missing")
+
+
+def _with_remote_signature(path: Path, stat: os.stat_result, remote_metadata: FileMetadata) -> FileMetadata:
+    return FileMetadata(
+        path=path,
+        hash=remote_metadata.hash,
+        signature=remote_metadata.signature,
+        file_size=stat.st_size,
+        last_modified=datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+    )
+
+
 def format_rejected_path(path: Path) -> Path:
     return path.with_suffix(REJECTED_FILE_SUFFIX + path.suffix)
 
@@ -147,6 +319,37 @@ class SyncAction(ABC):
         return self.local_metadata
 
 
+class BatchableSyncAction(ABC):
+    """Mixin of sync actions that can also be executed with other actions of their type in a single request."""
+
+    # endpoint that executes multiple actions of this type with a single request, see `execute_batch`
+    batch_endpoint: ClassVar[str]
+
+    @abstractmethod
+    def can_batch(self) -> bool:
+        """True if the action can be executed with other actions of its type, with `execute_batch`."""
+        pass
+
+    @classmethod
+    @abstractmethod
+    def execute_batch(cls, client: SyncClient, actions: list[SyncAction]) -> dict[Path, BatchResult]:
+        """
+        Send multiple actions of this type to `batch_endpoint` in a single request.
+
+        Actions that fail before the request is sent are marked with their error and left out of the request.
+        Every other action has to be completed with its result, see `complete_batch`.
+
+        Returns:
+            dict[Path, BatchResult]: Result of every action in the request, by path.
+        """
+        pass
+
+    def complete_batch(self, client: SyncClient, result: Optional[BatchResult]) -> None:
+        """Complete the action with its result from `execute_batch`, raises like `execute`."""
+        client.raise_for_batch_result(self.batch_endpoint, result)
+        self.status = SyncStatus.SYNCED
+
+
 class NoopAction(SyncAction):
     action_type = SyncActionType.NOOP
 
@@ -166,10 +369,14 @@ class CreateLocalAction(SyncAction):
     action_type = SyncActionType.CREATE_LOCAL
 
     def execute(self, client: SyncClient) -> None:
-        content_bytes = client.download(self.path)
-        abs_path = client.workspace.datasites / self.path
-        abs_path.parent.mkdir(parents=True, exist_ok=True)
-        abs_path.write_bytes(content_bytes)
+        inline_content = client.get_inline_content(self.remote_metadata)
+        if inline_content is not None:
+            write_local_file(client, self.path, inline_content, self.remote_metadata)
+        elif is_chunked(self.remote_metadata):
+            download_chunked(client, self.path, self.remote_metadata)
+        else:
+            content_bytes = client.download(self.path)
+            write_local_file(client, self.path, content_bytes, self.remote_metadata)
         self.status = SyncStatus.SYNCED
 
     def process_rejection(self, client: SyncClient, reason: Optional[str] = None) -> None:
@@ -182,21 +389,16 @@ class ModifyLocalAction(SyncAction):
     action_type = SyncActionType.MODIFY_LOCAL
 
     def execute(self, client: SyncClient):
-        # Use rsync to update the local file with the remote changes
-        diff = client.get_diff(self.path, self.local_metadata.signature)
-
-        abs_path = client.workspace.datasites / self.path
-        local_data = abs_path.read_bytes()
-        new_data = py_fast_rsync.apply(local_data, diff.diff_bytes)
-        new_hash = hashlib.sha256(new_data).hexdigest()
-
-        if new_hash != diff.hash:
-            # TODO error handling
-            raise ValueError("Hash mismatch after applying diff")
-
-        # TODO implement safe write with tempfile + rename
-        abs_path.parent.mkdir(parents=True, exist_ok=True)
-        abs_path.write_bytes(new_data)
+        inline_content = client.get_inline_content(self.remote_metadata)
+        if inline_content is not None:
+            # small files are inlined in listings, writing them is cheaper than requesting a diff
+            write_local_file(client, self.path, inline_content, self.remote_metadata)
+        elif is_chunked(self.local_metadata) or is_chunked(self.remote_metadata):
+            download_chunked(client, self.path, self.remote_metadata)
+        else:
+            # Use rsync to update the local file with the remote changes
+            diff = client.get_diff(self.path, self.local_metadata.signature)
+            apply_local_diff(client, self.path, diff, self.remote_metadata)
         self.status = SyncStatus.SYNCED
 
     def process_rejection(self, client: SyncClient, reason: Optional[str] = None) -> None:
@@ -212,6 +414,7 @@ class DeleteLocalAction(SyncAction):
     def execute(self, client: SyncClient):
         abs_path = client.workspace.datasites / self.path
         abs_path.unlink()
+        client.hash_cache.pop(abs_path)
         self.status = SyncStatus.SYNCED
 
     def process_rejection(self, client: SyncClient, reason: Optional[str] = None) -> None:
@@ -219,15 +422,42 @@ class DeleteLocalAction(SyncAction):
         pass
 
 
-class CreateRemoteAction(SyncAction):
+class CreateRemoteAction(BatchableSyncAction, SyncAction):
     action_type = SyncActionType.CREATE_REMOTE
+    batch_endpoint = "/sync/upload_bulk"
 
     def execute(self, client: SyncClient):
-        abs_path = client.workspace.datasites / self.path
-        data = abs_path.read_bytes()
-        client.create(self.path, data)
+        if is_chunked(self.local_metadata):
+            upload_chunked(client, self.path)
+        else:
+            abs_path = client.workspace.datasites / self.path
+            data = abs_path.read_bytes()
+            client.create(self.path, data)
         self.status = SyncStatus.SYNCED
 
+    def can_batch(self) -> bool:
+        # permission files are created on their own, so they never change the permissions of a batch
+        return (
+            self.local_metadata is not None
+            and self.local_metadata.file_size <= BATCH_MAX_FILE_SIZE
+            and not SyftPermission.is_permission_file(self.path)
+        )
+
+    @classmethod
+    def execute_batch(cls, client: SyncClient, actions: list[SyncAction]) -> dict[Path, BatchResult]:
+        files: dict[Path, bytes] = {}
+        expected_hashes: dict[Path, str] = {}
+        for action in actions:
+            try:
+                files[action.path] = (client.workspace.datasites / action.path).read_bytes()
+                expected_hashes[action.path] = action.local_metadata.hash
+            except OSError as e:
+                action.error(e)
+        if not files:
+            return {}
+        response = client.upload_bulk(files, expected_hashes)
+        return {result.path: result for result in response.results}
+
     def process_rejection(self, client: SyncClient, reason: Optional[str] = None) -> None:
         # Attempted upload without permission, the local file is renamed to a rejected file
         abs_path = client.workspace.datasites / self.path
@@ -237,13 +467,51 @@ class CreateRemoteAction(SyncAction):
         self.message = reason
 
 
-class ModifyRemoteAction(SyncAction):
+class ModifyRemoteAction(BatchableSyncAction, SyncAction):
     action_type = SyncActionType.MODIFY_REMOTE
+    batch_endpoint = "/sync/apply_diff_bulk"
+
+    def can_batch(self) -> bool:
+        # large files are uploaded in chunks, permission files are modified on their own
+        return (
+            self.local_metadata is not None
+            and self.remote_metadata is not None
+            and self.local_metadata.file_size <= BATCH_MAX_FILE_SIZE
+            and self.remote_metadata.file_size <= BATCH_MAX_FILE_SIZE
+            and not SyftPermission.is_permission_file(self.path)
+        )
+
+    @classmethod
+    def execute_batch(cls, client: SyncClient, actions: list[SyncAction]) -> dict[Path, BatchResult]:
+        diffs = []
+        for action in actions:
+            try:
+                with map_file(client.workspace.datasites / action.path) as local_data:
+                    diff = compute_delta(action.remote_metadata.signature_bytes, local_data)
+            except OSError as e:
+                action.error(e)
+                continue
+            diffs.append(
+                ApplyDiffRequest(
+                    path=action.path,
+                    diff=base64.b85encode(diff).decode("utf-8"),
+                    expected_hash=action.local_metadata.hash,
+                )
+            )
+        if not diffs:
+            return {}
+        response = client.apply_diff_bulk(diffs)
+        return {result.path: result for result in response.results}
 
     def execute(self, client: SyncClient):
-        abs_path = client.workspace.datasites / self.path
-        local_data = abs_path.read_bytes()
-        diff = py_fast_rsync.diff(self.remote_metadata.signature_bytes, local_data)
+        if is_chunked(self.local_metadata) or is_chunked(self.remote_metadata):
+            upload_chunked(client, self.path)
+            self.status = SyncStatus.SYNCED
+            return
+
+        # the local file is memory mapped and diffed in windows, see `compute_delta`
+        with map_file(client.workspace.datasites / self.path) as local_data:
+            diff = compute_delta(self.remote_metadata.signature_bytes, local_data)
         client.apply_diff(
             relative_path=self.path,
             diff=diff,
@@ -268,8 +536,17 @@ class ModifyRemoteAction(SyncAction):
         self.message = reason
 
 
-class DeleteRemoteAction(SyncAction):
+class DeleteRemoteAction(BatchableSyncAction, SyncAction):
     action_type = SyncActionType.DELETE_REMOTE
+    batch_endpoint = "/sync/delete_bulk"
+
+    def can_batch(self) -> bool:
+        return not SyftPermission.is_permission_file(self.path)
+
+    @classmethod
+    def execute_batch(cls, client: SyncClient, actions: list[SyncAction]) -> dict[Path, BatchResult]:
+        response = client.delete_bulk([action.path for action in actions])
+        return {result.path: result for result in response.results}
 
     def execute(self, client: SyncClient):
         client.delete(self.path)
@@ -1,14 +1,36 @@
 import base64
+import itertools
+import json
 from pathlib import Path
-from typing import Union
+from typing import Iterable, Iterator, Optional, Union
 
 import httpx
 
 from syftbox.client.base import SyftClientInterface
 from syftbox.client.exceptions import SyftServerError
+from syftbox.client.plugins.sync.constants import INLINE_CONTENT_MAX_SIZE, REMOTE_STATE_PAGE_SIZE
 from syftbox.client.plugins.sync.exceptions import SyftPermissionError
+from syftbox.client.plugins.sync.placeholders import Placeholders
+from syftbox.lib.hash import HashCache, HashPool
+from syftbox.lib.http import HEADER_SYFTBOX_NEXT_CURSOR, NDJSON_MEDIA_TYPE
+from syftbox.lib.subscriptions import Subscriptions
 from syftbox.lib.workspace import SyftWorkspace
-from syftbox.server.models.sync_models import ApplyDiffResponse, DiffResponse, FileMetadata
+from syftbox.server.models.sync_models import (
+    ApplyDiffRequest,
+    ApplyDiffResponse,
+    BatchApplyDiffRequest,
+    BatchResponse,
+    BatchResult,
+    ChunkInfo,
+    ChunkManifest,
+    CommitChunksRequest,
+    CommitChunksResponse,
+    DatasiteStateResponse,
+    DiffResponse,
+    FileMetadata,
+    SubscriptionList,
+    TreeNodeResponse,
+)
 
 
 class SyncClient:
@@ -16,8 +38,30 @@ class SyncClient:
     Client for handling file sync operations with the server.
     """
 
-    def __init__(self, client: SyftClientInterface) -> None:
+    def __init__(
+        self,
+        client: SyftClientInterface,
+        page_size: int = REMOTE_STATE_PAGE_SIZE,
+        hash_pool: Optional[HashPool] = None,
+        inline_max_size: int = INLINE_CONTENT_MAX_SIZE,
+    ) -> None:
         self.client = client
+        self.page_size = page_size
+        self.inline_max_size = inline_max_size
+        # (metadata, contents) of small remote files that were inlined in listings, by path
+        self.inline_contents: dict[Path, tuple[FileMetadata, bytes]] = {}
+        # subscriptions of the user from the last get_subscriptions or set_subscriptions call, None before the first
+        self.subscriptions: Optional[Subscriptions] = None
+        # manifest of remote files that are not downloaded, set by the SyncManager, see sync.placeholders
+        self.placeholders: Optional[Placeholders] = None
+        # (etag, result) of the last complete get_datasite_states call
+        self._datasite_states_cache: Optional[tuple[str, list[tuple[str, list[FileMetadata]]]]] = None
+        # (etag, root) of the last get_tree_node call for the root of the tree
+        self._tree_root_cache: Optional[tuple[str, TreeNodeResponse]] = None
+        # metadata of local files, shared by the producer, consumer and sync actions
+        self.hash_cache = HashCache()
+        # workers for hashing local files, files are hashed on the calling thread if None
+        self.hash_pool = hash_pool
 
     @property
     def email(self) -> str:
@@ -42,25 +86,167 @@ class SyncClient:
         elif response.status_code != 200:
             raise SyftServerError(f"[{endpoint_path}] call failed ({response.status_code}): {response.text}")
 
-    def get_datasite_states(self) -> dict[str, list[FileMetadata]]:
-        response = self.server_client.post("/sync/datasite_states")
+    def raise_for_batch_result(self, endpoint_path: str, result: Optional[BatchResult]) -> None:
+        """Error handling for a single file of a batch endpoint, like `raise_for_status`."""
+        if result is None:
+            raise SyftServerError(f"[{endpoint_path}] file is missing from the response")
+        if result.status_code == 403:
+            raise SyftPermissionError(f"[{endpoint_path}] permission denied: {result.detail}")
+        elif result.status_code != 200:
+            raise SyftServerError(f"[{endpoint_path}] call failed ({result.status_code}): {result.detail}")
+
+    def _iter_pages(
+        self,
+        endpoint: str,
+        params: Optional[dict] = None,
+        headers: Optional[dict] = None,
+    ) -> Iterator[httpx.Response]:
+        """Request a paginated listing endpoint page by page, following the next-page cursor."""
+        cursor = None
+        while True:
+            page_params = {**(params or {}), "page_size": self.page_size}
+            if cursor is not None:
+                page_params["cursor"] = cursor
+
+            response = self.server_client.post(endpoint, params=page_params, headers=headers)
+            if response.status_code == 304:
+                # Not modified, there are no pages to follow
+                yield response
+                return
+            self.raise_for_status(response)
+            yield response
+
+            cursor = response.headers.get(HEADER_SYFTBOX_NEXT_CURSOR)
+            if cursor is None:
+                return
+
+    def _add_inline_contents(self, files: Iterable[FileMetadata], contents: dict[Path, str]) -> None:
+        for file in files:
+            if file.path in contents:
+                self.inline_contents[file.path] = (file, base64.b85decode(contents[file.path]))
+
+    def get_inline_content(self, metadata: Optional[FileMetadata]) -> Optional[bytes]:
+        """Contents of a remote file from a listing, None if it was not inlined or has a different hash."""
+        if metadata is None or metadata.path not in self.inline_contents:
+            return None
+        inline_metadata, data = self.inline_contents[metadata.path]
+        return data if inline_metadata.hash == metadata.hash else None
+
+    def get_subscriptions(self) -> Subscriptions:
+        """Get the datasites and directories the user syncs, and cache them in `self.subscriptions`."""
+        response = self.server_client.post("/sync/subscriptions")
+        if response.status_code == 404:
+            # server without selective sync, every datasite is listed
+            paths = []
+        else:
+            self.raise_for_status(response)
+            paths = SubscriptionList(**response.json()).paths
+        self.subscriptions = Subscriptions(self.email, paths)
+        return self.subscriptions
+
+    def set_subscriptions(self, paths: list[Path]) -> Subscriptions:
+        """Only sync the given datasites and directories, an empty list syncs everything."""
+        response = self.server_client.post(
+            "/sync/subscriptions/set",
+            json=SubscriptionList(paths=paths).model_dump(mode="json"),
+        )
         self.raise_for_status(response)
-        data = response.json()
+        self.subscriptions = Subscriptions(self.email, SubscriptionList(**response.json()).paths)
+        return self.subscriptions
+
+    def get_datasites(self) -> list[str]:
+        response = self.server_client.post("/sync/datasites")
+        self.raise_for_status(response)
+        return response.json()
+
+    def get_datasite_states(self) -> Iterator[tuple[str, list[FileMetadata]]]:
+        """
+        Lazily yield (datasite, remote files) for every datasite on the server.
+
+        Pages are requested as they are consumed. A datasite is only yielded once all of its files are received,
+        datasites without readable files are yielded last with an empty list.
+
+        The last complete result is cached with its ETag. If the server reports the state is unchanged
+        (304 Not Modified), the cached result is returned without downloading the listing again.
+        """
+        headers = {"Accept": NDJSON_MEDIA_TYPE}
+        if self._datasite_states_cache is not None:
+            headers["If-None-Match"] = self._datasite_states_cache[0]
+
+        params = {"inline_max_size": self.inline_max_size}
+        pages = self._iter_pages("/sync/datasite_states", params=params, headers=headers)
+        first_page = next(pages)
+        if first_page.status_code == 304:
+            yield from self._datasite_states_cache[1]
+            return
 
-        result = {}
-        for email, metadata_list in data.items():
-            result[email] = [FileMetadata(**item) for item in metadata_list]
+        etag = first_page.headers.get("etag")
+        result = []
+        for datasite, files in self._merge_datasite_state_pages(itertools.chain([first_page], pages)):
+            result.append((datasite, files))
+            yield datasite, files
 
-        return result
+        # Only cache complete results
+        self._datasite_states_cache = (etag, result) if etag else None
+
+    def _merge_datasite_state_pages(self, pages: Iterator[httpx.Response]) -> Iterator[tuple[str, list[FileMetadata]]]:
+        """
+        Merge the pages of /sync/datasite_states per datasite.
+
+        Only datasites listed by the server are yielded. The last page lists every subscribed datasite, datasites
+        that were already yielded are listed again with an empty list and skipped.
+        """
+        seen = set()
+        current_datasite, current_files = None, []
+        for response in pages:
+            for datasite_state in _parse_datasite_states(response):
+                # Files of a datasite are contiguous across pages
+                if datasite_state.datasite != current_datasite:
+                    if datasite_state.datasite in seen:
+                        continue
+                    if current_datasite is not None:
+                        yield current_datasite, current_files
+                    current_datasite, current_files = datasite_state.datasite, []
+                    seen.add(current_datasite)
+                current_files.extend(datasite_state.files)
+                self._add_inline_contents(datasite_state.files, datasite_state.contents)
+
+        if current_datasite is not None:
+            yield current_datasite, current_files
+
+    def get_remote_state(self, relative_path: Path) -> Iterator[FileMetadata]:
+        """Lazily yield the metadata of all remote files under `relative_path`, page by page."""
+        for response in self._iter_pages("/sync/dir_state", params={"dir": relative_path.as_posix()}):
+            for item in response.json():
+                yield FileMetadata(**item)
+
+    def get_tree_node(self, relative_path: Path) -> TreeNodeResponse:
+        """
+        Get a directory of the remote Merkle tree, Path(".") is the root with one child per datasite.
+
+        The root is cached with its ETag, if the server reports it is unchanged (304 Not Modified) the cached root
+        is returned.
+        """
+        is_root = relative_path == Path(".")
+        headers = {}
+        if is_root and self._tree_root_cache is not None:
+            headers["If-None-Match"] = self._tree_root_cache[0]
 
-    def get_remote_state(self, relative_path: Path) -> list[FileMetadata]:
         response = self.server_client.post(
-            "/sync/dir_state",
-            params={"dir": relative_path.as_posix()},
+            "/sync/tree",
+            params={"dir": relative_path.as_posix(), "inline_max_size": self.inline_max_size},
+            headers=headers,
         )
+        if response.status_code == 304 and is_root and self._tree_root_cache is not None:
+            return self._tree_root_cache[1]
         self.raise_for_status(response)
-        data = response.json()
-        return [FileMetadata(**item) for item in data]
+        node = TreeNodeResponse(**response.json())
+        self._add_inline_contents((child.metadata for child in node.children if child.metadata), node.contents)
+
+        etag = response.headers.get("etag")
+        if is_root:
+            self._tree_root_cache = (etag, node) if etag else None
+        return node
 
     def get_metadata(self, path: Path) -> FileMetadata:
         response = self.server_client.post(
@@ -127,6 +313,24 @@ class SyncClient:
         )
         self.raise_for_status(response)
 
+    def delete_bulk(self, relative_paths: list[Path]) -> BatchResponse:
+        """Delete multiple remote files in a single request, like `upload_bulk`."""
+        response = self.server_client.post(
+            "/sync/delete_bulk",
+            json={"paths": [path.as_posix() for path in relative_paths]},
+        )
+        self.raise_for_status(response)
+        return BatchResponse(**response.json())
+
+    def apply_diff_bulk(self, diffs: list[ApplyDiffRequest]) -> BatchResponse:
+        """Apply diffs to multiple remote files in a single request, like `upload_bulk`."""
+        response = self.server_client.post(
+            "/sync/apply_diff_bulk",
+            json=BatchApplyDiffRequest(diffs=diffs).model_dump(mode="json"),
+        )
+        self.raise_for_status(response)
+        return BatchResponse(**response.json())
+
     def create(self, relative_path: Path, data: bytes) -> None:
         response = self.server_client.post(
             "/sync/create",
@@ -134,6 +338,19 @@ class SyncClient:
         )
         self.raise_for_status(response)
 
+    def upload_bulk(self, files: dict[Path, bytes], expected_hashes: dict[Path, str]) -> BatchResponse:
+        """Create multiple new remote files in a single request.
+
+        Every file is created or rejected on its own, check the result of each file with `raise_for_batch_result`.
+        """
+        response = self.server_client.post(
+            "/sync/upload_bulk",
+            files=[("files", (path.as_posix(), data, "application/octet-stream")) for path, data in files.items()],
+            data={"hashes": json.dumps({path.as_posix(): file_hash for path, file_hash in expected_hashes.items()})},
+        )
+        self.raise_for_status(response)
+        return BatchResponse(**response.json())
+
     def download(self, relative_path: Path) -> bytes:
         response = self.server_client.post(
             "/sync/download",
@@ -142,6 +359,45 @@ class SyncClient:
         self.raise_for_status(response)
         return response.content
 
+    def get_chunk_manifest(self, relative_path: Path) -> ChunkManifest:
+        response = self.server_client.post(
+            "/sync/chunks/manifest",
+            json={"path": relative_path.as_posix()},
+        )
+        self.raise_for_status(response)
+        return ChunkManifest(**response.json())
+
+    def download_chunk(self, relative_path: Path, file_hash: str, index: int) -> bytes:
+        """Download chunk `index` of the remote file, `file_hash` is the hash from its chunk manifest."""
+        response = self.server_client.post(
+            "/sync/chunks/download",
+            json={"path": relative_path.as_posix(), "hash": file_hash, "index": index},
+        )
+        self.raise_for_status(response)
+        return response.content
+
+    def upload_chunk(self, chunk_hash: str, data: bytes) -> None:
+        response = self.server_client.post(
+            "/sync/chunks/upload",
+            files={"file": (chunk_hash, data, "application/octet-stream")},
+        )
+        self.raise_for_status(response)
+
+    def commit_chunks(self, relative_path: Path, chunks: list[ChunkInfo], expected_hash: str) -> CommitChunksResponse:
+        """Write a remote file from uploaded chunks and chunks of the current remote file.
+
+        Returns:
+            CommitChunksResponse: if `missing_chunks` is not empty, nothing was written.
+        """
+        response = self.server_client.post(
+            "/sync/chunks/commit",
+            json=CommitChunksRequest(path=relative_path, expected_hash=expected_hash, chunks=chunks).model_dump(
+                mode="json"
+            ),
+        )
+        self.raise_for_status(response)
+        return CommitChunksResponse(**response.json())
+
     def download_bulk(self, relative_paths: list[Path]) -> bytes:
         relative_paths = [path.as_posix() for path in relative_paths]
         response = self.server_client.post(
@@ -150,3 +406,10 @@ class SyncClient:
         )
         self.raise_for_status(response)
         return response.content
+
+
+def _parse_datasite_states(response: httpx.Response) -> list[DatasiteStateResponse]:
+    """Parse a /sync/datasite_states response, either NDJSON or a single JSON object from older servers."""
+    if response.headers.get("content-type", "").startswith(NDJSON_MEDIA_TYPE):
+        return [DatasiteStateResponse.model_validate_json(line) for line in response.iter_lines() if line]
+    return [DatasiteStateResponse(datasite=datasite, files=files) for datasite, files in response.json().items()]
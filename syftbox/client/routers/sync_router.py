@@ -1,15 +1,18 @@
+from pathlib import Path
 from typing import List, Optional
 
 import wcmatch.glob
 from fastapi import APIRouter, Depends, HTTPException
 from fastapi.responses import HTMLResponse
 from jinja2 import Environment, FileSystemLoader
+from pydantic import BaseModel
 
 from syftbox.client.exceptions import SyftPluginException
 from syftbox.client.plugins.sync.local_state import SyncStatusInfo
 from syftbox.client.plugins.sync.manager import SyncManager
 from syftbox.client.plugins.sync.types import SyncStatus
 from syftbox.client.routers.common import APIContext
+from syftbox.server.models.sync_models import FileMetadata, RelativePath
 
 router = APIRouter()
 jinja_env = Environment(loader=FileSystemLoader("syftbox/assets/templates"))
@@ -106,3 +109,43 @@ def get_status_info(
 def sync_dashboard(context: APIContext):
     template = jinja_env.get_template("sync_dashboard.jinja2")
     return HTMLResponse(template.render(base_url=context.config.client_url))
+
+
+class MaterializeRequest(BaseModel):
+    path: RelativePath
+    pin: bool = False
+
+
+class EvictRequest(BaseModel):
+    path: RelativePath
+
+
+def validate_datasites_path(path: Path) -> None:
+    if not path.parts or ".." in path.parts:
+        raise HTTPException(status_code=400, detail=f"Invalid path {path}")
+
+
+@router.get("/placeholders")
+def get_placeholders(sync_manager: SyncManager = Depends(get_sync_manager)) -> List[FileMetadata]:
+    """Remote files that are not downloaded, if metadata-only sync is enabled."""
+    return list(sync_manager.placeholders.files.values())
+
+
+@router.post("/placeholders")
+def set_placeholders_enabled(enabled: bool, sync_manager: SyncManager = Depends(get_sync_manager)) -> dict:
+    sync_manager.set_placeholders_enabled(enabled)
+    return {"enabled": enabled}
+
+
+@router.post("/materialize")
+def materialize(req: MaterializeRequest, sync_manager: SyncManager = Depends(get_sync_manager)) -> List[Path]:
+    """Download placeholders under a path, returns the local files under the path."""
+    validate_datasites_path(req.path)
+    return sync_manager.materialize(req.path, pin=req.pin)
+
+
+@router.post("/evict")
+def evict(req: EvictRequest, sync_manager: SyncManager = Depends(get_sync_manager)) -> List[Path]:
+    """Delete unpinned local copies under a path and turn them back into placeholders."""
+    validate_datasites_path(req.path)
+    return sync_manager.evict(req.path)
@@ -0,0 +1,107 @@
+"""
+Chunked transfer of large files.
+
+Files larger than `CHUNKED_FILE_THRESHOLD` are not synced with rsync diffs, which need the whole file in memory.
+They are split into chunks of at most `CHUNK_SIZE` bytes, and the server keeps the sha256 of every chunk.
+A client sends the chunk hashes of its file to the server, and only uploads or downloads the chunks that the other
+side does not have. Files are always read and written one chunk at a time, so memory use does not depend on
+the file size.
+
+Chunk boundaries are content-defined: a chunk ends after a run of `CDC_RUN_LENGTH` bytes that all fall in the same
+half of a fixed partition of byte values, searched with `bytes.find` on a translated copy of the data. Boundaries
+only depend on the bytes around them, so inserting data into a file or appending to it only changes the chunks
+around the change, and identical data in different files is split into identical chunks. Like FastCDC, a longer run
+is required before `CDC_AVG_SIZE` and a shorter one after it, which keeps chunk sizes close to the average.
+
+Large files have no rsync signature, their `FileMetadata.signature` is empty.
+"""
+
+import hashlib
+from pathlib import Path
+from typing import BinaryIO, Iterator, Optional, Union
+
+from syftbox.server.models.sync_models import ChunkInfo, FileMetadata
+
+CHUNK_SIZE = 4 * 1024 * 1024
+CHUNKED_FILE_THRESHOLD = 10 * 1024 * 1024
+
+CDC_MIN_SIZE = 256 * 1024
+CDC_AVG_SIZE = 1024 * 1024
+CDC_RUN_LENGTH = 20
+
+# every byte value is mapped to 0 or 1, derived from sha256 so the partition never changes between versions
+_CDC_TABLE = bytes(hashlib.sha256(bytes([b])).digest()[0] & 1 for b in range(256))
+_CDC_RUN_BEFORE_AVG = b"\x01" * CDC_RUN_LENGTH
+_CDC_RUN_AFTER_AVG = b"\x01" * (CDC_RUN_LENGTH - 4)
+
+
+def is_chunked(metadata: Optional[FileMetadata]) -> bool:
+    """True if the file is synced in chunks instead of with rsync diffs."""
+    return metadata is not None and metadata.file_size > CHUNKED_FILE_THRESHOLD
+
+
+def find_chunk_boundary(data: Union[bytes, bytearray]) -> int:
+    """Length of the first chunk of `data`, `data` should hold at least `CHUNK_SIZE` bytes unless it is the end."""
+    if len(data) <= CDC_MIN_SIZE:
+        return len(data)
+    classes = data[:CHUNK_SIZE].translate(_CDC_TABLE)
+    end = len(classes)
+
+    i = classes.find(_CDC_RUN_BEFORE_AVG, CDC_MIN_SIZE, min(end, CDC_AVG_SIZE))
+    if i >= 0:
+        return i + len(_CDC_RUN_BEFORE_AVG)
+    i = classes.find(_CDC_RUN_AFTER_AVG, max(CDC_MIN_SIZE, CDC_AVG_SIZE - len(_CDC_RUN_AFTER_AVG)), end)
+    if i >= 0:
+        return i + len(_CDC_RUN_AFTER_AVG)
+    return end
+
+
+def iter_chunks(f: BinaryIO) -> Iterator[tuple[ChunkInfo, bytes]]:
+    """Read a file object from its current position, yields the info and contents of every chunk."""
+    offset = 0
+    buffer = bytearray()
+    while True:
+        if len(buffer) < CHUNK_SIZE:
+            buffer += f.read(CHUNK_SIZE - len(buffer))
+        if not buffer:
+            return
+        size = find_chunk_boundary(buffer)
+        data = bytes(buffer[:size])
+        del buffer[:size]
+        yield ChunkInfo(offset=offset, size=size, hash=hashlib.sha256(data).hexdigest()), data
+        offset += size
+
+
+def chunk_file(path: Path) -> tuple[str, list[ChunkInfo]]:
+    """
+    Hash a file one chunk at a time.
+
+    Returns:
+        tuple[str, list[ChunkInfo]]: sha256 of the whole file, and the chunks of the file.
+    """
+    file_hash = hashlib.sha256()
+    chunks = []
+    with open(path, "rb") as f:
+        for chunk, data in iter_chunks(f):
+            file_hash.update(data)
+            chunks.append(chunk)
+    return file_hash.hexdigest(), chunks
+
+
+def sha256_file(path: Path) -> str:
+    """sha256 of a file, read in blocks of `CHUNK_SIZE`."""
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        while data := f.read(CHUNK_SIZE):
+            file_hash.update(data)
+    return file_hash.hexdigest()
+
+
+def read_chunk(path: Path, chunk: ChunkInfo) -> bytes:
+    """Read a chunk of a file, raises ValueError if the file changed since it was chunked."""
+    with open(path, "rb") as f:
+        f.seek(chunk.offset)
+        data = f.read(chunk.size)
+    if hashlib.sha256(data).hexdigest() != chunk.hash:
+        raise ValueError(f"Chunk at offset {chunk.offset} of {path} changed")
+    return data
@@ -8,9 +8,11 @@ But we need it to maintain compatibility with apps
 
 from pathlib import Path
 
+import httpx
 from typing_extensions import Optional, Self
 
 from syftbox.lib.client_config import SyftClientConfig
+from syftbox.lib.http import SYFTBOX_HEADERS
 from syftbox.lib.types import PathLike, to_path
 from syftbox.lib.workspace import SyftWorkspace
 
@@ -103,3 +105,45 @@ class Client:
 
         for path in paths:
             to_path(path).mkdir(parents=True, exist_ok=True)
+
+    def _relative_to_datasites(self, path: PathLike) -> Path:
+        path = Path(path).expanduser()
+        if not path.is_absolute():
+            return path
+        return path.resolve().relative_to(self.datasites)
+
+    def _post_client(self, endpoint: str, json: dict) -> list[Path]:
+        response = httpx.post(
+            f"{str(self.config.client_url).rstrip('/')}{endpoint}",
+            json=json,
+            headers=SYFTBOX_HEADERS,
+            timeout=None,
+        )
+        response.raise_for_status()
+        return [self.datasites / path for path in response.json()]
+
+    def materialize(self, path: PathLike, pin: bool = False) -> Path:
+        """
+        Download a file or directory that is only synced as a placeholder, see `client.plugins.sync.placeholders`.
+        Does nothing for files that already exist locally. Requires the SyftBox client to be running.
+
+        Args:
+            path (PathLike): Path in the datasites folder, absolute or relative to the datasites folder.
+            pin (bool, optional): Also download files that are created under the path later. Defaults to False.
+
+        Returns:
+            Path: Absolute path of the downloaded file or directory.
+        """
+        relative_path = self._relative_to_datasites(path)
+        self._post_client("/sync/materialize", {"path": relative_path.as_posix(), "pin": pin})
+        return self.datasites / relative_path
+
+    def evict(self, path: PathLike) -> list[Path]:
+        """
+        Delete local copies of unpinned files in other datasites, they are turned back into placeholders.
+
+        Returns:
+            list[Path]: Absolute paths of the evicted files.
+        """
+        relative_path = self._relative_to_datasites(path)
+        return self._post_client("/sync/evict", {"path": relative_path.as_posix()})
@@ -0,0 +1,172 @@
+"""
+Streaming application of rsync deltas, as produced by `py_fast_rsync.diff`.
+
+`py_fast_rsync.apply` needs the old file and the delta as bytes and returns the new file as bytes, so applying
+a delta holds three copies of the file in memory. The delta format is a list of commands that either copy
+a range of the old file or insert literal bytes, so it can be applied one command at a time: the old file is read
+through a memory map and the new file is written to a file object, `DELTA_CHUNK_SIZE` bytes at a time.
+
+`py_fast_rsync.diff` also needs the new file as bytes. `compute_delta` diffs a memory map of the new file
+`DIFF_WINDOW_SIZE` bytes at a time against the signature of the whole old file, and joins the commands of every
+window into a single delta. Copies never span two windows, so at most one block per window boundary is sent as
+a literal instead of a copy.
+
+Delta format (librsync compatible, big-endian integers):
+    magic: 4 bytes, 0x72730236
+    commands:
+        0x00              end
+        0x01-0x40         literal, the command is the length
+        0x41-0x44         literal, followed by a 1, 2, 4 or 8 byte length
+        0x45-0x54         copy, followed by a 1, 2, 4 or 8 byte offset and a 1, 2, 4 or 8 byte length
+"""
+
+import contextlib
+import hashlib
+import mmap
+from pathlib import Path
+from typing import BinaryIO, Iterator, Union
+
+import py_fast_rsync
+
+DELTA_MAGIC = 0x72730236
+SIGNATURE_MAGIC = 0x72730136
+# MD4, the strong hash of py_fast_rsync signatures
+_MAX_STRONG_HASH_SIZE = 16
+DELTA_CHUNK_SIZE = 1024 * 1024
+DIFF_WINDOW_SIZE = 16 * 1024 * 1024
+
+_END = 0x00
+_LITERAL_MAX_INLINE = 0x40
+_LITERAL_N1 = 0x41
+_COPY_N1_N1 = 0x45
+_COPY_N8_N8 = 0x54
+_INT_WIDTHS = (1, 2, 4, 8)
+
+Buffer = Union[bytes, bytearray, memoryview, mmap.mmap]
+
+
+@contextlib.contextmanager
+def map_file(path: Path) -> Iterator[Buffer]:
+    """Read-only memory map of a file, empty files cannot be mapped and yield b""."""
+    with open(path, "rb") as f:
+        if f.seek(0, 2) == 0:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+
+def _iter_delta(base: Buffer, delta: bytes) -> Iterator[Buffer]:
+    """Yield the new file in chunks of at most `DELTA_CHUNK_SIZE` bytes."""
+    view = memoryview(delta)
+    if len(view) < 4 or int.from_bytes(view[:4], "big") != DELTA_MAGIC:
+        raise ValueError("Invalid delta: bad magic")
+    pos = 4
+
+    def read_int(width: int) -> int:
+        nonlocal pos
+        if pos + width > len(view):
+            raise ValueError("Invalid delta: truncated")
+        value = int.from_bytes(view[pos : pos + width], "big")
+        pos += width
+        return value
+
+    while True:
+        cmd = read_int(1)
+        if cmd == _END:
+            break
+        if cmd < _COPY_N1_N1:
+            length = cmd if cmd <= _LITERAL_MAX_INLINE else read_int(_INT_WIDTHS[cmd - _LITERAL_N1])
+            if pos + length > len(view):
+                raise ValueError("Invalid delta: truncated literal")
+            source, offset = view, pos
+            pos += length
+        elif cmd <= _COPY_N8_N8:
+            offset_width, length_width = divmod(cmd - _COPY_N1_N1, 4)
+            offset = read_int(_INT_WIDTHS[offset_width])
+            length = read_int(_INT_WIDTHS[length_width])
+            if offset + length > len(base):
+                raise ValueError("Invalid delta: copy out of range of the base file")
+            # slices of a memory map are copies, so the map can be closed while chunks are alive
+            source = base
+        else:
+            raise ValueError(f"Invalid delta: unknown command {cmd:#x}")
+
+        for start in range(offset, offset + length, DELTA_CHUNK_SIZE):
+            yield source[start : min(start + DELTA_CHUNK_SIZE, offset + length)]
+
+    if pos != len(view):
+        raise ValueError("Invalid delta: trailing data after end")
+
+
+def apply_delta(base: Buffer, delta: bytes, out: BinaryIO) -> str:
+    """
+    Apply `delta` to `base` and write the result to `out`, without loading the result in memory.
+
+    Args:
+        base (Buffer): Contents of the old file, usually a memory map from `map_file`.
+        delta (bytes): Delta from `py_fast_rsync.diff`.
+        out (BinaryIO): File object the new file is written to.
+
+    Raises:
+        ValueError: If the delta is malformed or does not match `base`.
+
+    Returns:
+        str: sha256 hex digest of the new file.
+    """
+    new_hash = hashlib.sha256()
+    for chunk in _iter_delta(base, delta):
+        new_hash.update(chunk)
+        out.write(chunk)
+    return new_hash.hexdigest()
+
+
+def compute_delta(signature: bytes, data: Buffer) -> bytes:
+    """
+    Delta from the file with `signature` to `data`, like `py_fast_rsync.diff` but only `DIFF_WINDOW_SIZE` bytes
+    of `data` are copied in memory at a time.
+
+    Args:
+        signature (bytes): Signature of the old file, from `py_fast_rsync.signature.calculate`.
+        data (Buffer): Contents of the new file, usually a memory map from `map_file`.
+
+    Raises:
+        ValueError: If the signature is malformed.
+
+    Returns:
+        bytes: The delta, which can be applied with `apply_delta` or `py_fast_rsync.apply`.
+    """
+    # windows are aligned to the block size of the signature, so unchanged files only produce copies
+    block_size = _signature_block_size(signature)
+    window_size = max(block_size, DIFF_WINDOW_SIZE - DIFF_WINDOW_SIZE % block_size)
+
+    delta = bytearray(DELTA_MAGIC.to_bytes(4, "big"))
+    for start in range(0, len(data), window_size):
+        try:
+            window_delta = py_fast_rsync.diff(signature, bytes(data[start : start + window_size]))
+        except RuntimeError as e:
+            raise ValueError(f"Invalid signature: {e}") from e
+        # strip the magic and the end command of every window
+        delta += memoryview(window_delta)[4:-1]
+    delta.append(_END)
+    return bytes(delta)
+
+
+def _signature_block_size(signature: bytes) -> int:
+    """
+    Block size of a signature, checked up front because py_fast_rsync panics on some malformed signatures.
+
+    Signature format (big-endian integers): magic (4 bytes), block size (4 bytes), strong hash size (4 bytes),
+    then a 4 byte rolling hash and a strong hash per block.
+    """
+    if len(signature) < 12:
+        raise ValueError("Invalid signature: truncated header")
+    if int.from_bytes(signature[:4], "big") != SIGNATURE_MAGIC:
+        raise ValueError("Invalid signature: bad magic")
+    block_size = int.from_bytes(signature[4:8], "big")
+    strong_hash_size = int.from_bytes(signature[8:12], "big")
+    if block_size == 0:
+        raise ValueError("Invalid signature: block size is 0")
+    if not 0 < strong_hash_size <= _MAX_STRONG_HASH_SIZE or (len(signature) - 12) % (4 + strong_hash_size) != 0:
+        raise ValueError("Invalid signature: truncated")
+    return block_size
@@ -1,55 +1,231 @@
 import base64
 import hashlib
-from concurrent.futures import ProcessPoolExecutor
+import os
+import threading
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timezone
 from functools import partial
 from pathlib import Path
-from typing import Optional, Union
+from typing import Iterable, Iterator, Optional, Union
 
+import pathspec
 from loguru import logger
 from py_fast_rsync import signature
 
-from syftbox.lib.ignore import filter_ignored_paths
-from syftbox.server.models.sync_models import FileMetadata
+from syftbox.lib.chunks import CHUNKED_FILE_THRESHOLD, sha256_file
+from syftbox.lib.ignore import filter_ignored_paths, get_ignore_matcher
+from syftbox.server.models.sync_models import FileMetadata, datetime_to_ns
 
 
 def hash_file(file_path: Path, root_dir: Optional[Path] = None) -> Optional[FileMetadata]:
-    # ignore files larger then 100MB
     try:
-        if file_path.stat().st_size > 100_000_000:
-            logger.warning("File too large: %s", file_path)
-            return str(file_path), None
-
-        with open(file_path, "rb") as f:
-            # not ideal for large files
-            # but py_fast_rsync does not support files yet.
-            # TODO: add support for streaming hashing
-            data = f.read()
-
         if root_dir is None:
             path = file_path
         else:
             path = file_path.relative_to(root_dir)
-        return FileMetadata(
-            path=path,
-            hash=hashlib.sha256(data).hexdigest(),
-            signature=base64.b85encode(signature.calculate(data)),
-            file_size=len(data),
-            last_modified=datetime.fromtimestamp(file_path.stat().st_mtime, timezone.utc),
-        )
+
+        stat = file_path.stat()
+        if stat.st_size > CHUNKED_FILE_THRESHOLD:
+            # large files are synced in chunks and have no rsync signature, hash them without loading them
+            return FileMetadata(
+                path=path,
+                hash=sha256_file(file_path),
+                signature="",
+                file_size=stat.st_size,
+                last_modified=datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+            )
+
+        with open(file_path, "rb") as f:
+            # py_fast_rsync does not support files, small files are hashed in memory
+            data = f.read()
+        # the stat from before the read, so a file written during the read does not match and is hashed again
+        return hash_data(data, path, stat)
     except Exception:
         logger.error(f"Failed to hash file {file_path}")
         return None
 
 
-def hash_files_parallel(files: list[Path], root_dir: Path) -> list[FileMetadata]:
-    with ProcessPoolExecutor() as executor:
-        results = list(executor.map(partial(hash_file, root_dir=root_dir), files))
+def hash_data(data: bytes, path: Path, stat: os.stat_result) -> FileMetadata:
+    """Metadata of a file at `path` with contents `data`, `stat` is the stat of the file on disk."""
+    return FileMetadata(
+        path=path,
+        hash=hashlib.sha256(data).hexdigest(),
+        signature=base64.b85encode(signature.calculate(data)) if len(data) <= CHUNKED_FILE_THRESHOLD else "",
+        file_size=len(data),
+        last_modified=datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+    )
+
+
+def is_unchanged(stat: os.stat_result, file_size: int, last_modified: int) -> bool:
+    """True if a file with `stat` has the given size and last_modified (ns), as stored by `hash_file`."""
+    mtime = datetime_to_ns(datetime.fromtimestamp(stat.st_mtime, timezone.utc))
+    return stat.st_size == file_size and mtime == last_modified
+
+
+class HashCache:
+    """
+    Metadata of hashed files by absolute path. An entry is used as long as the size and mtime of the file
+    do not change, so unchanged files are not hashed again.
+
+    Entries are grouped by the first part of `metadata.path`, the datasite for paths relative to the datasites dir,
+    so entries of deleted files can be dropped after a walk of a datasite with `prune`.
+    """
+
+    def __init__(self) -> None:
+        self._entries: dict[Path, FileMetadata] = {}
+        self._groups: dict[str, set[Path]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, file_path: Path, stat: os.stat_result) -> Optional[FileMetadata]:
+        metadata = self._entries.get(file_path)
+        if metadata is None or not is_unchanged(stat, metadata.file_size, datetime_to_ns(metadata.last_modified)):
+            return None
+        return metadata
+
+    def put(self, file_path: Path, metadata: FileMetadata) -> None:
+        """Add the metadata of a file, `metadata.last_modified` must be the mtime of the file on disk."""
+        with self._lock:
+            self._pop(file_path)
+            self._entries[file_path] = metadata
+            self._groups.setdefault(metadata.path.parts[0], set()).add(file_path)
+
+    def pop(self, file_path: Path) -> None:
+        with self._lock:
+            self._pop(file_path)
+
+    def _pop(self, file_path: Path) -> None:
+        metadata = self._entries.pop(file_path, None)
+        if metadata is not None:
+            self._groups[metadata.path.parts[0]].discard(file_path)
+
+    def prune(self, group: str, keep: set[Path]) -> int:
+        """Drop the entries of files in `group` that are not in `keep`, returns the number of dropped entries."""
+        with self._lock:
+            dropped = self._groups.get(group, set()) - keep
+            for file_path in dropped:
+                self._pop(file_path)
+            return len(dropped)
+
+    def hash_file(
+        self,
+        file_path: Path,
+        root_dir: Optional[Path] = None,
+        stat: Optional[os.stat_result] = None,
+    ) -> Optional[FileMetadata]:
+        """Like `hash_file`, but returns the cached metadata if the file did not change.
+        `stat` of the file can be passed in if it is already known."""
+        try:
+            metadata = self.get(file_path, stat or file_path.stat())
+        except OSError:
+            metadata = None
+        if metadata is None:
+            metadata = hash_file(file_path, root_dir)
+            if metadata is not None:
+                self.put(file_path, metadata)
+        return metadata
+
+
+class HashPool:
+    """
+    Long-lived pool of hashing workers.
+
+    Small files are hashed in threads, hashlib releases the GIL while hashing. Files of at least
+    `large_file_threshold` bytes are hashed in processes, so computing their rsync signatures uses all cores.
+    Both executors are started on first use and restarted after `shutdown`.
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        large_file_threshold: int = 1_000_000,
+        max_pending: Optional[int] = None,
+    ) -> None:
+        """
+        Args:
+            workers (Optional[int], optional): Number of threads and of processes. Defaults to the number of CPUs.
+            large_file_threshold (int, optional): Files of at least this size are hashed in processes.
+                Defaults to 1MB.
+            max_pending (Optional[int], optional): Maximum number of files submitted to the workers at once
+                by `hash_files`. Defaults to 4 per worker.
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.large_file_threshold = large_file_threshold
+        self.max_pending = max_pending or 4 * self.workers
+        self._threads: Optional[ThreadPoolExecutor] = None
+        self._processes: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self, file_size: int) -> Executor:
+        with self._lock:
+            if file_size < self.large_file_threshold:
+                if self._threads is None:
+                    self._threads = ThreadPoolExecutor(self.workers, thread_name_prefix="syftbox-hash")
+                return self._threads
+            if self._processes is None:
+                self._processes = ProcessPoolExecutor(self.workers)
+            return self._processes
+
+    def submit(
+        self,
+        file_path: Path,
+        root_dir: Optional[Path] = None,
+        stat: Optional[os.stat_result] = None,
+    ) -> Future:
+        """Hash a single file, the future resolves to the result of `hash_file`."""
+        try:
+            file_size = (stat or file_path.stat()).st_size
+        except OSError:
+            file_size = 0
+        return self._get_executor(file_size).submit(hash_file, file_path, root_dir)
+
+    def hash_files(
+        self,
+        files: Iterable[tuple[Path, Optional[os.stat_result]]],
+        root_dir: Optional[Path] = None,
+    ) -> Iterator[tuple[Path, Optional[FileMetadata]]]:
+        """
+        Hash (file_path, stat) pairs, yields (file_path, metadata) in the order of `files`.
+        At most `max_pending` files are in flight, the rest are submitted as results are consumed.
+        """
+        pending: deque[tuple[Path, Future]] = deque()
+        for file_path, stat in files:
+            if len(pending) >= self.max_pending:
+                done_path, future = pending.popleft()
+                yield done_path, future.result()
+            pending.append((file_path, self.submit(file_path, root_dir, stat)))
+        while pending:
+            done_path, future = pending.popleft()
+            yield done_path, future.result()
+
+    def shutdown(self) -> None:
+        with self._lock:
+            threads, processes = self._threads, self._processes
+            self._threads = self._processes = None
+        for executor in (threads, processes):
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+
+
+def hash_files_parallel(
+    files: list[Path],
+    root_dir: Path,
+    executor: Optional[Executor] = None,
+    chunksize: int = 16,
+) -> list[FileMetadata]:
+    """Hash files in a process pool. Pass an executor to reuse a pool over multiple calls."""
+    if executor is None:
+        with ProcessPoolExecutor() as executor:
+            return hash_files_parallel(files, root_dir, executor, chunksize)
+    results = executor.map(partial(hash_file, root_dir=root_dir), files, chunksize=chunksize)
     return [r for r in results if r is not None]
 
 
-def hash_files(files: list[Path], root_dir: Path) -> list[FileMetadata]:
-    result = [hash_file(file, root_dir) for file in files]
+def hash_files(files: list[Path], root_dir: Path, cache: Optional[HashCache] = None) -> list[FileMetadata]:
+    if cache is None:
+        result = [hash_file(file, root_dir) for file in files]
+    else:
+        result = [cache.hash_file(file, root_dir) for file in files]
     return [r for r in result if r is not None]
 
 
@@ -57,50 +233,106 @@ def hash_dir(
     dir: Path,
     root_dir: Path,
     filter_ignored: bool = True,
+    cache: Optional[HashCache] = None,
 ) -> list[FileMetadata]:
     """
     hash all files in dir recursively, return a list of FileMetadata.
 
     ignore_folders should be relative to root_dir.
     returned Paths are relative to root_dir.
+    files that did not change since they were added to `cache` are not hashed again.
     """
-    files = collect_files(dir)
+    ignore_rules = get_ignore_matcher(root_dir).rules if filter_ignored else None
+    entries = {
+        Path(entry.path).relative_to(root_dir): entry
+        for entry in walk_files(dir, ignore_rules=ignore_rules, root_dir=root_dir)
+    }
 
-    relative_paths = [file.relative_to(root_dir) for file in files]
+    relative_paths = list(entries)
     if filter_ignored:
         relative_paths = filter_ignored_paths(root_dir, relative_paths)
 
-    absolute_paths = [root_dir / file for file in relative_paths]
-    return hash_files(absolute_paths, root_dir)
+    if cache is None:
+        return hash_files([root_dir / file for file in relative_paths], root_dir)
 
+    result = []
+    for file in relative_paths:
+        try:
+            stat = entries[file].stat()
+        except OSError:
+            continue
+        metadata = cache.hash_file(root_dir / file, root_dir, stat=stat)
+        if metadata is not None:
+            result.append(metadata)
+    return result
 
-def collect_files(
+
+def walk_files(
     dir: Union[Path, str],
     include_hidden: bool = False,
     follow_symlinks: bool = False,
-) -> list[Path]:
-    """Collect files recursively, excluding files in hidden/symlinked directories unless specified."""
+    ignore_rules: Optional[pathspec.PathSpec] = None,
+    root_dir: Optional[Path] = None,
+    pruned_dirs: Optional[list[Path]] = None,
+) -> Iterator[os.DirEntry]:
+    """
+    Walk all files under `dir`, skipping hidden and symlinked entries unless specified.
+
+    Skipped and ignored directories are pruned, so their contents are never listed. Yields `os.DirEntry` objects,
+    which carry the file type from the directory listing and cache their `stat()`.
+
+    Args:
+        dir (Union[Path, str]): Directory to walk.
+        include_hidden (bool, optional): Include hidden files and directories. Defaults to False.
+        follow_symlinks (bool, optional): Include symlinked files and directories. Defaults to False.
+        ignore_rules (Optional[pathspec.PathSpec], optional): Directories matching these rules are pruned,
+            matched on their path relative to `root_dir`. Defaults to None.
+        root_dir (Optional[Path], optional): Root of the paths matched by `ignore_rules`. Defaults to `dir`.
+        pruned_dirs (Optional[list[Path]], optional): If provided, directories pruned by `ignore_rules` are appended
+            to it, relative to `root_dir`. Defaults to None.
+    """
     dir = Path(dir)
     if not dir.is_dir():
-        return []
+        return
+    root_dir = dir if root_dir is None else Path(root_dir)
 
-    files: list[Path] = []
-    for entry in dir.iterdir():
+    def _walk(path: str) -> Iterator[os.DirEntry]:
         try:
-            # Skip hidden entries
-            if not include_hidden and entry.name.startswith("."):
-                continue
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:
+            return
+
+        for entry in entries:
+            try:
+                # Skip hidden entries
+                if not include_hidden and entry.name.startswith("."):
+                    continue
 
-            # Skip symlinked entries
-            if not follow_symlinks and entry.is_symlink():
+                # Skip symlinked entries
+                if not follow_symlinks and entry.is_symlink():
+                    continue
+
+                if entry.is_file():
+                    yield entry
+                elif entry.is_dir():
+                    if ignore_rules is not None:
+                        relative_dir = Path(entry.path).relative_to(root_dir)
+                        if ignore_rules.match_file(relative_dir.as_posix() + "/"):
+                            if pruned_dirs is not None:
+                                pruned_dirs.append(relative_dir)
+                            continue
+                    yield from _walk(entry.path)
+            except OSError:
                 continue
 
-            if entry.is_file():
-                files.append(entry)
-            elif entry.is_dir():
-                files.extend(collect_files(entry, include_hidden, follow_symlinks))
+    yield from _walk(str(dir))
 
-        except OSError:
-            continue
 
-    return files
+def collect_files(
+    dir: Union[Path, str],
+    include_hidden: bool = False,
+    follow_symlinks: bool = False,
+) -> list[Path]:
+    """Collect files recursively, excluding files in hidden/symlinked directories unless specified."""
+    return [Path(entry.path) for entry in walk_files(dir, include_hidden, follow_symlinks)]
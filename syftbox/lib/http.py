@@ -9,6 +9,12 @@ HEADER_OS_NAME = b"x-os-name"
 HEADER_OS_VERSION = b"x-os-ver"
 HEADER_OS_ARCH = b"x-os-arch"
 
+# newline-delimited JSON, used for streaming responses
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# keyset pagination cursor for the next page of a listing, absent on the last page
+HEADER_SYFTBOX_NEXT_CURSOR = "x-syftbox-next-cursor"
+
 SYFTBOX_HEADERS = {
     "User-Agent": f"SyftBox/{__version__} (Python {PYTHON_VERSION}; {OS_NAME} {OS_VERSION}; {OS_ARCH})",
     HEADER_SYFTBOX_VERSION: __version__,
@@ -1,3 +1,5 @@
+import threading
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Optional
 
@@ -112,6 +114,108 @@ def filter_rejected_files(relative_paths: list[Path]) -> list[Path]:
     return result
 
 
+@dataclass
+class PathClassification:
+    """Relative paths grouped by the first ignore rule they match, in order: hidden, symlink, rejected, ignored."""
+
+    included: list[Path] = field(default_factory=list)
+    hidden: list[Path] = field(default_factory=list)
+    symlinks: list[Path] = field(default_factory=list)
+    rejected: list[Path] = field(default_factory=list)
+    ignored: list[Path] = field(default_factory=list)
+
+
+class IgnoreMatcher:
+    """
+    Ignore rules of a datasites dir.
+
+    The _.syftignore file is only read and compiled again when its mtime or size changes, and symlink checks of
+    parent directories are shared by all paths in a `classify` call.
+    """
+
+    def __init__(self, datasites_dir: Path) -> None:
+        self.datasites_dir = to_path(datasites_dir)
+        self._rules: Optional[pathspec.PathSpec] = None
+        self._rules_key: Optional[tuple[int, int]] = None
+        self._lock = threading.Lock()
+
+    @property
+    def ignore_file(self) -> Path:
+        return self.datasites_dir / IGNORE_FILENAME
+
+    @property
+    def rules(self) -> Optional[pathspec.PathSpec]:
+        """Compiled rules of the _.syftignore file, None if the file does not exist."""
+        try:
+            stat = self.ignore_file.stat()
+            key = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            key = None
+
+        with self._lock:
+            if key != self._rules_key:
+                self._rules = get_ignore_rules(self.datasites_dir) if key is not None else None
+                self._rules_key = key
+            return self._rules
+
+    def _is_symlinked_dir(self, directory: Path, memo: dict[Path, bool]) -> bool:
+        """True if `directory` or any of its parents up to the datasites dir is a symlink."""
+        if directory == self.datasites_dir or directory.parent == directory:
+            return False
+        if directory not in memo:
+            memo[directory] = directory.is_symlink() or self._is_symlinked_dir(directory.parent, memo)
+        return memo[directory]
+
+    def classify(
+        self,
+        relative_paths: list[Path],
+        hidden: bool = True,
+        symlinks: bool = True,
+        rejected: bool = True,
+    ) -> PathClassification:
+        """
+        Classify paths relative to the datasites dir in a single pass.
+
+        Args:
+            relative_paths (list[Path]): Paths to classify, relative to the datasites dir.
+            hidden (bool, optional): Check for hidden files and directories. Defaults to True.
+            symlinks (bool, optional): Check for symlinks and symlinked directories. Defaults to True.
+            rejected (bool, optional): Check for rejected files. Defaults to True.
+
+        Returns:
+            PathClassification: The paths, grouped by the first check they match.
+        """
+        rules = self.rules
+        symlink_memo: dict[Path, bool] = {}
+        result = PathClassification()
+        for path in relative_paths:
+            abs_path = self.datasites_dir / path
+            if hidden and any(part.startswith(".") for part in path.parts):
+                result.hidden.append(path)
+            elif symlinks and (abs_path.is_symlink() or self._is_symlinked_dir(abs_path.parent, symlink_memo)):
+                result.symlinks.append(path)
+            elif rejected and _is_rejected_file(path):
+                result.rejected.append(path)
+            elif rules is not None and rules.match_file(path):
+                result.ignored.append(path)
+            else:
+                result.included.append(path)
+        return result
+
+
+_matchers: dict[Path, IgnoreMatcher] = {}
+_matchers_lock = threading.Lock()
+
+
+def get_ignore_matcher(datasites_dir: PathLike) -> IgnoreMatcher:
+    """Get the shared matcher of a datasites dir."""
+    datasites_dir = to_path(datasites_dir)
+    with _matchers_lock:
+        if datasites_dir not in _matchers:
+            _matchers[datasites_dir] = IgnoreMatcher(datasites_dir)
+        return _matchers[datasites_dir]
+
+
 def filter_ignored_paths(
     datasites_dir: Path,
     relative_paths: list[Path],
@@ -134,26 +238,16 @@ def filter_ignored_paths(
     Returns:
         list[Path]: List of filtered relative paths.
     """
-
-    if ignore_hidden_files:
-        relative_paths = filter_hidden_files(relative_paths)
-
-    if ignore_symlinks:
-        relative_paths = filter_symlinks(datasites_dir, relative_paths)
-
-    if ignore_rejected_files:
-        relative_paths = filter_rejected_files(relative_paths)
-
-    ignore_rules = get_ignore_rules(datasites_dir)
-    if ignore_rules is None:
-        return relative_paths
-
-    filtered_paths = []
-    for path in relative_paths:
-        if not ignore_rules.match_file(path):
-            filtered_paths.append(path)
-
-    return filtered_paths
+    return (
+        get_ignore_matcher(datasites_dir)
+        .classify(
+            relative_paths,
+            hidden=ignore_hidden_files,
+            symlinks=ignore_symlinks,
+            rejected=ignore_rejected_files,
+        )
+        .included
+    )
 
 
 def get_syftignore_matches(
@@ -165,19 +259,10 @@ def get_syftignore_matches(
     Get the paths that match the ignore rules in the _.syftignore file.
     If include_symlinks is False, symlinks are ignored.
     """
-
-    ignore_rules = get_ignore_rules(datasites_dir)
-    if ignore_rules is None:
+    matcher = get_ignore_matcher(datasites_dir)
+    if matcher.rules is None:
         return []
 
-    filtered_paths = []
-    for path in relative_paths:
-        abs_path = datasites_dir / path
-        if not include_symlinks and is_symlinked_file(abs_path, datasites_dir):
-            continue
-        elif ignore_rules.match_file(path):
-            filtered_paths.append(path)
-        elif _is_rejected_file(path):
-            filtered_paths.append(path)
-
-    return filtered_paths
+    result = matcher.classify(relative_paths, hidden=False, symlinks=not include_symlinks)
+    matches = set(result.ignored) | set(result.rejected)
+    return [path for path in relative_paths if path in matches]
@@ -0,0 +1,96 @@
+"""
+Merkle trees over file metadata, used to compare local and remote state without listing every file.
+
+The hash of a file is its content hash, the hash of a directory is the hash of its sorted direct children.
+Two directories with the same hash contain the same files, so sync only has to descend into directories
+whose hashes differ. The server and client compute hashes the same way, from the same FileMetadata.
+"""
+
+import hashlib
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from syftbox.server.models.sync_models import FileMetadata, TreeEntry, TreeNodeResponse
+
+EMPTY_TREE_HASH = hashlib.sha256(b"").hexdigest()
+
+
+def _hash_children(children: Iterable[tuple[str, bool, str]]) -> str:
+    dir_hash = hashlib.sha256()
+    for name, is_dir, child_hash in sorted(children):
+        kind = "d" if is_dir else "f"
+        dir_hash.update(f"{kind} {child_hash} {name}\n".encode())
+    return dir_hash.hexdigest()
+
+
+def hash_entries(entries: Iterable[TreeEntry]) -> str:
+    """Rollup hash of a directory with the given direct children."""
+    return _hash_children((entry.name, entry.is_dir, entry.hash) for entry in entries)
+
+
+class MerkleTree:
+    def __init__(self, root: Path, files: Iterable[FileMetadata]) -> None:
+        """Merkle tree of all files under `root`. Files outside of `root` are skipped.
+
+        Args:
+            root (Path): Root directory of the tree, relative to the datasites dir. Path(".") for all datasites.
+            files (Iterable[FileMetadata]): Files to include, paths relative to the datasites dir.
+        """
+        self.root = root
+        self.files: dict[Path, FileMetadata] = {}
+        # directory -> child name -> child path
+        self._children: dict[Path, dict[str, Path]] = {root: {}}
+        self._hashes: dict[Path, str] = {}
+
+        for file in files:
+            if root not in file.path.parents:
+                continue
+            self.files[file.path] = file
+            child = file.path
+            for parent in child.parents:
+                siblings = self._children.setdefault(parent, {})
+                is_known_parent = len(siblings) > 0
+                siblings[child.name] = child
+                if parent == root or is_known_parent:
+                    break
+                child = parent
+
+        # Deepest directories first, so children are hashed before their parents
+        for directory in sorted(self._children, key=lambda p: len(p.parts), reverse=True):
+            self._hashes[directory] = _hash_children(
+                (name, child not in self.files, self.hash(child)) for name, child in self._children[directory].items()
+            )
+
+    @property
+    def root_hash(self) -> str:
+        return self._hashes[self.root]
+
+    def is_dir(self, path: Path) -> bool:
+        return path in self._children
+
+    def hash(self, path: Path) -> str:
+        """Hash of a file or directory, directories that are not in the tree are empty."""
+        if path in self.files:
+            return self.files[path].hash
+        return self._hashes.get(path, EMPTY_TREE_HASH)
+
+    def children(self, directory: Path) -> list[TreeEntry]:
+        """Direct children of a directory, sorted by name. Empty if the directory is not in the tree."""
+        entries = []
+        for name, child in sorted(self._children.get(directory, {}).items()):
+            if child in self.files:
+                entries.append(TreeEntry(name=name, hash=self.hash(child), is_dir=False, metadata=self.files[child]))
+            else:
+                entries.append(TreeEntry(name=name, hash=self.hash(child), is_dir=True))
+        return entries
+
+    def node(self, directory: Path) -> TreeNodeResponse:
+        return TreeNodeResponse(path=directory, hash=self.hash(directory), children=self.children(directory))
+
+    def iter_files(self, directory: Path) -> Iterator[FileMetadata]:
+        """All files under a directory, recursively."""
+        for child in self._children.get(directory, {}).values():
+            if child in self.files:
+                yield self.files[child]
+            else:
+                yield from self.iter_files(child)
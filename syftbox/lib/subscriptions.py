@@ -0,0 +1,70 @@
+"""
+Selective sync subscriptions.
+
+A user subscribes to datasites, or to directories in datasites. The server only lists subscribed files, and the client
+only syncs subscribed files. A user without subscriptions is subscribed to everything, and every user is always
+subscribed to their own datasite.
+"""
+
+import hashlib
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from syftbox.server.models.sync_models import FileMetadata
+
+
+class Subscriptions:
+    def __init__(self, user: str, paths: Iterable[Path] = ()) -> None:
+        """
+        Args:
+            user (str): Email of the subscribed user.
+            paths (Iterable[Path], optional): Subscribed datasites and directories, relative to the datasites dir.
+                Defaults to (), which subscribes to everything.
+        """
+        self.user = user
+        # the own datasite is always subscribed to, and paths under another subscribed path are redundant
+        paths = {Path(path) for path in paths if Path(path).parts[0] != user}
+        self.paths = sorted(path for path in paths if not any(parent in paths for parent in path.parents))
+        self._paths = set(self.paths)
+
+    @property
+    def is_everything(self) -> bool:
+        return not self.paths
+
+    @property
+    def fingerprint(self) -> str:
+        """Changes whenever the subscribed paths change, for cache keys and ETags."""
+        if self.is_everything:
+            return "*"
+        return hashlib.sha256("\n".join(path.as_posix() for path in self.paths).encode()).hexdigest()
+
+    def includes(self, path: Path) -> bool:
+        """True if the file or directory at `path` is subscribed to."""
+        if self.is_everything or path.parts[:1] == (self.user,):
+            return True
+        return path in self._paths or any(parent in self._paths for parent in path.parents)
+
+    def includes_datasite(self, datasite: str) -> bool:
+        """True if any part of the datasite is subscribed to."""
+        if self.is_everything or datasite == self.user:
+            return True
+        return any(path.parts[0] == datasite for path in self.paths)
+
+    @property
+    def prefixes(self) -> list[Path]:
+        """Disjoint subscribed paths, including the own datasite, sorted by datasite."""
+        return sorted([Path(self.user), *self.paths])
+
+    def prefixes_in(self, datasite: str) -> list[Path]:
+        """Disjoint subscribed paths of a datasite, [Path(datasite)] if the whole datasite is subscribed to."""
+        if self.includes(Path(datasite)):
+            return [Path(datasite)]
+        return [path for path in self.paths if path.parts[0] == datasite]
+
+    def filter(self, files: Iterable[FileMetadata]) -> Iterator[FileMetadata]:
+        if self.is_everything:
+            yield from files
+            return
+        for file in files:
+            if self.includes(file.path):
+                yield file
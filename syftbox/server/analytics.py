@@ -25,6 +25,8 @@ def to_jsonable_dict(obj: dict) -> dict:
             result[key] = value.isoformat()
         elif isinstance(value, Path):
             result[key] = value.as_posix()
+        elif isinstance(value, list):
+            result[key] = [to_jsonable_dict({"item": item})["item"] for item in value]
         elif isinstance(value, (str, int, float, bool, type(None))):
             result[key] = value
         else:
@@ -77,6 +79,27 @@ def log_file_change_event(
         logger.error(f"Failed to log file change event: {e}")
 
 
+def log_file_change_events(
+    endpoint: str,
+    email: Optional[str],
+    relative_paths: list[Path],
+    file_store: FileStore,
+) -> None:
+    """
+    Log a batch of file changes as a single event, with the metadata of every file that exists.
+    """
+    try:
+        metadata = file_store.get_many_metadata(relative_paths, email, skip_permission_check=True)
+        log_analytics_event(
+            endpoint=endpoint,
+            email=email,
+            num_files=len(relative_paths),
+            file_metadata=list(metadata.values()),
+        )
+    except Exception as e:
+        logger.error(f"Failed to log file change events: {e}")
+
+
 def _parse_analytics_file(file_path: Path) -> list[dict]:
     if file_path.suffix == ".zip":
         with zipfile.ZipFile(file_path, "r") as zfile:
@@ -1,51 +1,60 @@
 import base64
 import hashlib
-import sqlite3
-import traceback
+import json
+import re
 import zipfile
 from io import BytesIO
+from pathlib import Path
+from typing import Iterator, Optional
 
-import py_fast_rsync
-from fastapi import APIRouter, Depends, HTTPException, Request, Response, UploadFile
+from fastapi import APIRouter, Depends, Form, HTTPException, Query, Request, Response, UploadFile
 from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
-from loguru import logger
 
+from syftbox.lib.chunks import CHUNK_SIZE
+from syftbox.lib.delta import apply_delta, compute_delta, map_file
+from syftbox.lib.http import HEADER_SYFTBOX_NEXT_CURSOR, NDJSON_MEDIA_TYPE
 from syftbox.lib.permissions import PermissionType
-from syftbox.server.analytics import log_file_change_event
-from syftbox.server.db.db import get_all_datasites
+from syftbox.server.analytics import log_file_change_event, log_file_change_events
 from syftbox.server.db.file_store import FileStore, SyftFile
-from syftbox.server.db.schema import get_db
-from syftbox.server.settings import ServerSettings, get_server_settings
 from syftbox.server.users.auth import get_current_user
 
 from ...models.sync_models import (
+    SHA256_PATTERN,
     ApplyDiffRequest,
     ApplyDiffResponse,
+    BatchApplyDiffRequest,
     BatchFileRequest,
+    BatchResponse,
+    BatchResult,
+    ChunkManifest,
+    ChunkRequest,
+    CommitChunksRequest,
+    CommitChunksResponse,
+    DatasiteStateResponse,
     DiffRequest,
     DiffResponse,
     FileMetadata,
     FileMetadataRequest,
     FileRequest,
     RelativePath,
+    SubscriptionList,
+    TreeNodeResponse,
 )
 
 
-def get_db_connection(request: Request):
-    conn = get_db(request.state.server_settings.file_db_path)
-    yield conn
-    conn.close()
-
-
 def get_file_store(request: Request):
     store = FileStore(
         server_settings=request.state.server_settings,
+        executor=request.state.db_executor,
     )
     yield store
 
 
 router = APIRouter(prefix="/sync", tags=["sync"])
 
+# upper bound for the page_size of paginated listings
+MAX_PAGE_SIZE = 10_000
+
 
 @router.post("/get_diff", response_model=DiffResponse)
 def get_diff(
@@ -54,46 +63,145 @@ def get_diff(
     email: str = Depends(get_current_user),
 ) -> DiffResponse:
     try:
-        file = file_store.get(req.path, email)
+        metadata = file_store.get_metadata(req.path, email)
     except ValueError:
         raise HTTPException(status_code=404, detail="file not found")
-    diff = py_fast_rsync.diff(req.signature_bytes, file.data)
+    # the snapshot file is memory mapped and diffed in windows instead of read, see `compute_delta`
+    try:
+        with map_file(file_store.server_settings.snapshot_folder / metadata.path) as data:
+            diff = compute_delta(req.signature_bytes, data)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="file not found")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"invalid signature: {e}")
     diff_bytes = base64.b85encode(diff).decode("utf-8")
     return DiffResponse(
-        path=file.metadata.path.as_posix(),
+        path=metadata.path.as_posix(),
         diff=diff_bytes,
-        hash=file.metadata.hash,
+        hash=metadata.hash,
     )
 
 
+def get_inline_max_size(
+    request: Request,
+    inline_max_size: int = Query(default=0, ge=0, description="Inline the contents of files up to this size"),
+) -> int:
+    """Size up to which listings inline file contents, limited by the `inline_content_max_size` setting."""
+    return min(inline_max_size, request.state.server_settings.inline_content_max_size)
+
+
+def stream_datasite_states(
+    datasite_states: Iterator[tuple[str, list[FileMetadata]]],
+    file_store: FileStore,
+    inline_max_size: int = 0,
+) -> Iterator[str]:
+    for datasite, files in datasite_states:
+        contents = file_store.read_inline_contents(files, inline_max_size) if inline_max_size else {}
+        yield DatasiteStateResponse(datasite=datasite, files=files, contents=contents).model_dump_json() + "\n"
+
+
 @router.post("/datasite_states", response_model=dict[str, list[FileMetadata]])
 def get_datasite_states(
-    conn: sqlite3.Connection = Depends(get_db_connection),
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    page_size: Optional[int] = Query(default=None, ge=1, le=MAX_PAGE_SIZE),
+    inline_max_size: int = Depends(get_inline_max_size),
     file_store: FileStore = Depends(get_file_store),
-    server_settings: ServerSettings = Depends(get_server_settings),
     email: str = Depends(get_current_user),
 ) -> dict[str, list[FileMetadata]]:
-    all_datasites = get_all_datasites(conn)
-    datasite_states: dict[str, list[FileMetadata]] = {}
-    for datasite in all_datasites:
-        try:
-            datasite_state = dir_state(RelativePath(datasite), file_store, server_settings, email)
-        except Exception as e:
-            logger.error(f"Failed to get dir state for {datasite}: {e} {traceback.format_exc()}")
-            continue
-        datasite_states[datasite] = datasite_state
-
-    return datasite_states
+    """
+    Returns the files the user can read, grouped by datasite. Only subscribed datasites and files are included,
+    see `/sync/subscriptions`.
+
+    If `page_size` is set, only one page is returned and the cursor for the next page is sent in the
+    `x-syftbox-next-cursor` header. Pages only contain datasites with readable files in the page, except the last
+    page, which lists every subscribed datasite. Datasites that already had files in earlier pages are listed with an
+    empty list.
+    If the request accepts NDJSON, the response is streamed as one `DatasiteStateResponse` per line, and the contents
+    of files up to `inline_max_size` bytes are included.
+
+    The ETag of the response is computed before the listing. If the first page is requested with a matching
+    `If-None-Match` header, 304 Not Modified is returned without computing the listing.
+    """
+    etag = file_store.get_datasite_states_etag(email, page_size=page_size, inline_max_size=inline_max_size)
+    if cursor is None and request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    headers = {"ETag": etag}
+    if page_size is None:
+        datasite_states = file_store.iter_datasite_states(email)
+    else:
+        page, next_cursor = file_store.datasite_states_page(email, cursor=cursor, page_size=page_size)
+        datasite_states = iter(page.items())
+        if next_cursor is not None:
+            headers[HEADER_SYFTBOX_NEXT_CURSOR] = next_cursor
+
+    if NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+        return StreamingResponse(
+            stream_datasite_states(datasite_states, file_store, inline_max_size),
+            media_type=NDJSON_MEDIA_TYPE,
+            headers=headers,
+        )
+    response.headers.update(headers)
+    return dict(datasite_states)
 
 
 @router.post("/dir_state", response_model=list[FileMetadata])
 def dir_state(
     dir: RelativePath,
+    response: Response,
+    cursor: Optional[str] = None,
+    page_size: Optional[int] = Query(default=None, ge=1, le=MAX_PAGE_SIZE),
     file_store: FileStore = Depends(get_file_store),
-    server_settings: ServerSettings = Depends(get_server_settings),
     email: str = Depends(get_current_user),
 ) -> list[FileMetadata]:
-    return file_store.list_for_user(dir, email)
+    """
+    Returns the files under `dir` the user can read and is subscribed to.
+
+    If `page_size` is set, only one page is returned and the cursor for the next page is sent in the
+    `x-syftbox-next-cursor` header.
+    """
+    if page_size is None:
+        return file_store.list_for_user(dir, email)
+
+    files, next_cursor = file_store.list_page_for_user(dir, email, cursor=cursor, page_size=page_size)
+    if next_cursor is not None:
+        response.headers[HEADER_SYFTBOX_NEXT_CURSOR] = next_cursor
+    return files
+
+
+@router.post("/tree", response_model=TreeNodeResponse)
+def get_tree_node(
+    request: Request,
+    response: Response,
+    dir: RelativePath = Path("."),
+    inline_max_size: int = Depends(get_inline_max_size),
+    file_store: FileStore = Depends(get_file_store),
+    email: str = Depends(get_current_user),
+) -> TreeNodeResponse:
+    """
+    Returns the rollup hash and direct children of `dir` in the Merkle tree over the subscribed files the user
+    can read.
+
+    Clients compare hashes with their local tree and only request the directories that differ.
+    The default `dir` returns the root, with one child per datasite. The contents of child files up to
+    `inline_max_size` bytes are included.
+
+    The root has the same ETag as `/sync/datasite_states`. If it is requested with a matching `If-None-Match` header,
+    304 Not Modified is returned without computing the tree.
+    """
+    if dir == Path("."):
+        etag = file_store.get_datasite_states_etag(email, inline_max_size=inline_max_size, resource="tree")
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
+
+    node = file_store.get_tree_node(dir, email)
+    if inline_max_size:
+        files = [child.metadata for child in node.children if child.metadata is not None]
+        node.contents = file_store.read_inline_contents(files, inline_max_size)
+    return node
 
 
 @router.post("/get_metadata", response_model=FileMetadata)
@@ -109,6 +217,23 @@ def get_metadata(
         raise HTTPException(status_code=400, detail=str(e))
 
 
+def apply_diff_to_snapshot(file_store: FileStore, metadata: FileMetadata, req: ApplyDiffRequest) -> bytes:
+    """Apply a diff to the snapshot file of `metadata`, raises an HTTPException if the result is not written."""
+    # the old file is memory mapped instead of read, the result is needed in memory to compute its signature
+    result = BytesIO()
+    try:
+        with map_file(file_store.server_settings.snapshot_folder / metadata.path) as base:
+            new_hash = apply_delta(base, req.diff_bytes, result)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="file not found")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"invalid diff: {e}")
+
+    if new_hash != req.expected_hash:
+        raise HTTPException(status_code=400, detail="hash mismatch, skipped writing")
+    return result.getvalue()
+
+
 @router.post("/apply_diff", response_model=ApplyDiffResponse)
 def apply_diffs(
     req: ApplyDiffRequest,
@@ -116,17 +241,12 @@ def apply_diffs(
     email: str = Depends(get_current_user),
 ) -> ApplyDiffResponse:
     try:
-        file = file_store.get(req.path, email)
+        metadata = file_store.get_metadata(req.path, email)
     except ValueError:
         raise HTTPException(status_code=404, detail="file not found")
 
-    result = py_fast_rsync.apply(file.data, req.diff_bytes)
-    new_hash = hashlib.sha256(result).hexdigest()
-
-    if new_hash != req.expected_hash:
-        raise HTTPException(status_code=400, detail="hash mismatch, skipped writing")
-
-    file_store.put(req.path, result, user=email, check_permission=PermissionType.WRITE)
+    contents = apply_diff_to_snapshot(file_store, metadata, req)
+    file_store.put(req.path, contents, user=email, check_permission=PermissionType.WRITE)
 
     log_file_change_event(
         "/sync/apply_diff",
@@ -135,7 +255,56 @@ def apply_diffs(
         file_store=file_store,
     )
 
-    return ApplyDiffResponse(path=req.path, current_hash=new_hash, previous_hash=file.metadata.hash)
+    return ApplyDiffResponse(path=req.path, current_hash=req.expected_hash, previous_hash=metadata.hash)
+
+
+def batch_response(errors: dict[Path, Optional[HTTPException]]) -> BatchResponse:
+    return BatchResponse(
+        results=[
+            BatchResult(path=path, status_code=200)
+            if error is None
+            else BatchResult(path=path, status_code=error.status_code, detail=error.detail)
+            for path, error in errors.items()
+        ]
+    )
+
+
+@router.post("/apply_diff_bulk", response_model=BatchResponse)
+def apply_diff_bulk(
+    req: BatchApplyDiffRequest,
+    file_store: FileStore = Depends(get_file_store),
+    email: str = Depends(get_current_user),
+) -> BatchResponse:
+    """
+    Apply diffs to multiple files in a single request, metadata is committed in one transaction per database.
+
+    Diffs are applied independently, the response has the status every file would get from `/sync/apply_diff`.
+    """
+    denied: set[Path] = set()
+    metadata = file_store.get_many_metadata([diff.path for diff in req.diffs], email, denied=denied)
+    contents: dict[Path, bytes] = {}
+    errors: dict[Path, Optional[HTTPException]] = {}
+    for diff in req.diffs:
+        try:
+            if diff.path in contents or diff.path in errors:
+                raise HTTPException(status_code=400, detail="duplicate path in request")
+            if diff.path in denied:
+                raise HTTPException(
+                    status_code=403,
+                    detail=f"User {email} does not have read permission for {diff.path}",
+                )
+            if diff.path not in metadata:
+                raise HTTPException(status_code=404, detail="file not found")
+            contents[diff.path] = apply_diff_to_snapshot(file_store, metadata[diff.path], diff)
+        except HTTPException as e:
+            errors[diff.path] = e
+            contents.pop(diff.path, None)
+
+    errors.update(file_store.put_each(contents, email, PermissionType.WRITE))
+    written = [path for path, error in errors.items() if error is None]
+    if written:
+        log_file_change_events("/sync/apply_diff_bulk", email=email, relative_paths=written, file_store=file_store)
+    return batch_response(errors)
 
 
 @router.post("/delete", response_class=JSONResponse)
@@ -155,6 +324,22 @@ def delete_file(
     return JSONResponse(content={"status": "success"})
 
 
+@router.post("/delete_bulk", response_model=BatchResponse)
+def delete_bulk(
+    req: BatchFileRequest,
+    file_store: FileStore = Depends(get_file_store),
+    email: str = Depends(get_current_user),
+) -> BatchResponse:
+    """
+    Delete multiple files in a single request, metadata is committed in one transaction per database.
+
+    Files are deleted independently, the response has the status every file would get from `/sync/delete`.
+    """
+    # metadata of deleted files is gone after the delete
+    log_file_change_events("/sync/delete_bulk", email=email, relative_paths=req.paths, file_store=file_store)
+    return batch_response(file_store.delete_each(req.paths, email))
+
+
 @router.post("/create", response_class=JSONResponse)
 def create_file(
     file: UploadFile,
@@ -186,6 +371,112 @@ def create_file(
     return JSONResponse(content={"status": "success"})
 
 
+@router.post("/upload_bulk", response_model=BatchResponse)
+def upload_bulk(
+    files: list[UploadFile],
+    hashes: str = Form(description="JSON object with the sha256 of every file, by path"),
+    file_store: FileStore = Depends(get_file_store),
+    email: str = Depends(get_current_user),
+) -> BatchResponse:
+    """
+    Create multiple new files in a single request, the filename of every file is its path.
+
+    Files are created independently, the response has the status every file would get from `/sync/create`.
+    """
+    try:
+        expected_hashes = {Path(path): file_hash for path, file_hash in json.loads(hashes).items()}
+    except (ValueError, AttributeError):
+        raise HTTPException(status_code=400, detail="hashes must be a JSON object of path to sha256")
+
+    contents: dict[Path, bytes] = {}
+    errors: dict[Path, Optional[HTTPException]] = {}
+    for file in files:
+        path = Path(file.filename or "")
+        if "%" in path.as_posix():
+            errors[path] = HTTPException(status_code=400, detail="filename cannot contain '%'")
+        elif path.is_absolute() or ".." in path.parts or not path.parts:
+            errors[path] = HTTPException(status_code=400, detail="path must be relative")
+        elif path in contents or path in errors:
+            errors[path] = HTTPException(status_code=400, detail="duplicate path in request")
+        else:
+            data = file.file.read()
+            if hashlib.sha256(data).hexdigest() == expected_hashes.get(path):
+                contents[path] = data
+            else:
+                errors[path] = HTTPException(status_code=400, detail="hash mismatch, skipped writing")
+    for path in errors:
+        contents.pop(path, None)
+
+    errors.update(file_store.put_each(contents, email, PermissionType.CREATE, create_only=True))
+    written = [path for path, error in errors.items() if error is None]
+    if written:
+        log_file_change_events("/sync/upload_bulk", email=email, relative_paths=written, file_store=file_store)
+    return batch_response(errors)
+
+
+@router.post("/chunks/manifest", response_model=ChunkManifest)
+def get_chunk_manifest(
+    req: FileMetadataRequest,
+    file_store: FileStore = Depends(get_file_store),
+    email: str = Depends(get_current_user),
+) -> ChunkManifest:
+    """Chunk hashes of a large file, see `syftbox.lib.chunks`."""
+    try:
+        return file_store.get_chunk_manifest(req.path, email)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="file not found")
+
+
+@router.post("/chunks/download")
+def download_chunk(
+    req: ChunkRequest,
+    file_store: FileStore = Depends(get_file_store),
+    email: str = Depends(get_current_user),
+) -> Response:
+    try:
+        content = file_store.read_chunk(req.path, email, req.hash, req.index)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return Response(content=content, media_type="application/octet-stream")
+
+
+@router.post("/chunks/upload", response_class=JSONResponse)
+def upload_chunk(
+    file: UploadFile,
+    file_store: FileStore = Depends(get_file_store),
+    email: str = Depends(get_current_user),
+) -> JSONResponse:
+    """Stage a chunk for `/chunks/commit`, the filename is the sha256 of the chunk."""
+    chunk_hash = file.filename or ""
+    if not re.fullmatch(SHA256_PATTERN, chunk_hash):
+        raise HTTPException(status_code=400, detail="filename must be the sha256 of the chunk")
+    file_store.stage_chunk(email, chunk_hash, file.file.read(CHUNK_SIZE + 1))
+    return JSONResponse(content={"status": "success"})
+
+
+@router.post("/chunks/commit", response_model=CommitChunksResponse)
+def commit_chunks(
+    req: CommitChunksRequest,
+    file_store: FileStore = Depends(get_file_store),
+    email: str = Depends(get_current_user),
+) -> CommitChunksResponse:
+    """
+    Write a file from its chunks. Chunks must either be staged with `/chunks/upload`, or be part of the current
+    version of the file. If chunks are missing nothing is written, and the response lists the missing chunks.
+    """
+    if "%" in req.path.as_posix():
+        raise HTTPException(status_code=400, detail="filename cannot contain '%'")
+    result = file_store.put_chunks(req.path, req.chunks, req.expected_hash, email)
+    if result.current_hash is not None:
+        log_file_change_event(
+            "/sync/chunks/commit",
+            email=email,
+            relative_path=req.path,
+            file_store=file_store,
+        )
+    return result
+
+
 @router.post("/download", response_class=FileResponse)
 def download_file(
     req: FileRequest,
@@ -201,10 +492,35 @@ def download_file(
 
 @router.post("/datasites", response_model=list[str])
 def get_datasites(
-    conn: sqlite3.Connection = Depends(get_db_connection),
+    file_store: FileStore = Depends(get_file_store),
     email: str = Depends(get_current_user),
 ) -> list[str]:
-    return get_all_datasites(conn)
+    return file_store.list_datasites()
+
+
+@router.post("/subscriptions", response_model=SubscriptionList)
+def get_subscriptions(
+    file_store: FileStore = Depends(get_file_store),
+    email: str = Depends(get_current_user),
+) -> SubscriptionList:
+    """Returns the datasites and directories the user syncs, an empty list if the user syncs everything."""
+    return SubscriptionList(paths=file_store.get_subscriptions(email).paths)
+
+
+@router.post("/subscriptions/set", response_model=SubscriptionList)
+def set_subscriptions(
+    req: SubscriptionList,
+    file_store: FileStore = Depends(get_file_store),
+    email: str = Depends(get_current_user),
+) -> SubscriptionList:
+    """
+    Replaces the subscriptions of the user. Listings only include subscribed files from then on,
+    the own datasite of the user is always included.
+    """
+    for path in req.paths:
+        if not path.parts or ".." in path.parts:
+            raise HTTPException(status_code=400, detail=f"Invalid subscription path {path}")
+    return SubscriptionList(paths=file_store.set_subscriptions(email, req.paths).paths)
 
 
 def create_zip_from_files(files: list[SyftFile]) -> BytesIO:
@@ -216,19 +532,17 @@ def create_zip_from_files(files: list[SyftFile]) -> BytesIO:
     return memory_file
 
 
+def read_files_as_zip(file_store: FileStore, paths: list[RelativePath], email: str) -> bytes:
+    files = file_store.get_many(paths, email)
+    return create_zip_from_files(files).read()
+
+
 @router.post("/download_bulk")
 async def get_files(
     req: BatchFileRequest,
     file_store: FileStore = Depends(get_file_store),
     email: str = Depends(get_current_user),
-) -> StreamingResponse:
-    all_files = []
-    for path in req.paths:
-        try:
-            file = file_store.get(path, email)
-        except ValueError:
-            logger.warning(f"File not found: {path}")
-            continue
-        all_files.append(file)
-    zip_file = create_zip_from_files(all_files)
-    return Response(content=zip_file.read(), media_type="application/zip")
+) -> Response:
+    # reading and zipping all files is blocking, keep it off the event loop
+    content = await file_store.run_async(read_files_as_zip, file_store, req.paths, email)
+    return Response(content=content, media_type="application/zip")
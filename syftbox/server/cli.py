@@ -1,3 +1,5 @@
+from typing import Optional
+
 from loguru import logger
 from typer import Exit, Option, Typer
 
@@ -24,16 +26,22 @@ EXAMPLE_OPTS = Option(
     rich_help_panel=SERVER_PANEL,
     help="Enable verbose mode",
 )
+
+WORKERS_OPTS = Option(
+    "-w", "--workers",
+    min=1,
+    help="Number of processes used to hash files, defaults to the number of CPUs",
+)
 # fmt: on
 
 
 @app.command()
-def migrate():
+def migrate(workers: Optional[int] = WORKERS_OPTS):
     """Run database migrations"""
 
     try:
         settings = ServerSettings()
-        run_migrations(settings)
+        run_migrations(settings, workers=workers)
         logger.info("Migrations completed successfully")
     except Exception as e:
         logger.error("Migrations failed")
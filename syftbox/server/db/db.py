@@ -1,33 +1,53 @@
 import sqlite3
 from pathlib import Path
-from typing import List, Optional
+from typing import Iterable, Iterator, List, Optional
 
 from syftbox.lib.permissions import PermissionRule, SyftPermission
-from syftbox.server.models.sync_models import FileMetadata, RelativePath
+from syftbox.server.models.sync_models import ChunkInfo, FileMetadata, RelativePath, datetime_to_ns
+
+UPSERT_FILE_METADATA = """
+INSERT INTO file_metadata (path, datasite, hash, signature, file_size, last_modified)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT(path) DO UPDATE SET
+    datasite = excluded.datasite,
+    hash = excluded.hash,
+    signature = excluded.signature,
+    file_size = excluded.file_size,
+    last_modified = excluded.last_modified
+"""
+
+
+def _file_metadata_params(metadata: FileMetadata) -> tuple:
+    return (
+        str(metadata.path),
+        metadata.datasite,
+        bytes.fromhex(metadata.hash),
+        metadata.signature,
+        metadata.file_size,
+        datetime_to_ns(metadata.last_modified),
+    )
 
 
 def save_file_metadata(conn: sqlite3.Connection, metadata: FileMetadata):
     # Insert the metadata into the database or update if a conflict on 'path' occurs
-    conn.execute(
-        """
-    INSERT INTO file_metadata (path, datasite, hash, signature, file_size, last_modified)
-    VALUES (?, ?, ?, ?, ?, ?)
-    ON CONFLICT(path) DO UPDATE SET
-        datasite = excluded.datasite,
-        hash = excluded.hash,
-        signature = excluded.signature,
-        file_size = excluded.file_size,
-        last_modified = excluded.last_modified
-    """,
-        (
-            str(metadata.path),
-            metadata.datasite,
-            metadata.hash,
-            metadata.signature,
-            metadata.file_size,
-            metadata.last_modified.isoformat(),
-        ),
-    )
+    conn.execute(UPSERT_FILE_METADATA, _file_metadata_params(metadata))
+
+
+def save_many_file_metadata(conn: sqlite3.Connection, metadata: Iterable[FileMetadata]):
+    conn.executemany(UPSERT_FILE_METADATA, (_file_metadata_params(m) for m in metadata))
+
+
+def get_file_stats(conn: sqlite3.Connection, path_like: Optional[str] = None) -> dict[str, tuple[int, int]]:
+    """Map of path to (file_size, last_modified in ns) for all files, without loading full metadata."""
+    query = "SELECT path, file_size, last_modified FROM file_metadata"
+    params = ()
+
+    if path_like:
+        query += " WHERE path >= ? AND path < ?"
+        params = prefix_range(path_like)
+
+    cursor = conn.execute(query, params)
+    return {row["path"]: (row["file_size"], row["last_modified"]) for row in cursor}
 
 
 def delete_file_metadata(conn: sqlite3.Connection, path: str):
@@ -37,17 +57,75 @@ def delete_file_metadata(conn: sqlite3.Connection, path: str):
         raise ValueError(f"Failed to delete metadata for {path}.")
 
 
+def get_file_chunks(conn: sqlite3.Connection, path: str, file_hash: str) -> Optional[list[ChunkInfo]]:
+    """Chunks of the file at `path` with hash `file_hash`, None if they are not stored."""
+    cursor = conn.execute(
+        "SELECT offset, size, hash FROM file_chunks WHERE path = ? AND file_hash = ? ORDER BY idx",
+        (path, bytes.fromhex(file_hash)),
+    )
+    chunks = [ChunkInfo(offset=row["offset"], size=row["size"], hash=row["hash"].hex()) for row in cursor]
+    return chunks or None
+
+
+def save_file_chunks(conn: sqlite3.Connection, path: str, file_hash: str, chunks: list[ChunkInfo]) -> None:
+    delete_file_chunks(conn, path)
+    conn.executemany(
+        "INSERT INTO file_chunks (path, file_hash, idx, offset, size, hash) VALUES (?, ?, ?, ?, ?, ?)",
+        (
+            (path, bytes.fromhex(file_hash), idx, chunk.offset, chunk.size, bytes.fromhex(chunk.hash))
+            for idx, chunk in enumerate(chunks)
+        ),
+    )
+
+
+def find_chunks(conn: sqlite3.Connection, hashes: Iterable[str]) -> dict[str, tuple[Path, ChunkInfo]]:
+    """
+    Find chunks by hash in any file, returns the path and location of one current file per chunk.
+    Chunks of older versions of files are skipped.
+    """
+    hashes = list(hashes)
+    found = {}
+    # stay below the default SQLITE_MAX_VARIABLE_NUMBER of older SQLite versions
+    for i in range(0, len(hashes), 500):
+        batch = hashes[i : i + 500]
+        cursor = conn.execute(
+            f"""
+            SELECT c.path, c.offset, c.size, c.hash FROM file_chunks c
+            JOIN file_metadata f ON f.path = c.path AND f.hash = c.file_hash
+            WHERE c.hash IN ({", ".join("?" for _ in batch)})
+            """,
+            [bytes.fromhex(h) for h in batch],
+        )
+        for row in cursor:
+            chunk = ChunkInfo(offset=row["offset"], size=row["size"], hash=row["hash"].hex())
+            found.setdefault(chunk.hash, (Path(row["path"]), chunk))
+    return found
+
+
+def delete_file_chunks(conn: sqlite3.Connection, path: str) -> None:
+    conn.execute("DELETE FROM file_chunks WHERE path = ?", (path,))
+
+
+def prefix_range(prefix: str) -> tuple[str, str]:
+    """
+    Returns the half-open range [lower, upper) containing every string that starts with `prefix`.
+
+    `path >= lower AND path < upper` is equivalent to `path LIKE 'prefix%'`, but unlike LIKE
+    it can be answered with a range scan on the unique index on `path`.
+    """
+    if not prefix:
+        raise ValueError("prefix cannot be empty")
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return prefix, upper
+
+
 def get_all_metadata(conn: sqlite3.Connection, path_like: Optional[str] = None) -> list[FileMetadata]:
     query = "SELECT * FROM file_metadata"
     params = ()
 
     if path_like:
-        if "%" in path_like:
-            raise ValueError("we don't support % in paths")
-        path_like = path_like + "%"
-        escaped_path = path_like.replace("_", "\\_")
-        query += " WHERE path LIKE ? ESCAPE '\\' "
-        params = (escaped_path,)
+        query += " WHERE path >= ? AND path < ?"
+        params = prefix_range(path_like)
 
     cursor = conn.execute(query, params)
     # would be nice to paginate
@@ -64,13 +142,52 @@ def get_one_metadata(conn: sqlite3.Connection, path: str) -> FileMetadata:
 
 
 def get_all_datasites(conn: sqlite3.Connection) -> list[str]:
-    # INSTR(path, '/'): Finds the position of the first slash in the path.
+    # Skip-scan over idx_file_metadata_datasite: every step seeks to the next distinct datasite,
+    # so this costs one index lookup per datasite instead of reading every row.
     cursor = conn.execute(
-        """SELECT DISTINCT SUBSTR(path, 1, INSTR(path, '/') - 1) AS root_folder
-        FROM file_metadata;
         """
+        WITH RECURSIVE datasites(name) AS (
+            SELECT MIN(datasite) FROM file_metadata
+            UNION ALL
+            SELECT (SELECT MIN(datasite) FROM file_metadata WHERE datasite > name)
+            FROM datasites WHERE name IS NOT NULL
+        )
+        SELECT name FROM datasites WHERE name IS NOT NULL
+        """
+    )
+    return [row[0] for row in cursor]
+
+
+def get_catalog_datasites(conn: sqlite3.Connection) -> list[str]:
+    cursor = conn.execute("SELECT datasite FROM datasites ORDER BY datasite")
+    return [row["datasite"] for row in cursor]
+
+
+def add_catalog_datasite(conn: sqlite3.Connection, datasite: str) -> None:
+    conn.execute("INSERT OR IGNORE INTO datasites (datasite) VALUES (?)", (datasite,))
+
+
+def get_datasite_version(conn: sqlite3.Connection, datasite: str) -> Optional[int]:
+    row = conn.execute("SELECT version FROM datasite_versions WHERE datasite = ?", (datasite,)).fetchone()
+    return row["version"] if row is not None else None
+
+
+def get_datasite_versions(conn: sqlite3.Connection) -> list[tuple[str, int]]:
+    cursor = conn.execute("SELECT datasite, version FROM datasite_versions ORDER BY datasite")
+    return [(row["datasite"], row["version"]) for row in cursor]
+
+
+def get_subscriptions(conn: sqlite3.Connection, user: str) -> list[Path]:
+    cursor = conn.execute("SELECT path FROM subscriptions WHERE user = ? ORDER BY path", (user,))
+    return [Path(row["path"]) for row in cursor]
+
+
+def set_subscriptions(conn: sqlite3.Connection, user: str, paths: Iterable[Path]) -> None:
+    conn.execute("DELETE FROM subscriptions WHERE user = ?", (user,))
+    conn.executemany(
+        "INSERT OR IGNORE INTO subscriptions (user, path) VALUES (?, ?)",
+        [(user, path.as_posix()) for path in paths],
     )
-    return [row[0] for row in cursor if row[0]]
 
 
 def query_rules_for_permfile(cursor, file: SyftPermission):
@@ -100,9 +217,9 @@ def get_all_files(cursor):
 def get_all_files_under_syftperm(cursor, permfile: SyftPermission) -> List[Path]:
     cursor.execute(
         """
-        SELECT * FROM file_metadata WHERE path LIKE ?
+        SELECT * FROM file_metadata WHERE path >= ? AND path < ?
     """,
-        (str(permfile.dir_path) + "/%",),
+        prefix_range(str(permfile.dir_path) + "/"),
     )
     return [
         (
@@ -241,16 +358,31 @@ def get_read_permissions_for_user(
     These bits are combined with a final OR operation.
     """
     cursor = connection.cursor()
+    query, params = _read_permissions_query(user, path_like)
+    res = cursor.execute(query, params)
+
+    return res.fetchall()
 
+
+def _read_permissions_query(
+    user: str,
+    path_like: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: Optional[int] = None,
+) -> tuple[str, tuple]:
     params = (user, user, user)
-    like_clause = ""
+    conditions = []
     if path_like:
-        if "%" in path_like:
-            raise ValueError("we don't support % in paths")
-        path_like = path_like + "%"
-        escaped_path = path_like.replace("_", "\\_")
-        like_clause += " WHERE path LIKE ? ESCAPE '\\' "
-        params = (user, user, user, escaped_path)
+        conditions.append("path >= ? AND path < ?")
+        params += prefix_range(path_like)
+    if after is not None:
+        conditions.append("path > ?")
+        params += (after,)
+    where_clause = " WHERE " + " AND ".join(conditions) if conditions else ""
+    limit_clause = ""
+    if limit is not None:
+        limit_clause = "LIMIT ?"
+        params += (limit,)
 
     query = """
     SELECT path, hash, signature, file_size, last_modified,
@@ -292,10 +424,10 @@ def get_read_permissions_for_user(
     ) OR datasite = ? AS read_permission
     FROM file_metadata f
     {}
-    """.format(like_clause)
-    res = cursor.execute(query, params)
-
-    return res.fetchall()
+    ORDER BY path
+    {}
+    """.format(where_clause, limit_clause)
+    return query, params
 
 
 def print_table(connection: sqlite3.Connection, table: str):
@@ -312,6 +444,43 @@ def print_table(connection: sqlite3.Connection, table: str):
 def get_filemetadata_with_read_access(
     connection: sqlite3.Connection, user: str, path: Optional[RelativePath] = None
 ) -> list[FileMetadata]:
-    rows = get_read_permissions_for_user(connection, user, str(path))
-    res = [FileMetadata.from_row(row) for row in rows if row["read_permission"]]
-    return res
+    return list(iter_filemetadata_with_read_access(connection, user, path))
+
+
+def iter_filemetadata_with_read_access(
+    connection: sqlite3.Connection, user: str, path: Optional[RelativePath] = None
+) -> Iterator[FileMetadata]:
+    """
+    Lazily yield the metadata of all files under `path` that `user` can read, ordered by path.
+
+    Ordering by path keeps all files of a datasite contiguous, so the result can be grouped
+    by datasite in a single pass.
+    """
+    path_like = str(path) if path is not None else None
+    query, params = _read_permissions_query(user, path_like)
+    for row in connection.execute(query, params):
+        if row["read_permission"]:
+            yield FileMetadata.from_row(row)
+
+
+def get_filemetadata_page_with_read_access(
+    connection: sqlite3.Connection,
+    user: str,
+    path: Optional[RelativePath] = None,
+    cursor: Optional[str] = None,
+    page_size: int = 1000,
+) -> tuple[list[FileMetadata], Optional[str]]:
+    """
+    Keyset pagination over the files under `path` that `user` can read, ordered by path.
+
+    A page examines at most `page_size` files after `cursor`, so it can contain fewer (or zero)
+    readable files while more pages remain. The returned cursor is the last examined path,
+    or None if there are no more pages.
+    """
+    path_like = str(path) if path is not None else None
+    query, params = _read_permissions_query(user, path_like, after=cursor, limit=page_size)
+    rows = connection.execute(query, params).fetchall()
+
+    next_cursor = rows[-1]["path"] if len(rows) == page_size else None
+    page = [FileMetadata.from_row(row) for row in rows if row["read_permission"]]
+    return page, next_cursor
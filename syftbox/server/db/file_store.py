@@ -1,19 +1,36 @@
+import asyncio
+import base64
+import contextlib
+import functools
+import hashlib
+import itertools
+import os
 import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Executor
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import List, Optional
+from typing import Callable, Iterable, Iterator, List, Optional, TypeVar
 
 import yaml
 from fastapi import HTTPException
+from loguru import logger
 from pydantic import BaseModel
 
+from syftbox.lib.chunks import CHUNK_SIZE, CHUNKED_FILE_THRESHOLD, chunk_file, read_chunk
 from syftbox.lib.constants import PERM_FILE
-from syftbox.lib.hash import hash_file
+from syftbox.lib.hash import hash_data
+from syftbox.lib.merkle import MerkleTree, hash_entries
 from syftbox.lib.permissions import (
     ComputedPermission,
     PermissionRule,
     PermissionType,
     SyftPermission,
 )
+from syftbox.lib.subscriptions import Subscriptions
 from syftbox.server.db import db
 from syftbox.server.db.db import (
     get_rules_for_path,
@@ -21,9 +38,24 @@ from syftbox.server.db.db import (
     set_rules_for_permfile,
 )
 from syftbox.server.db.schema import get_db
-from syftbox.server.models.sync_models import AbsolutePath, FileMetadata, RelativePath
+from syftbox.server.db.writer import get_writer
+from syftbox.server.models.sync_models import (
+    AbsolutePath,
+    ChunkInfo,
+    ChunkManifest,
+    CommitChunksResponse,
+    FileMetadata,
+    RelativePath,
+    TreeEntry,
+    TreeNodeResponse,
+)
 from syftbox.server.settings import ServerSettings
 
+T = TypeVar("T")
+
+# upper bound for the inlined contents of a single listing response, or of a datasite in /sync/datasite_states
+MAX_INLINE_CONTENTS_SIZE = 1024 * 1024
+
 
 class SyftFile(BaseModel):
     metadata: FileMetadata
@@ -31,21 +63,215 @@ class SyftFile(BaseModel):
     absolute_path: AbsolutePath
 
 
+class MerkleTreeCache:
+    """
+    LRU cache of the Merkle trees of datasites, as seen by a user.
+
+    Trees are keyed on the datasite version, which changes on every file or permission change in the datasite,
+    so a cached tree is never stale and only the datasites that changed since the last request are rebuilt.
+
+    The cache is bounded by the total number of files in all cached trees, trees with more than `max_files` files
+    are not cached. Root hashes are cached separately and cost a few bytes each, so polling the root of the tree
+    does not rebuild unchanged datasites even when their trees were evicted.
+    """
+
+    def __init__(self, max_files: int = 1_000_000, max_root_hashes: int = 100_000) -> None:
+        self.max_files = max_files
+        self.max_root_hashes = max_root_hashes
+        self._trees: OrderedDict[tuple, MerkleTree] = OrderedDict()
+        self._num_files = 0
+        self._root_hashes: OrderedDict[tuple, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[MerkleTree]:
+        with self._lock:
+            tree = self._trees.get(key)
+            if tree is not None:
+                self._trees.move_to_end(key)
+            return tree
+
+    def get_root_hash(self, key: tuple) -> Optional[str]:
+        with self._lock:
+            root_hash = self._root_hashes.get(key)
+            if root_hash is not None:
+                self._root_hashes.move_to_end(key)
+            return root_hash
+
+    def put(self, key: tuple, tree: MerkleTree) -> None:
+        with self._lock:
+            self._root_hashes[key] = tree.root_hash
+            self._root_hashes.move_to_end(key)
+            while len(self._root_hashes) > self.max_root_hashes:
+                self._root_hashes.popitem(last=False)
+
+            if len(tree.files) > self.max_files:
+                return
+            previous = self._trees.pop(key, None)
+            if previous is not None:
+                self._num_files -= len(previous.files)
+            self._trees[key] = tree
+            self._num_files += len(tree.files)
+            while self._num_files > self.max_files:
+                _, evicted = self._trees.popitem(last=False)
+                self._num_files -= len(evicted.files)
+
+
+# FileStore is created per request, trees are shared between requests
+merkle_tree_cache = MerkleTreeCache()
+
+
+# puts and deletes of the same path are serialized, so the snapshot matches the last committed metadata
+_path_locks = [threading.Lock() for _ in range(256)]
+
+
+def path_lock(path: Path) -> threading.Lock:
+    return _path_locks[hash(str(path)) % len(_path_locks)]
+
+
+@contextlib.contextmanager
+def path_locks(paths: Iterable[Path]) -> Iterator[None]:
+    """Hold the locks of multiple paths, locks are acquired in a fixed order so concurrent callers cannot deadlock."""
+    locks = sorted({id(path_lock(path)): path_lock(path) for path in paths}.items())
+    with contextlib.ExitStack() as stack:
+        for _, lock in locks:
+            stack.enter_context(lock)
+        yield
+
+
+def _iter_staged_files(staging_dir: Path) -> Iterator[tuple[Path, int, float]]:
+    """(path, size, mtime) of the staged chunks in a directory, including temporary files of unfinished writes."""
+    if not staging_dir.is_dir():
+        return
+    for entry in os.scandir(staging_dir):
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        yield Path(entry.path), stat.st_size, stat.st_mtime
+
+
+def _fsync_dir(path: Path) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_files_atomic(root: Path, files: dict[RelativePath, bytes], fsync: bool = True) -> dict[Path, FileMetadata]:
+    """
+    Write files under `root` through temporary files that are renamed over the old versions.
+
+    Temporary files are hidden, so they are never picked up as snapshot files. With `fsync`, all files are flushed
+    before the first rename, and every directory is flushed once after all renames instead of once per file.
+
+    Returns:
+        dict[Path, FileMetadata]: Metadata of every written file.
+    """
+    temp_paths: dict[Path, Path] = {}
+    try:
+        for path, contents in files.items():
+            abs_path = root / path
+            abs_path.parent.mkdir(exist_ok=True, parents=True)
+            temp_path = abs_path.with_name(f".{abs_path.name}.{uuid.uuid4().hex}.tmp")
+            temp_paths[path] = temp_path
+            with open(temp_path, "wb") as f:
+                f.write(contents)
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+        metadata = {}
+        for path, temp_path in temp_paths.items():
+            # rename keeps the mtime, so the metadata matches the file after the rename
+            metadata[path] = hash_data(files[path], path, temp_path.stat())
+            os.replace(temp_path, root / path)
+    except BaseException:
+        for temp_path in temp_paths.values():
+            temp_path.unlink(missing_ok=True)
+        raise
+
+    if fsync and os.name != "nt":
+        for directory in {(root / path).parent for path in files}:
+            _fsync_dir(directory)
+    return metadata
+
+
 def computed_permission_for_user_and_path(connection: sqlite3.Connection, user: str, path: Path):
     rules: List[PermissionRule] = get_rules_for_path(connection, path)
     return ComputedPermission.from_user_rules_and_path(rules=rules, user=user, path=path)
 
 
 class FileStore:
-    def __init__(self, server_settings: ServerSettings) -> None:
+    def __init__(self, server_settings: ServerSettings, executor: Optional[Executor] = None) -> None:
+        """
+        Args:
+            server_settings (ServerSettings): Settings of the server
+            executor (Optional[Executor], optional): Executor for `run_async`.
+                Defaults to None, which uses the default executor of the event loop.
+        """
         self.server_settings = server_settings
+        self.executor = executor
+
+    async def run_async(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """
+        Run a blocking FileStore method on the executor, so async endpoints do not block the event loop.
+
+        Example:
+            `file = await file_store.run_async(file_store.get, path, user)`
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
 
     @property
     def db_path(self) -> AbsolutePath:
+        """Main database, only the catalog of datasites if `shard_db_by_datasite` is set."""
         return self.server_settings.file_db_path
 
-    def delete(self, path: RelativePath, user: str, skip_permission_check: bool = False) -> None:
+    @property
+    def is_sharded(self) -> bool:
+        return self.server_settings.shard_db_by_datasite
+
+    def db_path_for(self, path: Path) -> AbsolutePath:
+        """Database with the metadata of `path`, routed by the datasite of the path."""
+        return self.server_settings.datasite_db_path(path.parts[0])
+
+    def list_datasites(self) -> list[str]:
         with get_db(self.db_path) as conn:
+            if self.is_sharded:
+                return db.get_catalog_datasites(conn)
+            return db.get_all_datasites(conn)
+
+    def _for_each_datasite(
+        self, fn: Callable[[sqlite3.Connection, str], T], subscriptions: Optional[Subscriptions] = None
+    ) -> list[T]:
+        """
+        Call `fn(connection, datasite)` for every datasite, sorted by datasite.
+        If `subscriptions` is given, only datasites with subscribed paths are included.
+
+        If metadata is sharded, every call uses the database of its datasite and calls fan out over the executor.
+        Otherwise, all calls share a single connection to the main database.
+        """
+        if not self.is_sharded:
+            with get_db(self.db_path) as conn:
+                datasites = db.get_all_datasites(conn)
+                if subscriptions is not None:
+                    datasites = [datasite for datasite in datasites if subscriptions.includes_datasite(datasite)]
+                return [fn(conn, datasite) for datasite in datasites]
+
+        def call(datasite: str) -> T:
+            with get_db(self.server_settings.datasite_db_path(datasite)) as conn:
+                return fn(conn, datasite)
+
+        datasites = self.list_datasites()
+        if subscriptions is not None:
+            datasites = [datasite for datasite in datasites if subscriptions.includes_datasite(datasite)]
+        if self.executor is None:
+            return [call(datasite) for datasite in datasites]
+        return list(self.executor.map(call, datasites))
+
+    def delete(self, path: RelativePath, user: str, skip_permission_check: bool = False) -> None:
+        with get_db(self.db_path_for(path)) as conn:
             if path.name.endswith(PERM_FILE) and not skip_permission_check:
                 # check admin permission
                 computed_perm = computed_permission_for_user_and_path(conn, user, path)
@@ -62,46 +288,66 @@ class FileStore:
                     detail=f"User {user} does not have write permission for {path}",
                 )
 
-            cursor = conn.cursor()
-            cursor.execute("BEGIN IMMEDIATE;")
+        def delete_metadata(conn: sqlite3.Connection) -> None:
             try:
-                db.delete_file_metadata(cursor, str(path))
+                db.delete_file_metadata(conn, str(path))
             except ValueError:
                 pass
+            db.delete_file_chunks(conn, str(path))
 
             if path.name.endswith(PERM_FILE):
                 # todo: implement delete for permfile
                 permfile = SyftPermission(relative_filepath=path, rules=[])
                 set_rules_for_permfile(conn, permfile)
 
+        with path_lock(path):
+            get_writer(self.db_path_for(path)).write(delete_metadata)
             abs_path = self.server_settings.snapshot_folder / path
             abs_path.unlink(missing_ok=True)
-            conn.commit()
-            cursor.close()
 
     def get(self, path: RelativePath, user: str) -> SyftFile:
-        with get_db(self.db_path) as conn:
-            computed_perm = computed_permission_for_user_and_path(conn, user, path)
-            if not computed_perm.has_permission(PermissionType.READ):
-                raise HTTPException(
-                    status_code=403,
-                    detail=f"User {user} does not have read permission for {path}",
-                )
+        with get_db(self.db_path_for(path)) as conn:
+            return self._get(conn, path, user)
 
-            metadata = db.get_one_metadata(conn, path=str(path))
-            abs_path = self.server_settings.snapshot_folder / metadata.path
-
-            if not Path(abs_path).exists():
-                self.delete(metadata.path.as_posix(), user)
-                raise ValueError("File not found")
-            return SyftFile(
-                metadata=metadata,
-                data=self._read_bytes(abs_path),
-                absolute_path=abs_path,
+    def get_many(self, paths: list[RelativePath], user: str) -> list[SyftFile]:
+        """Get multiple files using a single connection per database, files that do not exist are skipped."""
+        files = []
+        connections: dict[Path, sqlite3.Connection] = {}
+        for path in paths:
+            db_path = self.db_path_for(path)
+            if db_path not in connections:
+                connections[db_path] = get_db(db_path)
+            try:
+                files.append(self._get(connections[db_path], path, user))
+            except ValueError:
+                logger.warning(f"File not found: {path}")
+
+        for conn in connections.values():
+            conn.close()
+        return files
+
+    def _get(self, conn: sqlite3.Connection, path: RelativePath, user: str) -> SyftFile:
+        computed_perm = computed_permission_for_user_and_path(conn, user, path)
+        if not computed_perm.has_permission(PermissionType.READ):
+            raise HTTPException(
+                status_code=403,
+                detail=f"User {user} does not have read permission for {path}",
             )
 
+        metadata = db.get_one_metadata(conn, path=str(path))
+        abs_path = self.server_settings.snapshot_folder / metadata.path
+
+        if not Path(abs_path).exists():
+            self.delete(metadata.path.as_posix(), user)
+            raise ValueError("File not found")
+        return SyftFile(
+            metadata=metadata,
+            data=self._read_bytes(abs_path),
+            absolute_path=abs_path,
+        )
+
     def exists(self, path: RelativePath) -> bool:
-        with get_db(self.db_path) as conn:
+        with get_db(self.db_path_for(path)) as conn:
             try:
                 # we are skipping permission check here for now
                 db.get_one_metadata(conn, path=str(path))
@@ -110,7 +356,7 @@ class FileStore:
                 return False
 
     def get_metadata(self, path: RelativePath, user: str, skip_permission_check: bool = False) -> FileMetadata:
-        with get_db(self.db_path) as conn:
+        with get_db(self.db_path_for(path)) as conn:
             if not skip_permission_check:
                 computed_perm = computed_permission_for_user_and_path(conn, user, path)
                 if not computed_perm.has_permission(PermissionType.READ):
@@ -125,6 +371,35 @@ class FileStore:
         with open(path, "rb") as f:
             return f.read()
 
+    def _check_put_permission(
+        self,
+        conn: sqlite3.Connection,
+        path: Path,
+        user: str,
+        check_permission: Optional[PermissionType],
+    ) -> None:
+        if path.name.endswith(PERM_FILE):
+            # check admin permission
+            computed_perm = computed_permission_for_user_and_path(conn, user, path)
+            if not computed_perm.has_permission(PermissionType.ADMIN):
+                raise HTTPException(
+                    status_code=403,
+                    detail=f"User {user} does not have permission to edit syftperm file for {path}",
+                )
+
+        computed_perm = computed_permission_for_user_and_path(conn, user, path)
+        if check_permission not in [
+            PermissionType.WRITE,
+            PermissionType.CREATE,
+        ]:
+            raise ValueError(f"check_permission must be either WRITE or CREATE, got {check_permission}")
+
+        if not computed_perm.has_permission(check_permission):
+            raise HTTPException(
+                status_code=403,
+                detail=f"User {user} does not have write permission for {path}",
+            )
+
     def put(
         self,
         path: Path,
@@ -133,60 +408,634 @@ class FileStore:
         check_permission: Optional[PermissionType] = None,
         skip_permission_check: bool = False,
     ) -> None:
-        with get_db(self.db_path) as conn:
-            if path.name.endswith(PERM_FILE) and not skip_permission_check:
-                # check admin permission
-                computed_perm = computed_permission_for_user_and_path(conn, user, path)
-                if not computed_perm.has_permission(PermissionType.ADMIN):
-                    raise HTTPException(
-                        status_code=403,
-                        detail=f"User {user} does not have permission to edit syftperm file for {path}",
-                    )
+        self.put_many({path: contents}, user, check_permission, skip_permission_check)
 
-            if not skip_permission_check:
-                computed_perm = computed_permission_for_user_and_path(conn, user, path)
-                if check_permission not in [
-                    PermissionType.WRITE,
-                    PermissionType.CREATE,
-                ]:
-                    raise ValueError(f"check_permission must be either WRITE or CREATE, got {check_permission}")
+    def put_many(
+        self,
+        files: dict[Path, bytes],
+        user: str,
+        check_permission: Optional[PermissionType] = None,
+        skip_permission_check: bool = False,
+    ) -> None:
+        """
+        Write multiple files, nothing is written if the user is not allowed to write any of them.
 
-                if not computed_perm.has_permission(check_permission):
-                    raise HTTPException(
-                        status_code=403,
-                        detail=f"User {user} does not have write permission for {path}",
-                    )
+        Files are written to a temporary file and renamed over the old version, so readers only ever see complete
+        files. Files are renamed before their metadata is committed: after a crash a file can be newer than its
+        metadata, which the scrubber repairs, but metadata never points to content that was not written.
+        All files are flushed to disk before the first rename, so a batch pays for one round of flushes.
+        """
+        paths = list(files)
+        for db_path, db_paths in itertools.groupby(sorted(paths, key=self.db_path_for), key=self.db_path_for):
+            db_path.parent.mkdir(exist_ok=True, parents=True)
+            if skip_permission_check:
+                continue
+            with get_db(db_path) as conn:
+                for path in db_paths:
+                    self._check_put_permission(conn, path, user, check_permission)
 
-            cursor = conn.cursor()
-            cursor.execute("BEGIN IMMEDIATE;")
-            abs_path = self.server_settings.snapshot_folder / path
-            abs_path.parent.mkdir(exist_ok=True, parents=True)
+        permfiles: dict[Path, SyftPermission] = {}
+        for path in paths:
+            if not path.name.endswith(PERM_FILE):
+                continue
+            try:
+                permfiles[path] = SyftPermission.from_bytes(files[path], path)
+            except (yaml.YAMLError, ValueError):
+                raise HTTPException(
+                    status_code=400,
+                    detail="invalid syftpermission contents, skipped writing",
+                )
 
-            abs_path.write_bytes(contents)
+        self._add_to_catalog(paths)
 
-            # TODO: this is currently not atomic (writing the file and adding rows to db)
-            # but its also somehwat challenging to do so. Especially date modified is tricky.
-            # Because: if we insert first and write the file later, the date modified it not known yet.
-            # If we write the file first and then insert, we might have to revert the file, but we need to
-            # set it to the old date modified.
-            metadata = hash_file(abs_path, root_dir=self.server_settings.snapshot_folder)
-            db.save_file_metadata(cursor, metadata)
+        with path_locks(paths):
+            metadata = write_files_atomic(
+                self.server_settings.snapshot_folder,
+                files,
+                fsync=self.server_settings.fsync_writes,
+            )
 
-            if path.name.endswith(PERM_FILE):
+            for db_path, db_paths in itertools.groupby(sorted(paths, key=self.db_path_for), key=self.db_path_for):
+                db_paths = list(db_paths)
+
+                def save_metadata(conn: sqlite3.Connection, db_paths: list[Path] = db_paths) -> None:
+                    db.save_many_file_metadata(conn, [metadata[path] for path in db_paths])
+                    for path in db_paths:
+                        if path in permfiles:
+                            set_rules_for_permfile(conn, permfiles[path])
+                        link_existing_rules_to_file(conn, path)
+
+                get_writer(db_path).write(save_metadata)
+
+    def put_each(
+        self,
+        files: dict[Path, bytes],
+        user: str,
+        check_permission: PermissionType,
+        create_only: bool = False,
+    ) -> dict[Path, Optional[HTTPException]]:
+        """
+        Write multiple files, unlike `put_many` every file succeeds or fails on its own.
+
+        Permissions are checked with a single connection per database, and all files that pass are
+        written with one `put_many`, which commits their metadata in one transaction per database.
+
+        Args:
+            create_only (bool, optional): Reject files that already exist, like `/sync/create`. Defaults to False.
+
+        Returns:
+            dict[Path, Optional[HTTPException]]: The error of every file that was not written, None if it was.
+        """
+        errors: dict[Path, HTTPException] = {}
+        for db_path, db_paths in itertools.groupby(sorted(files, key=self.db_path_for), key=self.db_path_for):
+            db_path.parent.mkdir(exist_ok=True, parents=True)
+            with get_db(db_path) as conn:
+                for path in db_paths:
+                    if create_only:
+                        try:
+                            db.get_one_metadata(conn, path=str(path))
+                            errors[path] = HTTPException(status_code=400, detail="file already exists")
+                            continue
+                        except ValueError:
+                            pass
+                    try:
+                        self._check_put_permission(conn, path, user, check_permission)
+                    except HTTPException as e:
+                        errors[path] = e
+                        continue
+                    if not path.name.endswith(PERM_FILE):
+                        continue
+                    try:
+                        SyftPermission.from_bytes(files[path], path)
+                    except (yaml.YAMLError, ValueError):
+                        errors[path] = HTTPException(
+                            status_code=400,
+                            detail="invalid syftpermission contents, skipped writing",
+                        )
+
+        to_write = {path: contents for path, contents in files.items() if path not in errors}
+        if to_write:
+            self.put_many(to_write, user, skip_permission_check=True)
+        return {path: errors.get(path) for path in files}
+
+    def delete_each(self, paths: list[RelativePath], user: str) -> dict[Path, Optional[HTTPException]]:
+        """
+        Delete multiple files, like `delete` for every file but with a single connection per database for the
+        permission checks and one transaction per database for the metadata. Every file succeeds or fails on its own.
+
+        Returns:
+            dict[Path, Optional[HTTPException]]: The error of every file that was not deleted, None if it was.
+        """
+        errors: dict[Path, HTTPException] = {}
+        to_delete: dict[Path, list[Path]] = {}
+        for db_path, db_paths in itertools.groupby(sorted(set(paths), key=self.db_path_for), key=self.db_path_for):
+            with get_db(db_path) as conn:
+                for path in db_paths:
+                    computed_perm = computed_permission_for_user_and_path(conn, user, path)
+                    if path.name.endswith(PERM_FILE) and not computed_perm.has_permission(PermissionType.ADMIN):
+                        errors[path] = HTTPException(
+                            status_code=403,
+                            detail=f"User {user} does not have permission to edit syftperm file for {path}",
+                        )
+                    elif not computed_perm.has_permission(PermissionType.WRITE):
+                        errors[path] = HTTPException(
+                            status_code=403,
+                            detail=f"User {user} does not have write permission for {path}",
+                        )
+                    else:
+                        to_delete.setdefault(db_path, []).append(path)
+
+        def delete_metadata(conn: sqlite3.Connection, db_paths: list[Path]) -> None:
+            for path in db_paths:
                 try:
-                    permfile = SyftPermission.from_bytes(contents, path)
-                except (yaml.YAMLError, ValueError):
-                    raise HTTPException(
-                        status_code=400,
-                        detail="invalid syftpermission contents, skipped writing",
+                    db.delete_file_metadata(conn, str(path))
+                except ValueError:
+                    pass
+                db.delete_file_chunks(conn, str(path))
+                if path.name.endswith(PERM_FILE):
+                    set_rules_for_permfile(conn, SyftPermission(relative_filepath=path, rules=[]))
+
+        with path_locks(itertools.chain.from_iterable(to_delete.values())):
+            for db_path, db_paths in to_delete.items():
+                get_writer(db_path).write(functools.partial(delete_metadata, db_paths=db_paths))
+                for path in db_paths:
+                    (self.server_settings.snapshot_folder / path).unlink(missing_ok=True)
+        return {path: errors.get(path) for path in paths}
+
+    def get_many_metadata(
+        self,
+        paths: list[RelativePath],
+        user: str,
+        skip_permission_check: bool = False,
+        denied: Optional[set[Path]] = None,
+    ) -> dict[Path, FileMetadata]:
+        """Metadata of multiple files with a single connection per database, files that do not exist or that
+        the user cannot read are skipped. Files the user cannot read are added to `denied`, if given."""
+        result: dict[Path, FileMetadata] = {}
+        for db_path, db_paths in itertools.groupby(sorted(paths, key=self.db_path_for), key=self.db_path_for):
+            with get_db(db_path) as conn:
+                for path in db_paths:
+                    if not skip_permission_check:
+                        computed_perm = computed_permission_for_user_and_path(conn, user, path)
+                        if not computed_perm.has_permission(PermissionType.READ):
+                            if denied is not None:
+                                denied.add(path)
+                            continue
+                    try:
+                        result[path] = db.get_one_metadata(conn, path=str(path))
+                    except ValueError:
+                        pass
+        return result
+
+    def _add_to_catalog(self, paths: list[Path]) -> None:
+        if not self.is_sharded:
+            return
+        datasites = self.list_datasites()
+        for datasite in sorted({path.parts[0] for path in paths} - set(datasites)):
+            # first file of a new datasite
+            get_writer(self.db_path).write(functools.partial(db.add_catalog_datasite, datasite=datasite))
+
+    def _get_chunks(self, metadata: FileMetadata) -> list[ChunkInfo]:
+        """Chunks of a snapshot file, chunks are computed and stored on first use."""
+        path = metadata.path
+        with get_db(self.db_path_for(path)) as conn:
+            chunks = db.get_file_chunks(conn, str(path), metadata.hash)
+        if chunks is not None:
+            return chunks
+
+        try:
+            file_hash, chunks = chunk_file(self.server_settings.snapshot_folder / path)
+        except FileNotFoundError:
+            raise ValueError(f"File not found: {path}")
+        if file_hash != metadata.hash:
+            raise HTTPException(status_code=409, detail=f"File {path} changed, retry")
+        get_writer(self.db_path_for(path)).write(
+            lambda conn: db.save_file_chunks(conn, str(path), file_hash, chunks),
+        )
+        return chunks
+
+    def get_chunk_manifest(self, path: RelativePath, user: str) -> ChunkManifest:
+        metadata = self.get_metadata(path, user)
+        return ChunkManifest(
+            path=path,
+            hash=metadata.hash,
+            file_size=metadata.file_size,
+            chunks=self._get_chunks(metadata) if metadata.file_size else [],
+        )
+
+    def read_chunk(self, path: RelativePath, user: str, file_hash: str, index: int) -> bytes:
+        """Read a single chunk of a file, `file_hash` is the hash of the file the chunk was listed for."""
+        manifest = self.get_chunk_manifest(path, user)
+        if manifest.hash != file_hash:
+            raise HTTPException(status_code=409, detail=f"File {path} changed, retry")
+        if index >= len(manifest.chunks):
+            raise ValueError(f"File {path} has no chunk {index}")
+        try:
+            return read_chunk(self.server_settings.snapshot_folder / path, manifest.chunks[index])
+        except ValueError:
+            raise HTTPException(status_code=409, detail=f"File {path} changed, retry")
+
+    def staging_dir_for(self, user: str) -> Path:
+        return self.server_settings.chunk_staging_folder / user
+
+    def stage_chunk(self, user: str, expected_hash: str, contents: bytes) -> None:
+        """
+        Store an uploaded chunk until it is committed with `put_chunks`.
+
+        Expired chunks of the user are deleted first, chunks that would exceed `chunk_staging_max_bytes` are rejected.
+        """
+        if len(contents) > CHUNK_SIZE:
+            raise HTTPException(status_code=400, detail=f"chunks cannot be larger than {CHUNK_SIZE} bytes")
+        if hashlib.sha256(contents).hexdigest() != expected_hash:
+            raise HTTPException(status_code=400, detail="hash mismatch, skipped writing")
+
+        staging_dir = self.staging_dir_for(user)
+        with path_lock(staging_dir):
+            self.expire_staged_chunks(user)
+            if (staging_dir / expected_hash).is_file():
+                return
+            staged_bytes = sum(size for _, size, _ in _iter_staged_files(staging_dir))
+            if staged_bytes + len(contents) > self.server_settings.chunk_staging_max_bytes:
+                raise HTTPException(
+                    status_code=413,
+                    detail="too many uncommitted chunks, commit or wait for staged chunks to expire",
+                )
+            write_files_atomic(staging_dir, {Path(expected_hash): contents}, fsync=False)
+
+    def expire_staged_chunks(self, user: Optional[str] = None) -> int:
+        """
+        Delete staged chunks older than `chunk_staging_ttl`, of `user` or of all users.
+
+        Returns:
+            int: Number of deleted files.
+        """
+        if user is not None:
+            staging_dirs = [self.staging_dir_for(user)]
+        elif self.server_settings.chunk_staging_folder.is_dir():
+            staging_dirs = [d for d in self.server_settings.chunk_staging_folder.iterdir() if d.is_dir()]
+        else:
+            staging_dirs = []
+
+        cutoff = time.time() - self.server_settings.chunk_staging_ttl.total_seconds()
+        deleted = 0
+        for staging_dir in staging_dirs:
+            for path, _, mtime in _iter_staged_files(staging_dir):
+                if mtime < cutoff:
+                    path.unlink(missing_ok=True)
+                    deleted += 1
+        return deleted
+
+    def _find_chunks(self, hashes: set[str]) -> dict[str, tuple[Path, ChunkInfo]]:
+        """Find chunks in the current version of any file, returns the snapshot path and location per chunk."""
+        if not hashes:
+            return {}
+        if not self.is_sharded:
+            with get_db(self.db_path) as conn:
+                return db.find_chunks(conn, hashes)
+
+        found: dict[str, tuple[Path, ChunkInfo]] = {}
+        for datasite in self.list_datasites():
+            remaining = hashes - found.keys()
+            if not remaining:
+                break
+            with get_db(self.server_settings.datasite_db_path(datasite)) as conn:
+                found.update(db.find_chunks(conn, remaining))
+        return found
+
+    def put_chunks(
+        self,
+        path: RelativePath,
+        chunks: list[ChunkInfo],
+        expected_hash: str,
+        user: str,
+    ) -> CommitChunksResponse:
+        """
+        Assemble a file from chunks staged by `user`, chunks of the current version of the file and, if
+        `chunk_dedup_enabled` is set, chunks of any other file on the server.
+
+        The file is written one chunk at a time to a temporary file, which is only renamed over the current version
+        if its hash matches `expected_hash`. If any chunk is not available, nothing is written and the response
+        lists the missing chunks.
+        """
+        if path.name.endswith(PERM_FILE):
+            raise HTTPException(status_code=400, detail="permission files cannot be uploaded in chunks")
+        offsets = itertools.accumulate((chunk.size for chunk in chunks), initial=0)
+        if any(chunk.offset != offset or not 0 < chunk.size <= CHUNK_SIZE for chunk, offset in zip(chunks, offsets)):
+            raise HTTPException(status_code=400, detail=f"chunks must be contiguous and at most {CHUNK_SIZE} bytes")
+        db_path = self.db_path_for(path)
+        db_path.parent.mkdir(exist_ok=True, parents=True)
+        with get_db(db_path) as conn:
+            try:
+                previous: Optional[FileMetadata] = db.get_one_metadata(conn, path=str(path))
+            except ValueError:
+                previous = None
+            check_permission = PermissionType.CREATE if previous is None else PermissionType.WRITE
+            self._check_put_permission(conn, path, user, check_permission)
+
+        # absolute path and location of every chunk that is available on the server
+        snapshot_folder = self.server_settings.snapshot_folder
+        abs_path = snapshot_folder / path
+        sources: dict[str, tuple[Path, ChunkInfo]] = {}
+        if previous is not None and previous.file_size:
+            try:
+                sources.update((chunk.hash, (abs_path, chunk)) for chunk in self._get_chunks(previous))
+            except ValueError:
+                # the current file is missing from the snapshot folder
+                pass
+        staging_dir = self.staging_dir_for(user)
+        for chunk in chunks:
+            if chunk.hash not in sources and (staging_dir / chunk.hash).is_file():
+                sources[chunk.hash] = (staging_dir / chunk.hash, chunk.model_copy(update={"offset": 0}))
+        if self.server_settings.chunk_dedup_enabled:
+            found = self._find_chunks({chunk.hash for chunk in chunks} - sources.keys())
+            sources.update((h, (snapshot_folder / found_path, chunk)) for h, (found_path, chunk) in found.items())
+
+        previous_hash = previous.hash if previous is not None else None
+        missing = list(dict.fromkeys(chunk.hash for chunk in chunks if chunk.hash not in sources))
+        if missing:
+            return CommitChunksResponse(path=path, previous_hash=previous_hash, missing_chunks=missing)
+
+        self._add_to_catalog([path])
+        abs_path.parent.mkdir(exist_ok=True, parents=True)
+        temp_path = abs_path.with_name(f".{abs_path.name}.{uuid.uuid4().hex}.tmp")
+        with path_lock(path):
+            try:
+                file_hash = hashlib.sha256()
+                with open(temp_path, "wb") as f:
+                    for chunk in chunks:
+                        data = read_chunk(*sources[chunk.hash])
+                        file_hash.update(data)
+                        f.write(data)
+                    if self.server_settings.fsync_writes:
+                        f.flush()
+                        os.fsync(f.fileno())
+                if file_hash.hexdigest() != expected_hash:
+                    raise HTTPException(status_code=400, detail="hash mismatch, skipped writing")
+
+                # rename keeps the mtime, so the metadata matches the file after the rename
+                stat = temp_path.stat()
+                if stat.st_size > CHUNKED_FILE_THRESHOLD:
+                    metadata = FileMetadata(
+                        path=path,
+                        hash=expected_hash,
+                        signature="",
+                        file_size=stat.st_size,
+                        last_modified=datetime.fromtimestamp(stat.st_mtime, timezone.utc),
                     )
-                set_rules_for_permfile(conn, permfile)
+                else:
+                    metadata = hash_data(temp_path.read_bytes(), path, stat)
+                os.replace(temp_path, abs_path)
+            except (ValueError, FileNotFoundError):
+                # a file a chunk is read from changed or was deleted since its chunks were listed
+                raise HTTPException(status_code=409, detail=f"File {path} changed, retry")
+            finally:
+                temp_path.unlink(missing_ok=True)
+            if self.server_settings.fsync_writes and os.name != "nt":
+                _fsync_dir(abs_path.parent)
 
-            link_existing_rules_to_file(conn, path)
+            def save_metadata(conn: sqlite3.Connection) -> None:
+                db.save_file_metadata(conn, metadata)
+                db.save_file_chunks(conn, str(path), expected_hash, chunks)
+                link_existing_rules_to_file(conn, path)
 
-            conn.commit()
-            cursor.close()
+            get_writer(db_path).write(save_metadata)
 
-    def list_for_user(self, path: RelativePath, email: str) -> list[FileMetadata]:
+        for chunk_hash in {chunk.hash for chunk in chunks}:
+            (staging_dir / chunk_hash).unlink(missing_ok=True)
+        return CommitChunksResponse(path=path, current_hash=expected_hash, previous_hash=previous_hash)
+
+    def read_inline_contents(self, files: Iterable[FileMetadata], max_size: int) -> dict[Path, str]:
+        """
+        b85 encoded contents of the listed files of at most `max_size` bytes, for listings that inline small files.
+
+        Files are only inlined while they match their listed hash, and at most `MAX_INLINE_CONTENTS_SIZE` bytes are
+        inlined in total. Files are assumed to be readable by the user the listing is for.
+        """
+        contents: dict[Path, str] = {}
+        budget = MAX_INLINE_CONTENTS_SIZE
+        for metadata in files:
+            if metadata.file_size > min(max_size, budget):
+                continue
+            try:
+                data = self._read_bytes(self.server_settings.snapshot_folder / metadata.path)
+            except OSError:
+                continue
+            if hashlib.sha256(data).hexdigest() != metadata.hash:
+                # changed since it was listed, the client downloads it instead
+                continue
+            contents[metadata.path] = base64.b85encode(data).decode("utf-8")
+            budget -= len(data)
+        return contents
+
+    def get_subscriptions(self, user: str) -> Subscriptions:
         with get_db(self.db_path) as conn:
-            return db.get_filemetadata_with_read_access(conn, email, path)
+            return Subscriptions(user, db.get_subscriptions(conn, user))
+
+    def set_subscriptions(self, user: str, paths: list[RelativePath]) -> Subscriptions:
+        """Replace the subscriptions of `user`, an empty list subscribes to everything."""
+        subscriptions = Subscriptions(user, paths)
+        get_writer(self.db_path).write(lambda conn: db.set_subscriptions(conn, user, subscriptions.paths))
+        return subscriptions
+
+    def _iter_subscribed(self, conn: sqlite3.Connection, email: str, prefixes: list[Path]) -> Iterator[FileMetadata]:
+        """Readable files under disjoint subscribed `prefixes`, with one range query per prefix."""
+        for prefix in prefixes:
+            for metadata in db.iter_filemetadata_with_read_access(conn, email, prefix):
+                # the range query matches on string prefix, a/b also matches a/bc
+                if metadata.path == prefix or prefix in metadata.path.parents:
+                    yield metadata
+
+    def list_for_user(self, path: RelativePath, email: str) -> list[FileMetadata]:
+        if self.is_sharded and path == Path("."):
+            return [file for _, files in self.iter_datasite_states(email) for file in files]
+        subscriptions = self.get_subscriptions(email)
+        with get_db(self.db_path_for(path)) as conn:
+            return list(subscriptions.filter(db.iter_filemetadata_with_read_access(conn, email, path)))
+
+    def get_datasite_states_etag(
+        self, email: str, page_size: Optional[int] = None, inline_max_size: int = 0, resource: str = "datasite_states"
+    ) -> str:
+        """
+        ETag for the datasite_states of `email`, changes whenever a file or permission in a subscribed datasite
+        changes, or when the subscriptions change. Other listings of all datasites, like the root of the Merkle tree,
+        use the same ETag with a different `resource`.
+
+        Computing it costs one row per datasite, so unchanged states can be detected without any permission queries.
+        """
+        subscriptions = self.get_subscriptions(email)
+        versions = self._for_each_datasite(
+            lambda conn, datasite: (datasite, db.get_datasite_version(conn, datasite)), subscriptions
+        )
+        state_hash = hashlib.sha256(
+            f"{resource}:{email}:{page_size}:{inline_max_size}:{subscriptions.fingerprint}".encode()
+        )
+        for datasite, version in versions:
+            state_hash.update(f"|{datasite}:{version}".encode())
+        return f'W/"{state_hash.hexdigest()}"'
+
+    def get_tree_node(self, path: RelativePath, email: str) -> TreeNodeResponse:
+        """
+        A directory of the Merkle tree over the subscribed files `email` can read, see `syftbox.lib.merkle`.
+
+        The root Path(".") has a child for every subscribed datasite, directories that do not exist are returned empty.
+        """
+        subscriptions = self.get_subscriptions(email)
+        if path == Path("."):
+            children = self._for_each_datasite(
+                lambda conn, datasite: TreeEntry(
+                    name=datasite,
+                    hash=self._get_datasite_root_hash(conn, email, datasite, subscriptions),
+                    is_dir=True,
+                ),
+                subscriptions,
+            )
+            return TreeNodeResponse(path=path, hash=hash_entries(children), children=children)
+
+        with get_db(self.db_path_for(path)) as conn:
+            return self._get_datasite_tree(conn, email, path.parts[0], subscriptions).node(path)
+
+    def _datasite_tree_key(
+        self, conn: sqlite3.Connection, email: str, datasite: str, subscriptions: Subscriptions
+    ) -> Optional[tuple]:
+        version = db.get_datasite_version(conn, datasite)
+        if version is None:
+            return None
+        return (
+            str(self.server_settings.datasite_db_path(datasite)),
+            email,
+            datasite,
+            version,
+            subscriptions.fingerprint,
+        )
+
+    def _get_datasite_root_hash(
+        self, conn: sqlite3.Connection, email: str, datasite: str, subscriptions: Subscriptions
+    ) -> str:
+        key = self._datasite_tree_key(conn, email, datasite, subscriptions)
+        root_hash = merkle_tree_cache.get_root_hash(key) if key is not None else None
+        if root_hash is None:
+            root_hash = self._get_datasite_tree(conn, email, datasite, subscriptions).root_hash
+        return root_hash
+
+    def _get_datasite_tree(
+        self, conn: sqlite3.Connection, email: str, datasite: str, subscriptions: Subscriptions
+    ) -> MerkleTree:
+        key = self._datasite_tree_key(conn, email, datasite, subscriptions)
+        tree = merkle_tree_cache.get(key) if key is not None else None
+        if tree is None:
+            files = self._iter_subscribed(conn, email, subscriptions.prefixes_in(datasite))
+            tree = MerkleTree(Path(datasite), files)
+            if key is not None:
+                merkle_tree_cache.put(key, tree)
+        return tree
+
+    def list_page_for_user(
+        self, path: RelativePath, email: str, cursor: Optional[str], page_size: int
+    ) -> tuple[list[FileMetadata], Optional[str]]:
+        subscriptions = self.get_subscriptions(email)
+        if self.is_sharded and path == Path("."):
+            return self._sharded_page(email, subscriptions, cursor=cursor, page_size=page_size)
+        with get_db(self.db_path_for(path)) as conn:
+            files, next_cursor = db.get_filemetadata_page_with_read_access(
+                conn, email, path, cursor=cursor, page_size=page_size
+            )
+        return list(subscriptions.filter(files)), next_cursor
+
+    def _sharded_page(
+        self, email: str, subscriptions: Subscriptions, cursor: Optional[str], page_size: int
+    ) -> tuple[list[FileMetadata], Optional[str]]:
+        """
+        A page of readable, subscribed files over all datasite databases, in datasite order.
+        The cursor is the last examined path, its datasite is the database to continue from.
+        """
+        cursor_datasite = cursor.split("/")[0] if cursor is not None else None
+        files: list[FileMetadata] = []
+        for datasite in self.list_datasites():
+            if cursor_datasite is not None and datasite < cursor_datasite:
+                continue
+            if not subscriptions.includes_datasite(datasite):
+                continue
+            with get_db(self.server_settings.datasite_db_path(datasite)) as conn:
+                page, next_cursor = db.get_filemetadata_page_with_read_access(
+                    conn,
+                    email,
+                    Path(datasite),
+                    cursor=cursor if datasite == cursor_datasite else None,
+                    page_size=page_size - len(files),
+                )
+            files.extend(subscriptions.filter(page))
+            if next_cursor is not None:
+                return files, next_cursor
+        return files, None
+
+    def datasite_states_page(
+        self, email: str, cursor: Optional[str], page_size: int
+    ) -> tuple[dict[str, list[FileMetadata]], Optional[str]]:
+        """
+        A page of `iter_datasite_states`, see `db.get_filemetadata_page_with_read_access` for the cursor semantics.
+
+        Pages include the datasites with readable files in the page. Files of a datasite are contiguous across pages,
+        so clients can merge consecutive pages per datasite. The last page marks the listing as complete: it also lists
+        every other subscribed datasite with an empty list, including datasites that had files in earlier pages.
+        """
+        subscriptions = self.get_subscriptions(email)
+        if self.is_sharded:
+            files, next_cursor = self._sharded_page(email, subscriptions, cursor=cursor, page_size=page_size)
+        else:
+            with get_db(self.db_path) as conn:
+                files, next_cursor = db.get_filemetadata_page_with_read_access(
+                    conn, email, cursor=cursor, page_size=page_size
+                )
+            files = list(subscriptions.filter(files))
+        datasite_states = {
+            datasite: list(datasite_files)
+            for datasite, datasite_files in itertools.groupby(files, key=lambda m: m.datasite)
+        }
+        if next_cursor is None:
+            for datasite in self.list_datasites():
+                if subscriptions.includes_datasite(datasite):
+                    datasite_states.setdefault(datasite, [])
+        return datasite_states, next_cursor
+
+    def iter_datasite_states(self, email: str) -> Iterator[tuple[str, list[FileMetadata]]]:
+        """
+        Yield (datasite, subscribed files readable by email) for every subscribed datasite on the server.
+
+        Permissions are resolved in a single pass over file_metadata, or in parallel over all datasite
+        databases if metadata is sharded. Datasites without any readable files are yielded last, with an empty list.
+        Datasites that are not subscribed to are not yielded at all, so clients never mistake them for empty.
+        """
+        subscriptions = self.get_subscriptions(email)
+        if self.is_sharded:
+            states = self._for_each_datasite(
+                lambda conn, datasite: (
+                    datasite,
+                    list(self._iter_subscribed(conn, email, subscriptions.prefixes_in(datasite))),
+                ),
+                subscriptions,
+            )
+            yield from ((datasite, files) for datasite, files in states if files)
+            yield from ((datasite, files) for datasite, files in states if not files)
+            return
+
+        # the response is streamed to the client, rows are copied before the first yield so the connection is closed
+        # before any data is sent, like the per-datasite lists of the sharded databases above
+        conn = get_db(self.db_path)
+        try:
+            datasites = [
+                datasite for datasite in db.get_all_datasites(conn) if subscriptions.includes_datasite(datasite)
+            ]
+            if subscriptions.is_everything:
+                readable_files = db.iter_filemetadata_with_read_access(conn, email)
+            else:
+                readable_files = self._iter_subscribed(conn, email, subscriptions.prefixes)
+            states = [
+                (datasite, list(files))
+                for datasite, files in itertools.groupby(readable_files, key=lambda m: m.datasite)
+            ]
+        finally:
+            conn.close()
+
+        yield from states
+        seen = {datasite for datasite, _ in states}
+        yield from ((datasite, []) for datasite in datasites if datasite not in seen)
@@ -1,4 +1,20 @@
 import sqlite3
+from datetime import datetime
+
+from syftbox.server.models.sync_models import datetime_to_ns
+
+# hash is the 32-byte sha256 digest, last_modified is in nanoseconds since the epoch (UTC)
+FILE_METADATA_TABLE = """
+CREATE TABLE IF NOT EXISTS {table} (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    datasite TEXT NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    hash BLOB NOT NULL,
+    signature TEXT NOT NULL,
+    file_size INTEGER NOT NULL,
+    last_modified INTEGER NOT NULL
+)
+"""
 
 
 # @contextlib.contextmanager
@@ -14,18 +30,7 @@ def get_db(path: str):
         conn.row_factory = sqlite3.Row
 
         # Create the table if it doesn't exist
-        conn.execute(
-            """
-        CREATE TABLE IF NOT EXISTS file_metadata (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            datasite TEXT NOT NULL,
-            path TEXT NOT NULL UNIQUE,
-            hash TEXT NOT NULL,
-            signature TEXT NOT NULL,
-            file_size INTEGER NOT NULL,
-            last_modified TEXT NOT NULL        )
-        """
-        )
+        conn.execute(FILE_METADATA_TABLE.format(table="file_metadata"))
         # TODO: migrate file_metadata id?
 
         # Create a table for storing file information
@@ -61,4 +66,124 @@ def get_db(path: str):
         );
         """
         )
+
+        _migrate_file_metadata_types(conn)
+
+        # Secondary indexes for the hot read paths. These are created on every connect,
+        # so existing databases are migrated in place the first time they are opened.
+        # - rules.permfile_dir: rule lookup for all parents of a path (get_rules_for_path)
+        # - rule_files.file_id: per-file rule join in get_read_permissions_for_user, and cascading deletes
+        # - file_metadata.datasite: per-datasite listings
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_rules_permfile_dir ON rules(permfile_dir);")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_rule_files_file_id ON rule_files(file_id);")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_file_metadata_datasite ON file_metadata(datasite);")
+
+        # Version of every datasite, changed by triggers on every file or permission rule change.
+        # Versions are random instead of incrementing, so they never repeat after the DB is rebuilt.
+        conn.execute(
+            """
+        CREATE TABLE IF NOT EXISTS datasite_versions (
+            datasite TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+        """
+        )
+        _create_version_triggers(conn)
+
+        # Chunks of large files, see syftbox.lib.chunks. Rows are only valid while file_hash matches
+        # the hash in file_metadata, stale rows are replaced when the chunks are requested.
+        conn.execute(
+            """
+        CREATE TABLE IF NOT EXISTS file_chunks (
+            path TEXT NOT NULL,
+            file_hash BLOB NOT NULL,
+            idx INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            hash BLOB NOT NULL,
+            PRIMARY KEY (path, idx)
+        )
+        """
+        )
+        # chunk index, to find any file that has a chunk
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_file_chunks_hash ON file_chunks(hash);")
+
+        # Catalog of all datasites, only used in the main DB when metadata is sharded per datasite
+        conn.execute("CREATE TABLE IF NOT EXISTS datasites (datasite TEXT PRIMARY KEY)")
+
+        # Selective sync subscriptions, see syftbox.lib.subscriptions. Only used in the main DB.
+        conn.execute(
+            """
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            user TEXT NOT NULL,
+            path TEXT NOT NULL,
+            PRIMARY KEY (user, path)
+        )
+        """
+        )
     return conn
+
+
+def _create_version_triggers(conn: sqlite3.Connection) -> None:
+    # datasite of a permission rule is the first component of its permfile_path
+    rule_datasite = "SUBSTR({row}.permfile_path, 1, INSTR({row}.permfile_path, '/') - 1)"
+    triggers = [
+        ("file_metadata", "INSERT", "NEW.datasite"),
+        ("file_metadata", "UPDATE", "NEW.datasite"),
+        ("file_metadata", "DELETE", "OLD.datasite"),
+        ("rules", "INSERT", rule_datasite.format(row="NEW")),
+        ("rules", "UPDATE", rule_datasite.format(row="NEW")),
+        ("rules", "DELETE", rule_datasite.format(row="OLD")),
+    ]
+    for table, event, datasite in triggers:
+        conn.execute(
+            f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_datasite_version
+        AFTER {event} ON {table}
+        BEGIN
+            INSERT INTO datasite_versions (datasite, version) VALUES ({datasite}, random())
+            ON CONFLICT(datasite) DO UPDATE SET version = excluded.version;
+        END;
+        """
+        )
+
+
+def _column_type(conn: sqlite3.Connection, table: str, column: str) -> str:
+    for row in conn.execute(f"PRAGMA table_info({table})"):
+        if row["name"] == column:
+            return row["type"]
+    raise ValueError(f"Column {column} not found in {table}")
+
+
+def _migrate_file_metadata_types(conn: sqlite3.Connection) -> None:
+    """
+    Migrate file_metadata from ISO-8601 TEXT timestamps and hex TEXT hashes to
+    integer nanosecond timestamps and BLOB hashes. This rebuilds the table, ids are kept.
+    """
+    if _column_type(conn, "file_metadata", "last_modified") != "TEXT":
+        return
+
+    # rule_files references file_metadata, dropping the old table should not cascade
+    conn.execute("PRAGMA foreign_keys = OFF;")
+    try:
+        conn.execute("BEGIN IMMEDIATE;")
+        # another connection might have migrated while we waited for the lock
+        if _column_type(conn, "file_metadata", "last_modified") == "TEXT":
+            conn.create_function("iso_to_ns", 1, lambda v: datetime_to_ns(datetime.fromisoformat(v)))
+            conn.create_function("hex_to_blob", 1, bytes.fromhex)
+            conn.execute(FILE_METADATA_TABLE.format(table="file_metadata_new"))
+            conn.execute(
+                """
+            INSERT INTO file_metadata_new (id, datasite, path, hash, signature, file_size, last_modified)
+            SELECT id, datasite, path, hex_to_blob(hash), signature, file_size, iso_to_ns(last_modified)
+            FROM file_metadata
+            """
+            )
+            conn.execute("DROP TABLE file_metadata")
+            conn.execute("ALTER TABLE file_metadata_new RENAME TO file_metadata")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute("PRAGMA foreign_keys = ON;")
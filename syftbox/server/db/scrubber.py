@@ -0,0 +1,231 @@
+import random
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+
+import yaml
+from loguru import logger
+from pydantic import BaseModel
+
+from syftbox.lib.constants import PERM_FILE
+from syftbox.lib.hash import hash_file, is_unchanged, walk_files
+from syftbox.lib.permissions import SyftPermission
+from syftbox.server.db import db
+from syftbox.server.db.file_store import FileStore, path_lock
+from syftbox.server.db.schema import get_db
+from syftbox.server.db.writer import get_writer
+from syftbox.server.models.sync_models import FileMetadata, datetime_to_ns
+from syftbox.server.settings import ServerSettings
+
+# files walked or checked between two waits of the walk throttle
+SCRUB_BATCH_SIZE = 100
+
+
+class ScrubberStats(BaseModel):
+    enabled: bool = True
+    repair: bool = False
+    """Differences are only counted and logged if False, see `ServerSettings.scrubber_repair`"""
+    passes: int = 0
+    """Number of completed passes over all datasites"""
+    progress: float = 0.0
+    """Fraction of datasites scrubbed in the current pass"""
+    current_datasite: Optional[str] = None
+    last_pass_finished: Optional[datetime] = None
+    files_checked: int = 0
+    files_hashed: int = 0
+    bytes_hashed: int = 0
+    orphan_rows_deleted: int = 0
+    """Rows of files that no longer exist in the snapshot folder, only reported if `repair` is False"""
+    orphan_files_added: int = 0
+    """Files in the snapshot folder without a row, only reported if `repair` is False"""
+    files_repaired: int = 0
+    """Files whose row did not match the file in the snapshot folder, only reported if `repair` is False"""
+    staged_chunks_expired: int = 0
+    """Uploaded chunks that were never committed, deleted after `chunk_staging_ttl`"""
+
+
+class SnapshotScrubber:
+    """
+    Background task that keeps `file_metadata` consistent with the snapshot folder.
+
+    Every pass walks the snapshot one datasite at a time and compares every file with its row by size and mtime.
+    Files that differ, files without a row and a random sample of unchanged files are hashed, rows of files that
+    no longer exist are deleted. The walk is limited to `scrubber_files_per_second` and hashing to
+    `scrubber_io_budget` bytes per second, so a pass never competes with clients for disk I/O.
+
+    Differences are only reported unless `scrubber_repair` is set. Files are hashed without holding a lock, repairs
+    take the same path lock as `FileStore.put` and `FileStore.delete` and re-check the file and its row under the
+    lock, so they never overwrite a concurrent write.
+    """
+
+    def __init__(self, settings: ServerSettings) -> None:
+        self.settings = settings
+        self.stats = ScrubberStats(repair=settings.scrubber_repair)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="syftbox-scrubber", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the scrubber, a pass in progress stops after the current file."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        interval = self.settings.scrubber_interval.total_seconds()
+        while not self._stop.wait(interval):
+            try:
+                self.scrub()
+            except Exception as e:
+                logger.exception(f"Scrubber pass failed: {e}")
+
+    def scrub(self) -> None:
+        """Run a full pass over all datasites."""
+        self.stats.staged_chunks_expired += FileStore(self.settings).expire_staged_chunks()
+        datasites = self._list_datasites()
+        logger.info(f"Scrubbing {len(datasites)} datasites")
+        self.stats.progress = 0.0
+        for i, datasite in enumerate(datasites):
+            if self._stop.is_set():
+                return
+            self.stats.current_datasite = datasite
+            self.scrub_datasite(datasite)
+            self.stats.progress = (i + 1) / len(datasites)
+
+        self.stats.passes += 1
+        self.stats.current_datasite = None
+        self.stats.last_pass_finished = datetime.now(timezone.utc)
+        logger.info(f"Scrubber pass finished: {self.stats}")
+
+    def _list_datasites(self) -> list[str]:
+        snapshot_folder = self.settings.snapshot_folder
+        on_disk = set()
+        if snapshot_folder.is_dir():
+            on_disk = {p.name for p in snapshot_folder.iterdir() if p.is_dir() and not p.name.startswith(".")}
+        return sorted(on_disk | set(FileStore(self.settings).list_datasites()))
+
+    def scrub_datasite(self, datasite: str) -> None:
+        snapshot_folder = self.settings.snapshot_folder
+        conn = get_db(self.settings.datasite_db_path(datasite))
+        try:
+            file_stats = db.get_file_stats(conn, path_like=f"{datasite}/")
+        finally:
+            conn.close()
+
+        files = set()
+        for entry in walk_files(snapshot_folder / datasite):
+            if self._stop.is_set():
+                return
+            files.add(Path(entry.path).relative_to(snapshot_folder).as_posix())
+            self._throttle_files(len(files))
+
+        for i, path in enumerate(sorted(file_stats.keys() | files), start=1):
+            if self._stop.is_set():
+                return
+            self._throttle_files(i)
+            self.stats.files_checked += 1
+            stored = file_stats.get(path)
+            try:
+                stat = (snapshot_folder / path).stat()
+            except OSError:
+                stat = None
+
+            if stat is not None and stored is not None and is_unchanged(stat, *stored):
+                if random.random() >= self.settings.scrubber_sample_rate:
+                    continue
+            self.repair(Path(path))
+
+    def _throttle_files(self, num_files: int) -> None:
+        """Wait after every `SCRUB_BATCH_SIZE` files, so walking and stat'ing files is limited like hashing."""
+        if num_files % SCRUB_BATCH_SIZE == 0:
+            self._stop.wait(SCRUB_BATCH_SIZE / self.settings.scrubber_files_per_second)
+
+    def repair(self, path: Path) -> None:
+        """Make the row of `path` match the file in the snapshot folder, or only report differences."""
+        abs_path = self.settings.snapshot_folder / path
+        db_path = self.settings.datasite_db_path(path.parts[0])
+
+        # hash without the path lock, path locks are shared by many paths and a large file takes long to hash
+        metadata = None
+        if abs_path.is_file():
+            metadata = hash_file(abs_path, root_dir=self.settings.snapshot_folder)
+            if metadata is None:
+                return
+            self.stats.files_hashed += 1
+            self.stats.bytes_hashed += metadata.file_size
+
+        with path_lock(path):
+            conn = get_db(db_path)
+            try:
+                row: Optional[FileMetadata] = db.get_one_metadata(conn, path=path.as_posix())
+            except ValueError:
+                row = None
+            finally:
+                conn.close()
+
+            try:
+                stat = abs_path.stat()
+            except OSError:
+                stat = None
+
+            if stat is None:
+                if row is not None:
+                    logger.info(f"Scrubber: {path} not found in snapshot folder{self._action('deleting from db')}")
+                    if self.settings.scrubber_repair:
+                        get_writer(db_path).write(lambda conn: self._delete_row(conn, path))
+                    self.stats.orphan_rows_deleted += 1
+            elif metadata is not None and is_unchanged(
+                stat, metadata.file_size, datetime_to_ns(metadata.last_modified)
+            ):
+                self._check_row(db_path, row, metadata, abs_path)
+            # otherwise the file was written while it was hashed, it is checked again in the next pass
+
+        # throttle outside of the lock, so writes to the path are not blocked
+        if metadata is not None:
+            self._stop.wait(metadata.file_size / self.settings.scrubber_io_budget)
+
+    def _check_row(self, db_path: Path, row: Optional[FileMetadata], metadata: FileMetadata, abs_path: Path) -> None:
+        path = metadata.path
+        if row is not None and (row.hash, row.file_size, row.last_modified) == (
+            metadata.hash,
+            metadata.file_size,
+            metadata.last_modified,
+        ):
+            return
+        if row is None:
+            logger.info(f"Scrubber: {path} has no metadata{self._action('adding to db')}")
+            self.stats.orphan_files_added += 1
+        else:
+            logger.info(f"Scrubber: metadata of {path} does not match the snapshot folder{self._action('updating db')}")
+            self.stats.files_repaired += 1
+        if self.settings.scrubber_repair:
+            self._add_row(db_path, metadata, abs_path)
+
+    def _action(self, repair: str) -> str:
+        return f", {repair}" if self.settings.scrubber_repair else ", not repaired (scrubber_repair is disabled)"
+
+    def _add_row(self, db_path: Path, metadata: FileMetadata, abs_path: Path) -> None:
+        datasite = metadata.path.parts[0]
+        if self.settings.shard_db_by_datasite and datasite not in FileStore(self.settings).list_datasites():
+            get_writer(self.settings.file_db_path).write(lambda conn: db.add_catalog_datasite(conn, datasite))
+        get_writer(db_path).write(lambda conn: self._save_row(conn, metadata, abs_path))
+
+    def _delete_row(self, conn: sqlite3.Connection, path: Path) -> None:
+        db.delete_file_metadata(conn, path.as_posix())
+        if path.name == PERM_FILE:
+            db.set_rules_for_permfile(conn, SyftPermission(relative_filepath=path, rules=[]))
+
+    def _save_row(self, conn: sqlite3.Connection, metadata: FileMetadata, abs_path: Path) -> None:
+        db.save_file_metadata(conn, metadata)
+        if metadata.path.name == PERM_FILE:
+            try:
+                permfile = SyftPermission.from_bytes(abs_path.read_bytes(), metadata.path)
+                db.set_rules_for_permfile(conn, permfile)
+            except (yaml.YAMLError, ValueError) as e:
+                logger.warning(f"Scrubber: invalid permission file {metadata.path}, rules not updated: {e}")
+        db.link_existing_rules_to_file(conn, metadata.path)
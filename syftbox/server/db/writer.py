@@ -0,0 +1,125 @@
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Callable, Optional, TypeVar, Union
+
+from loguru import logger
+
+from syftbox.server.db.schema import get_db
+
+T = TypeVar("T")
+WriteFn = Callable[[sqlite3.Connection], T]
+
+
+class DBWriter:
+    """
+    Single writer for a SQLite database, with group commit.
+
+    All writes are queued and executed by one thread on its own connection. The writer drains the queue
+    and commits everything it drained in a single transaction, so concurrent writers never contend on the
+    SQLite write lock and pay for one commit per batch instead of one per write.
+
+    If a write in a batch fails, the batch is rolled back and every write is retried in its own transaction,
+    so a failing write only fails its own caller.
+    """
+
+    def __init__(self, db_path: Union[Path, str], max_batch_size: int = 256) -> None:
+        self.db_path = db_path
+        self.max_batch_size = max_batch_size
+        self._queue: queue.Queue[Optional[tuple[WriteFn, Future]]] = queue.Queue()
+        self._closed = False
+        self._close_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="syftbox-db-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn: WriteFn[T]) -> "Future[T]":
+        """Queue `fn(connection)` for the next batch. The future resolves once the batch is committed."""
+        future: Future[T] = Future()
+        with self._close_lock:
+            if self._closed:
+                raise RuntimeError(f"DBWriter for {self.db_path} is closed")
+            self._queue.put((fn, future))
+        return future
+
+    def write(self, fn: WriteFn[T]) -> T:
+        """Queue `fn(connection)` and block until it is committed, exceptions raised by `fn` are re-raised."""
+        return self.submit(fn).result()
+
+    def close(self) -> None:
+        """Commit all queued writes and stop the writer thread."""
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        conn = get_db(self.db_path)
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                batch = [item]
+                while len(batch) < self.max_batch_size:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        self._commit_batch(conn, batch)
+                        return
+                    batch.append(item)
+                self._commit_batch(conn, batch)
+        finally:
+            conn.close()
+
+    def _commit_batch(self, conn: sqlite3.Connection, batch: list[tuple[WriteFn, Future]]) -> None:
+        try:
+            conn.execute("BEGIN IMMEDIATE;")
+            results = [fn(conn) for fn, _ in batch]
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            logger.debug(f"Batch of {len(batch)} writes failed, retrying writes individually. Reason: {e}")
+            for item in batch:
+                self._commit_batch(conn, [item])
+            return
+
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+
+_writers: dict[str, DBWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(db_path: Union[Path, str]) -> DBWriter:
+    """Get the writer for a database, there is a single writer per database in the process."""
+    key = str(db_path)
+    with _writers_lock:
+        if key not in _writers:
+            _writers[key] = DBWriter(db_path)
+        return _writers[key]
+
+
+def close_writer(db_path: Union[Path, str]) -> None:
+    with _writers_lock:
+        writer = _writers.pop(str(db_path), None)
+    if writer is not None:
+        writer.close()
+
+
+def close_writers(folder: Union[Path, str]) -> None:
+    """Close the writers of all databases in `folder`."""
+    with _writers_lock:
+        paths = [path for path in _writers if Path(folder) in Path(path).parents]
+    for path in paths:
+        close_writer(path)
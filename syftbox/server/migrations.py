@@ -1,61 +1,105 @@
+from collections import defaultdict
+from concurrent.futures import Executor, ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+
 import yaml
 from loguru import logger
 
-from syftbox import __version__
 from syftbox.lib.constants import PERM_FILE
-from syftbox.lib.hash import collect_files, hash_files
+from syftbox.lib.hash import collect_files, hash_files_parallel, is_unchanged
 from syftbox.lib.permissions import SyftPermission, migrate_permissions
 from syftbox.server.db import db
 from syftbox.server.db.schema import get_db
 from syftbox.server.server import create_folders
 from syftbox.server.settings import ServerSettings
 
+# files are hashed and saved in batches, each batch is committed on its own so an interrupted
+# migration keeps its progress and the next run only hashes the remaining files
+MIGRATION_BATCH_SIZE = 1000
+
 
-def run_migrations(settings: ServerSettings):
+def run_migrations(settings: ServerSettings, workers: Optional[int] = None):
     logger.info("Creating folders")
     create_folders(settings.folders)
     logger.info("Initializing DB")
-    init_db(settings)
+    init_db(settings, workers=workers)
+
 
+def init_db(settings: ServerSettings, workers: Optional[int] = None) -> None:
+    """Rebuild the file metadata and permission tables from the snapshot folder.
 
-def init_db(settings: ServerSettings) -> None:
-    # remove this after the upcoming release
-    if __version__ in ["0.2.11", "0.2.12"]:
-        # Delete existing DB to avoid conflicts
-        db_path = settings.file_db_path.absolute()
-        if db_path.exists():
-            db_path.unlink()
+    Files with the same size and mtime as their row in the database are not hashed again,
+    the rest are hashed with a pool of `workers` processes (defaults to the number of CPUs).
+    """
     migrate_permissions(settings.snapshot_folder)
 
-    # might take very long as snapshot folder grows
-    logger.info(f"> Collecting Files from {settings.snapshot_folder.absolute()}")
-    files = collect_files(settings.snapshot_folder.absolute())
-    logger.info("> Hashing files")
-    metadata = hash_files(files, settings.snapshot_folder)
-    logger.info(f"> Updating file hashes at {settings.file_db_path.absolute()}")
-    con = get_db(settings.file_db_path.absolute())
-    cur = con.cursor()
-    for m in metadata:
-        db.save_file_metadata(cur, m)
-
-    # remove files that are not in the snapshot folder
-    all_metadata = db.get_all_metadata(cur)
-    for m in all_metadata:
-        abs_path = settings.snapshot_folder / m.path
-        if not abs_path.exists():
-            logger.info(f"{m.path} not found in {settings.snapshot_folder}, deleting from db")
-            db.delete_file_metadata(cur, m.path.as_posix())
-
-    # fill the permission tables
-    for file in settings.snapshot_folder.rglob(PERM_FILE):
-        content = file.read_text()
-        rule_dicts = yaml.safe_load(content)
-        perm_file = SyftPermission.from_rule_dicts(
-            permfile_file_path=file.relative_to(settings.snapshot_folder), rule_dicts=rule_dicts
-        )
-        db.set_rules_for_permfile(con, perm_file)
-        db.link_existing_rules_to_file(con, file.relative_to(settings.snapshot_folder))
-
-    cur.close()
-    con.commit()
+    snapshot_folder = settings.snapshot_folder.absolute()
+    logger.info(f"> Collecting Files from {snapshot_folder}")
+    files = [file.relative_to(snapshot_folder) for file in collect_files(snapshot_folder)]
+    logger.info(f"> Found {len(files)} files")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if not settings.shard_db_by_datasite:
+            update_db(settings, settings.file_db_path.absolute(), files, executor)
+            return
+
+        # one database per datasite, and a catalog of all datasites in the main database
+        files_by_datasite = defaultdict(list)
+        for file in files:
+            files_by_datasite[file.parts[0]].append(file)
+
+        con = get_db(settings.file_db_path.absolute())
+        datasites = set(db.get_catalog_datasites(con)) | files_by_datasite.keys()
+        for datasite in sorted(datasites):
+            update_db(settings, settings.datasite_db_path(datasite), files_by_datasite[datasite], executor)
+            db.add_catalog_datasite(con, datasite)
+        con.commit()
+        con.close()
+
+
+def update_db(settings: ServerSettings, db_path: Path, files: list[Path], executor: Executor) -> None:
+    """Sync the database at `db_path` with `files`, paths relative to the snapshot folder."""
+    snapshot_folder = settings.snapshot_folder.absolute()
+    logger.info(f"> Updating file hashes at {db_path}")
+    con = get_db(db_path)
+    file_stats = db.get_file_stats(con)
+
+    changed_files = []
+    for file in files:
+        try:
+            stat = (snapshot_folder / file).stat()
+        except OSError:
+            continue
+        stored = file_stats.get(file.as_posix())
+        if stored is None or not is_unchanged(stat, *stored):
+            changed_files.append(file)
+    logger.info(f"> {len(files) - len(changed_files)} files unchanged, hashing {len(changed_files)} files")
+
+    for start in range(0, len(changed_files), MIGRATION_BATCH_SIZE):
+        batch = changed_files[start : start + MIGRATION_BATCH_SIZE]
+        metadata = hash_files_parallel([snapshot_folder / file for file in batch], snapshot_folder, executor)
+        with con:
+            db.save_many_file_metadata(con, metadata)
+        logger.info(f"> Hashed {start + len(batch)}/{len(changed_files)} files")
+
+    with con:
+        # remove files that are not in the snapshot folder
+        collected = {file.as_posix() for file in files}
+        for path in file_stats.keys() - collected:
+            if not (snapshot_folder / path).exists():
+                logger.info(f"{path} not found in {snapshot_folder}, deleting from db")
+                db.delete_file_metadata(con, path)
+                if Path(path).name == PERM_FILE:
+                    db.set_rules_for_permfile(con, SyftPermission(relative_filepath=Path(path), rules=[]))
+
+        # fill the permission tables
+        for perm_file_path in files:
+            if perm_file_path.name != PERM_FILE:
+                continue
+            content = (snapshot_folder / perm_file_path).read_text()
+            rule_dicts = yaml.safe_load(content)
+            perm_file = SyftPermission.from_rule_dicts(permfile_file_path=perm_file_path, rule_dicts=rule_dicts)
+            db.set_rules_for_permfile(con, perm_file)
+            db.link_existing_rules_to_file(con, perm_file_path)
     con.close()
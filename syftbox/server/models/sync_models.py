@@ -1,12 +1,26 @@
 import base64
 import enum
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from typing import Annotated, Any, Optional
 
 from pydantic import AfterValidator, BaseModel, Field
 
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+SHA256_PATTERN = "^[0-9a-f]{64}$"
+
+
+def datetime_to_ns(dt: datetime) -> int:
+    """Nanoseconds since the epoch, naive datetimes are UTC."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return (dt - EPOCH) // timedelta(microseconds=1) * 1000
+
+
+def ns_to_datetime(ns: int) -> datetime:
+    return EPOCH + timedelta(microseconds=ns // 1000)
+
 
 def should_be_relative(v):
     if v.is_absolute():
@@ -85,6 +99,53 @@ class ApplyDiffResponse(BaseModel):
     previous_hash: str
 
 
+class BatchApplyDiffRequest(BaseModel):
+    diffs: list[ApplyDiffRequest]
+
+
+class BatchResult(BaseModel):
+    path: Path
+    status_code: int = Field(description="Status the file would get from the single file endpoint, 200 on success")
+    detail: Optional[str] = None
+
+
+class BatchResponse(BaseModel):
+    results: list[BatchResult]
+
+
+class ChunkInfo(BaseModel):
+    offset: int
+    size: int
+    # chunks are staged under their hash, so anything but a sha256 hex digest is rejected before a path is built
+    hash: str = Field(pattern=SHA256_PATTERN, description="sha256 of the chunk")
+
+
+class ChunkManifest(BaseModel):
+    path: RelativePath
+    hash: str
+    file_size: int
+    chunks: list[ChunkInfo]
+
+
+class ChunkRequest(BaseModel):
+    path: RelativePath
+    hash: str = Field(description="Hash of the file the chunk belongs to")
+    index: int = Field(ge=0)
+
+
+class CommitChunksRequest(BaseModel):
+    path: RelativePath
+    expected_hash: str
+    chunks: list[ChunkInfo] = Field(description="Chunks of the new file, in order")
+
+
+class CommitChunksResponse(BaseModel):
+    path: RelativePath
+    current_hash: Optional[str] = Field(default=None, description="Hash of the new file, None if nothing was written")
+    previous_hash: Optional[str] = None
+    missing_chunks: list[str] = Field(default_factory=list, description="Hashes of chunks that must be uploaded first")
+
+
 class FileMetadata(BaseModel):
     path: Path
     hash: str
@@ -98,12 +159,13 @@ class FileMetadata(BaseModel):
 
     @staticmethod
     def from_row(row: sqlite3.Row) -> "FileMetadata":
-        return FileMetadata(
+        # rows are trusted, skip validation on the hot read paths
+        return FileMetadata.model_construct(
             path=Path(row["path"]),
-            hash=row["hash"],
+            hash=row["hash"].hex(),
             signature=row["signature"],
             file_size=row["file_size"],
-            last_modified=row["last_modified"],
+            last_modified=ns_to_datetime(row["last_modified"]),
         )
 
     @property
@@ -124,6 +186,40 @@ class FileMetadata(BaseModel):
         return self.path == value.path and self.hash == value.hash
 
 
+class DatasiteStateResponse(BaseModel):
+    """A single line of the NDJSON /sync/datasite_states response."""
+
+    datasite: str
+    files: list[FileMetadata]
+    contents: dict[Path, str] = Field(default_factory=dict, description="b85 encoded contents of small files")
+
+
+class TreeEntry(BaseModel):
+    """A child of a directory in a Merkle tree, files include their metadata."""
+
+    name: str
+    hash: str
+    is_dir: bool
+    metadata: Optional[FileMetadata] = None
+
+
+class TreeNodeResponse(BaseModel):
+    """A directory in a Merkle tree with its rollup hash and direct children, see `syftbox.lib.merkle`."""
+
+    path: Path
+    hash: str
+    children: list[TreeEntry]
+    contents: dict[Path, str] = Field(default_factory=dict, description="b85 encoded contents of small files")
+
+
+class SubscriptionList(BaseModel):
+    """Selective sync subscriptions of a user, see `syftbox.lib.subscriptions`."""
+
+    paths: list[RelativePath] = Field(
+        default_factory=list, description="Subscribed datasites and directories, empty to subscribe to everything"
+    )
+
+
 class SyncLog(BaseModel):
     path: Path
     method: str  # pull or push
@@ -1,9 +1,11 @@
 import contextlib
 import os
 import platform
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
+import anyio.to_thread
 from fastapi import Depends, FastAPI, Request
 from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import (
@@ -33,6 +35,8 @@ from syftbox.lib.lib import (
     get_datasites,
 )
 from syftbox.server.analytics import log_analytics_event
+from syftbox.server.db.scrubber import ScrubberStats, SnapshotScrubber
+from syftbox.server.db.writer import close_writers
 from syftbox.server.logger import setup_logger
 from syftbox.server.middleware import LoguruMiddleware
 from syftbox.server.settings import ServerSettings, get_server_settings
@@ -90,11 +94,26 @@ async def lifespan(app: FastAPI, settings: Optional[ServerSettings] = None):
     else:
         logger.info("OTel Exporter is DISABLED")
 
+    # sync endpoints run on the default anyio thread pool,
+    # async endpoints run blocking database and file I/O on a dedicated executor
+    anyio.to_thread.current_default_thread_limiter().total_tokens = settings.threadpool_size
+    db_executor = ThreadPoolExecutor(max_workers=settings.db_pool_size, thread_name_prefix="syftbox-db")
+
+    scrubber = SnapshotScrubber(settings)
+    scrubber.stats.enabled = settings.scrubber_enabled
+    if settings.scrubber_enabled:
+        scrubber.start()
+
     yield {
         "server_settings": settings,
+        "db_executor": db_executor,
+        "scrubber": scrubber,
     }
 
     logger.info("Shutting down server")
+    scrubber.stop()
+    db_executor.shutdown(wait=True)
+    close_writers(settings.data_folder)
 
 
 app = FastAPI(lifespan=lifespan)
@@ -284,3 +303,8 @@ async def info():
     return {
         "version": __version__,
     }
+
+
+@app.get("/info/scrubber", response_model=ScrubberStats)
+async def scrubber_info(request: Request):
+    return request.state.scrubber.stats
@@ -57,6 +57,55 @@ class ServerSettings(BaseSettings):
     otel_enabled: bool = False
     """Enable/Disable OpenTelemetry tracing"""
 
+    threadpool_size: int = Field(default=40, ge=1)
+    """Number of threads that run the sync (`def`) endpoints"""
+
+    db_pool_size: int = Field(default=8, ge=1)
+    """Number of threads that async endpoints use for database and snapshot I/O"""
+
+    shard_db_by_datasite: bool = False
+    """Store the file metadata of every datasite in its own database, `file.db` only keeps a catalog of datasites"""
+
+    fsync_writes: bool = True
+    """Flush written files to disk before their metadata is committed"""
+
+    chunk_dedup_enabled: bool = False
+    """
+    Reuse chunks of any file on the server when large files are uploaded in chunks, so chunks the server already has
+    are never uploaded again. Lets users confirm that a chunk exists somewhere on the server, even in files they
+    cannot read.
+    """
+
+    chunk_staging_max_bytes: int = Field(default=1024 * 1024 * 1024, ge=0)
+    """Bytes of uploaded, uncommitted chunks a user can stage, further chunk uploads are rejected"""
+
+    chunk_staging_ttl: timedelta = timedelta(hours=24)
+    """Staged chunks that are not committed within this time are deleted"""
+
+    inline_content_max_size: int = Field(default=4096, ge=0)
+    """
+    Largest file whose content is included in listings for clients that ask for it, so small files are synced without
+    extra requests. 0 disables inlining.
+    """
+
+    scrubber_enabled: bool = True
+    """Periodically check the snapshot folder against the file metadata in the background, and expire staged chunks"""
+
+    scrubber_repair: bool = False
+    """Repair the file metadata of files that differ from the snapshot folder, differences are only reported if False"""
+
+    scrubber_interval: timedelta = timedelta(hours=1)
+    """Time between scrubber passes, the first pass starts one interval after startup"""
+
+    scrubber_io_budget: int = Field(default=10_000_000, ge=1)
+    """Bytes per second the scrubber may read from the snapshot folder to hash files"""
+
+    scrubber_files_per_second: int = Field(default=10_000, ge=1)
+    """Files per second the scrubber may list and stat while walking the snapshot folder"""
+
+    scrubber_sample_rate: float = Field(default=0.01, ge=0, le=1)
+    """Fraction of unchanged files whose hash is verified in every scrubber pass"""
+
     @field_validator("data_folder", mode="after")
     def data_folder_abs(cls, v):
         return Path(v).expanduser().resolve()
@@ -80,12 +129,19 @@ class ServerSettings(BaseSettings):
 
     @property
     def folders(self) -> list[Path]:
+        if self.shard_db_by_datasite:
+            return [self.data_folder, self.snapshot_folder, self.datasite_db_folder]
         return [self.data_folder, self.snapshot_folder]
 
     @property
     def snapshot_folder(self) -> Path:
         return self.data_folder / "snapshot"
 
+    @property
+    def chunk_staging_folder(self) -> Path:
+        """Chunks of large files that were uploaded but not yet committed, per user"""
+        return self.data_folder / "chunk_staging"
+
     @property
     def logs_folder(self) -> Path:
         return self.data_folder / "logs"
@@ -105,6 +161,16 @@ class ServerSettings(BaseSettings):
     def file_db_path(self) -> Path:
         return self.data_folder / "file.db"
 
+    @property
+    def datasite_db_folder(self) -> Path:
+        return self.data_folder / "datasite_dbs"
+
+    def datasite_db_path(self, datasite: str) -> Path:
+        """Database with the file metadata of `datasite` if `shard_db_by_datasite` is set, else the main database."""
+        if not self.shard_db_by_datasite:
+            return self.file_db_path
+        return self.datasite_db_folder / f"{datasite}.db"
+
     def read(self, path: Path) -> bytes:
         with open(self.snapshot_folder / path, "rb") as f:
             return f.read()
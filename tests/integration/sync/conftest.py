@@ -70,17 +70,17 @@ def server_app_with_lifespan(tmp_path: Path) -> FastAPI:
 
 
 @pytest.fixture()
-def datasite_1(tmp_path: Path, server_app_with_lifespan: FastAPI) -> SyftClientInterface:
+def datasite_1(tmp_path: Path, server_app_with_lifespan: FastAPI) -> Generator[SyftClientInterface, None, None]:
     email = "user_1@openmined.org"
     with TestClient(server_app_with_lifespan) as client:
-        return setup_datasite(tmp_path, client, email)
+        yield setup_datasite(tmp_path, client, email)
 
 
 @pytest.fixture()
-def datasite_2(tmp_path: Path, server_app_with_lifespan: FastAPI) -> SyftClientInterface:
+def datasite_2(tmp_path: Path, server_app_with_lifespan: FastAPI) -> Generator[SyftClientInterface, None, None]:
     email = "user_2@openmined.org"
     with TestClient(server_app_with_lifespan) as client:
-        return setup_datasite(tmp_path, client, email)
+        yield setup_datasite(tmp_path, client, email)
 
 
 @pytest.fixture(scope="function")
@@ -1,11 +1,13 @@
 from pathlib import Path
 
+import pytest
+
 from syftbox.client.base import SyftClientInterface
 from syftbox.client.plugins.sync.datasite_state import DatasiteState
 from syftbox.client.plugins.sync.sync_client import SyncClient
 from syftbox.client.utils.dir_tree import create_dir_tree
 from syftbox.client.utils.display import display_file_tree
-from syftbox.lib.ignore import IGNORE_FILENAME, filter_ignored_paths
+from syftbox.lib.ignore import IGNORE_FILENAME, IgnoreMatcher, filter_ignored_paths
 
 ignore_file = """
 # Exlude alice datasite
@@ -126,3 +128,37 @@ def test_ignore_hidden_files(datasite_1: SyftClientInterface) -> None:
 
     filtered_paths = filter_ignored_paths(datasite_1.workspace.datasites, paths, ignore_hidden_files=True)
     assert filtered_paths == [Path("visible_file.txt")]
+
+
+def test_ignore_matcher(tmp_path, monkeypatch):
+    matcher = IgnoreMatcher(tmp_path)
+    assert matcher.rules is None
+
+    (tmp_path / IGNORE_FILENAME).write_text(ignore_file)
+    rules = matcher.rules
+    assert rules is not None
+
+    # rules are only compiled again when the ignore file changes
+    monkeypatch.setattr("syftbox.lib.ignore.get_ignore_rules", lambda _: pytest.fail("rules were reloaded"))
+    assert matcher.rules is rules
+    monkeypatch.undo()
+    (tmp_path / IGNORE_FILENAME).write_text(ignore_file + "\n*.pdf\n")
+    assert matcher.rules is not rules
+
+    (tmp_path / "target").mkdir()
+    (tmp_path / "john@example.com").mkdir()
+    (tmp_path / "john@example.com" / "link").symlink_to(tmp_path / "target")
+    paths = [
+        Path("john@example.com/docs/file.txt"),
+        Path("john@example.com/.hidden/file.txt"),
+        Path("john@example.com/link/a/file.txt"),
+        Path("john@example.com/link/b/file.txt"),
+        Path("john@example.com/docs/file.syftrejected.txt"),
+        Path("john@example.com/docs/file.pdf"),
+    ]
+    result = matcher.classify(paths)
+    assert result.included == paths[:1]
+    assert result.hidden == paths[1:2]
+    assert result.symlinks == paths[2:4]
+    assert result.rejected == paths[4:5]
+    assert result.ignored == paths[5:]
@@ -1,4 +1,6 @@
+import hashlib
 import os
+import random
 import shutil
 import time
 from pathlib import Path
@@ -8,13 +10,19 @@ import pytest
 import yaml
 from fastapi.testclient import TestClient
 
+import syftbox.client.plugins.sync.consumer
+import syftbox.client.plugins.sync.local_snapshot
+import syftbox.client.plugins.sync.sync_action
+import syftbox.lib.hash
 from syftbox.client.base import SyftClientInterface
-from syftbox.client.plugins.sync.constants import MAX_FILE_SIZE_MB
 from syftbox.client.plugins.sync.datasite_state import DatasiteState
 from syftbox.client.plugins.sync.exceptions import FatalSyncError
 from syftbox.client.plugins.sync.manager import SyncManager
 from syftbox.client.plugins.sync.queue import SyncQueueItem
+from syftbox.client.plugins.sync.sync_client import SyncClient
+from syftbox.client.plugins.sync.types import SyncStatus
 from syftbox.client.utils.dir_tree import DirTree, create_dir_tree
+from syftbox.lib.chunks import CHUNK_SIZE
 from syftbox.lib.constants import PERM_FILE
 from syftbox.lib.permissions import SyftPermission
 from syftbox.server.settings import ServerSettings
@@ -141,6 +149,72 @@ def test_create_file(server_client: TestClient, datasite_1: SyftClientInterface,
     assert_files_on_datasite(datasite_2, [Path(datasite_1.email) / "folder1" / "file.txt"])
 
 
+def test_create_files_in_bulk(server_client: TestClient, datasite_1: SyftClientInterface, monkeypatch):
+    server_settings: ServerSettings = server_client.app_state["server_settings"]
+    sync_service = SyncManager(datasite_1)
+    monkeypatch.setattr(syftbox.client.plugins.sync.consumer, "BATCH_MAX_FILES", 20)
+    create_calls, bulk_calls = [], []
+    create, upload_bulk = sync_service.sync_client.create, sync_service.sync_client.upload_bulk
+    monkeypatch.setattr(
+        sync_service.sync_client,
+        "create",
+        lambda path, data: create_calls.append(path) or create(path, data),
+    )
+    monkeypatch.setattr(
+        sync_service.sync_client,
+        "upload_bulk",
+        lambda files, hashes: bulk_calls.append(len(files)) or upload_bulk(files, hashes),
+    )
+
+    tree = {"project": {f"file_{i}.txt": fake.text(max_nb_chars=100) for i in range(50)}}
+    create_dir_tree(Path(datasite_1.my_datasite), tree)
+    sync_service.run_single_thread()
+
+    # permission files are created on their own, small files in batches
+    assert all(SyftPermission.is_permission_file(path) for path in create_calls)
+    assert sorted(bulk_calls) == [10, 20, 20]
+    assert_dirtree_exists(server_settings.snapshot_folder / datasite_1.email, tree)
+    for i in range(50):
+        path = Path(datasite_1.email) / "project" / f"file_{i}.txt"
+        assert (
+            sync_service.local_state.states[path].hash
+            == hashlib.sha256((datasite_1.my_datasite / "project" / f"file_{i}.txt").read_bytes()).hexdigest()
+        )
+
+
+def test_modify_and_delete_in_batches(server_client: TestClient, datasite_1: SyftClientInterface, monkeypatch):
+    server_settings: ServerSettings = server_client.app_state["server_settings"]
+    sync_service = SyncManager(datasite_1)
+    tree = {"outputs": {f"file_{i}.txt": fake.text(max_nb_chars=100) for i in range(30)}}
+    create_dir_tree(Path(datasite_1.my_datasite), tree)
+    sync_service.run_single_thread()
+
+    calls = []
+    for method in ["apply_diff", "apply_diff_bulk", "delete", "delete_bulk"]:
+        original = getattr(sync_service.sync_client, method)
+        monkeypatch.setattr(
+            sync_service.sync_client,
+            method,
+            lambda *args, method=method, original=original: calls.append(method) or original(*args),
+        )
+
+    outputs_dir = datasite_1.my_datasite / "outputs"
+    for i in range(30):
+        (outputs_dir / f"file_{i}.txt").write_text(f"modified {i}")
+    sync_service.run_single_thread()
+    assert calls == ["apply_diff_bulk"]
+    for i in range(30):
+        assert (server_settings.snapshot_folder / datasite_1.email / "outputs" / f"file_{i}.txt").read_text() == (
+            f"modified {i}"
+        )
+
+    shutil.rmtree(outputs_dir)
+    sync_service.run_single_thread()
+    assert calls == ["apply_diff_bulk", "delete_bulk"]
+    assert not list((server_settings.snapshot_folder / datasite_1.email / "outputs").glob("*.txt"))
+    assert not any(path.parts[1] == "outputs" for path in sync_service.local_state.states)
+
+
 def test_modify(server_client: TestClient, datasite_1: SyftClientInterface):
     server_settings: ServerSettings = server_client.app_state["server_settings"]
     sync_service_1 = SyncManager(datasite_1)
@@ -201,6 +275,237 @@ def test_modify_and_pull(server_client: TestClient, datasite_1: SyftClientInterf
     assert (Path(datasite_2.workspace.datasites) / datasite_1.email / "folder1" / "file.txt").read_text() == new_content
 
 
+def test_pull_inlined_small_files(
+    server_client: TestClient, datasite_1: SyftClientInterface, datasite_2: SyftClientInterface, monkeypatch
+):
+    sync_service_1 = SyncManager(datasite_1)
+    sync_service_2 = SyncManager(datasite_2)
+    calls = []
+    for method in ["download", "download_bulk", "get_diff", "get_metadata"]:
+        original = getattr(sync_service_2.sync_client, method)
+        monkeypatch.setattr(
+            sync_service_2.sync_client,
+            method,
+            lambda *args, method=method, original=original: calls.append((method, args)) or original(*args),
+        )
+
+    tree = {
+        "api_data": {
+            PERM_FILE: SyftPermission.mine_with_public_rw(datasite_1, dir=datasite_1.my_datasite / "api_data"),
+            "request.json": '{"status": "pending"}',
+        },
+    }
+    create_dir_tree(Path(datasite_1.my_datasite), tree)
+    sync_service_1.run_single_thread()
+
+    # small files are written from the listings, without requesting them
+    sync_service_2.run_single_thread()
+    remote_file = Path(datasite_2.workspace.datasites) / datasite_1.email / "api_data" / "request.json"
+    assert remote_file.read_text() == '{"status": "pending"}'
+
+    (datasite_1.my_datasite / "api_data" / "request.json").write_text('{"status": "done"}')
+    sync_service_1.run_single_thread()
+    sync_service_2.run_single_thread()
+    assert remote_file.read_text() == '{"status": "done"}'
+    # only the own datasite of datasite_2 is requested, it is pushed to the server
+    requested = [args[0] for _, args in calls]
+    assert all(isinstance(path, Path) and path.parts[0] == datasite_2.email for path in requested)
+
+
+def test_selective_sync(server_client: TestClient, datasite_1: SyftClientInterface, datasite_2: SyftClientInterface):
+    sync_service_1 = SyncManager(datasite_1)
+    sync_service_2 = SyncManager(datasite_2)
+    tree = {
+        PERM_FILE: SyftPermission.mine_with_public_read(datasite_1, dir=datasite_1.my_datasite),
+        "app": {"a.txt": "a"},
+        "other": {"b.txt": "b"},
+    }
+    create_dir_tree(Path(datasite_1.my_datasite), tree)
+    sync_service_1.run_single_thread()
+    sync_service_2.run_single_thread()
+    app_file = datasite_2.workspace.datasites / datasite_1.email / "app" / "a.txt"
+    other_file = datasite_2.workspace.datasites / datasite_1.email / "other" / "b.txt"
+    assert app_file.read_text() == "a"
+    assert other_file.read_text() == "b"
+
+    sync_service_2.sync_client.set_subscriptions([Path(datasite_1.email) / "app"])
+    (datasite_1.my_datasite / "app" / "a.txt").write_text("a2")
+    (datasite_1.my_datasite / "other" / "b.txt").write_text("b2")
+    sync_service_1.run_single_thread()
+    for _ in range(2):
+        sync_service_2.run_single_thread()
+
+    # unsubscribed files are not updated, and their local copies are kept
+    assert app_file.read_text() == "a2"
+    assert other_file.read_text() == "b"
+    # unsubscribed local files are not compared with the server
+    datasite_state = DatasiteState(sync_service_2.sync_client, datasite_1.email)
+    assert datasite_state.get_datasite_changes().files == []
+
+    # the own datasite is always synced
+    (datasite_2.my_datasite / "mine.txt").write_text("mine")
+    sync_service_2.run_single_thread()
+    assert sync_service_2.sync_client.get_metadata(Path(datasite_2.email) / "mine.txt").file_size == 4
+
+
+def test_placeholders(server_client: TestClient, datasite_1: SyftClientInterface, datasite_2: SyftClientInterface):
+    sync_service_1 = SyncManager(datasite_1)
+    sync_service_2 = SyncManager(datasite_2)
+    sync_service_2.set_placeholders_enabled(True)
+    tree = {
+        PERM_FILE: SyftPermission.mine_with_public_rw(datasite_1, dir=datasite_1.my_datasite),
+        "data": {"a.txt": "a", "b.txt": "b"},
+    }
+    create_dir_tree(Path(datasite_1.my_datasite), tree)
+    sync_service_1.run_single_thread()
+    for _ in range(2):
+        sync_service_2.run_single_thread()
+
+    # only the metadata of files in other datasites is synced, permission files are downloaded
+    datasites_2 = datasite_2.workspace.datasites
+    a_path, b_path = Path(datasite_1.email) / "data" / "a.txt", Path(datasite_1.email) / "data" / "b.txt"
+    assert sorted(sync_service_2.placeholders.files) == [a_path, b_path]
+    assert not (datasites_2 / datasite_1.email / "data").exists()
+    assert (datasites_2 / datasite_1.email / PERM_FILE).exists()
+
+    # unchanged placeholders are part of the local Merkle tree, nothing is listed
+    listed = []
+    original_get_remote_state = sync_service_2.sync_client.get_remote_state
+    sync_service_2.sync_client.get_remote_state = lambda path: listed.append(path) or original_get_remote_state(path)
+    sync_service_2.run_single_thread()
+    assert listed == []
+
+    assert sync_service_2.materialize(a_path) == [a_path]
+    assert (datasites_2 / a_path).read_text() == "a"
+    assert list(sync_service_2.placeholders.files) == [b_path]
+
+    # materialized files are kept in sync, placeholders are updated
+    (datasite_1.my_datasite / "data" / "a.txt").write_text("a2")
+    (datasite_1.my_datasite / "data" / "b.txt").write_text("b2")
+    sync_service_1.run_single_thread()
+    sync_service_2.run_single_thread()
+    assert (datasites_2 / a_path).read_text() == "a2"
+    assert sync_service_2.placeholders.files[b_path].hash == hashlib.sha256(b"b2").hexdigest()
+    assert not (datasites_2 / b_path).exists()
+
+    # evicted files become placeholders again, the remote file is kept
+    assert sync_service_2.evict(a_path) == [a_path]
+    assert not (datasites_2 / a_path).exists()
+    for _ in range(2):
+        sync_service_2.run_single_thread()
+    assert not (datasites_2 / a_path).exists()
+    assert sorted(sync_service_2.placeholders.files) == [a_path, b_path]
+    assert sync_service_1.sync_client.get_metadata(a_path).hash == hashlib.sha256(b"a2").hexdigest()
+
+    # new files under pinned directories are downloaded
+    sync_service_2.materialize(Path(datasite_1.email) / "data", pin=True)
+    assert sync_service_2.placeholders.files == {}
+    assert sync_service_2.evict(a_path) == []
+    (datasite_1.my_datasite / "data" / "c.txt").write_text("c")
+    sync_service_1.run_single_thread()
+    sync_service_2.run_single_thread()
+    assert (datasites_2 / datasite_1.email / "data" / "c.txt").read_text() == "c"
+
+
+def test_pulled_files_are_not_rehashed(
+    server_client: TestClient, datasite_1: SyftClientInterface, datasite_2: SyftClientInterface, monkeypatch
+):
+    sync_service_1 = SyncManager(datasite_1)
+    sync_service_2 = SyncManager(datasite_2)
+    tree = {
+        "folder1": {
+            PERM_FILE: SyftPermission.mine_with_public_rw(datasite_1, dir=datasite_1.my_datasite / "folder1"),
+            "file.txt": "content1",
+        },
+    }
+    create_dir_tree(Path(datasite_1.my_datasite), tree)
+    sync_service_1.run_single_thread()
+    sync_service_2.run_single_thread()
+
+    file_path = datasite_1.my_datasite / "folder1" / "file.txt"
+    file_path.write_text(fake.text(max_nb_chars=10_000))
+    sync_service_1.run_single_thread()
+    sync_service_2.run_single_thread()
+
+    # files written by sync are in the hash cache, the next sync does not hash them again
+    hashed = []
+    hash_file = syftbox.lib.hash.hash_file
+    monkeypatch.setattr(
+        syftbox.lib.hash, "hash_file", lambda path, *args: hashed.append(path) or hash_file(path, *args)
+    )
+    sync_service_2.run_single_thread()
+    pulled_folder = datasite_2.workspace.datasites / datasite_1.email / "folder1"
+    assert not any(pulled_folder in path.parents for path in hashed)
+    assert (pulled_folder / "file.txt").read_text() == file_path.read_text()
+
+    # no temporary files are left behind
+    assert sorted(p.name for p in pulled_folder.iterdir()) == sorted(["file.txt", PERM_FILE])
+
+
+def test_sync_large_file_in_chunks(
+    server_client: TestClient, datasite_1: SyftClientInterface, datasite_2: SyftClientInterface, monkeypatch
+):
+    server_settings: ServerSettings = server_client.app_state["server_settings"]
+    sync_service_1 = SyncManager(datasite_1)
+    sync_service_2 = SyncManager(datasite_2)
+    folder = datasite_1.my_datasite / "folder1"
+    create_dir_tree(
+        Path(datasite_1.my_datasite),
+        {"folder1": {PERM_FILE: SyftPermission.mine_with_public_rw(datasite_1, dir=folder)}},
+    )
+    file_path = folder / "large.bin"
+    file_path.write_bytes(random.Random(0).randbytes(3 * CHUNK_SIZE + 100))
+    sync_service_1.run_single_thread()
+    sync_service_2.run_single_thread()
+
+    relative_path = Path(datasite_1.email) / "folder1" / "large.bin"
+    assert (server_settings.snapshot_folder / relative_path).read_bytes() == file_path.read_bytes()
+    assert (datasite_2.workspace.datasites / relative_path).read_bytes() == file_path.read_bytes()
+
+    uploaded, downloaded = [], []
+    upload_chunk, download_chunk = SyncClient.upload_chunk, SyncClient.download_chunk
+    monkeypatch.setattr(
+        SyncClient, "upload_chunk", lambda self, *args: uploaded.append(args[0]) or upload_chunk(self, *args)
+    )
+    monkeypatch.setattr(
+        SyncClient, "download_chunk", lambda self, *args: downloaded.append(args[2]) or download_chunk(self, *args)
+    )
+
+    # only the changed chunk is transferred
+    with open(file_path, "r+b") as f:
+        f.seek(CHUNK_SIZE + 10)
+        f.write(b"changed")
+    sync_service_1.run_single_thread()
+    sync_service_2.run_single_thread()
+
+    assert len(uploaded) == 1
+    assert len(downloaded) == 1
+    assert (server_settings.snapshot_folder / relative_path).read_bytes() == file_path.read_bytes()
+    assert (datasite_2.workspace.datasites / relative_path).read_bytes() == file_path.read_bytes()
+
+
+def test_single_scan_per_datasite(server_client: TestClient, datasite_1: SyftClientInterface, monkeypatch):
+    sync_service = SyncManager(datasite_1)
+    create_dir_tree(Path(datasite_1.my_datasite), {"folder1": {"file.txt": "content", "file.tmp": "ignored"}})
+    sync_service.run_single_thread()
+
+    walked = []
+    walk_files = syftbox.client.plugins.sync.local_snapshot.walk_files
+    monkeypatch.setattr(
+        syftbox.client.plugins.sync.local_snapshot,
+        "walk_files",
+        lambda dir, **kwargs: walked.append(Path(dir).name) or walk_files(dir, **kwargs),
+    )
+    (datasite_1.my_datasite / "folder1" / "file.txt").write_text("modified")
+    sync_service.run_single_thread()
+
+    # every datasite is walked once per cycle
+    assert datasite_1.email in walked
+    assert len(walked) == len(set(walked))
+    ignored_path = Path(datasite_1.email) / "folder1" / "file.tmp"
+    assert sync_service.local_state.status_info[ignored_path].status == SyncStatus.IGNORED
+
+
 def test_modify_with_conflict(
     server_client: TestClient, datasite_1: SyftClientInterface, datasite_2: SyftClientInterface
 ):
@@ -289,12 +594,14 @@ def test_delete_file(server_client: TestClient, datasite_1: SyftClientInterface,
     assert Path(datasite_1.email) / "folder1" / "file.txt" not in remote_paths
 
 
-def test_invalid_sync_to_remote(server_client: TestClient, datasite_1: SyftClientInterface):
+def test_invalid_sync_to_remote(server_client: TestClient, datasite_1: SyftClientInterface, monkeypatch):
+    max_file_size_mb = 1
+    monkeypatch.setattr(syftbox.client.plugins.sync.sync_action, "MAX_FILE_SIZE_MB", max_file_size_mb)
     sync_service_1 = SyncManager(datasite_1)
     sync_service_1.run_single_thread()
 
     # random bytes 1 byte too large
-    too_large_content = os.urandom((MAX_FILE_SIZE_MB * 1024 * 1024) + 1)
+    too_large_content = os.urandom((max_file_size_mb * 1024 * 1024) + 1)
     tree = {
         "valid": {
             PERM_FILE: SyftPermission.mine_with_public_rw(datasite_1, dir=datasite_1.my_datasite / "valid"),
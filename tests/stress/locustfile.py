@@ -49,7 +49,7 @@ class SyftBoxUser(FastHttpUser):
         remote_datasite_states = self.sync_client.get_datasite_states()
         # logger.info(f"Syncing {len(remote_datasite_states)} datasites")
         all_files: list[FileMetadata] = []
-        for remote_state in remote_datasite_states.values():
+        for _, remote_state in remote_datasite_states:
             all_files.extend(remote_state)
 
         all_paths = [f.path for f in all_files][:10]
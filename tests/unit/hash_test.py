@@ -1,7 +1,13 @@
+import io
+import os
 from pathlib import Path
 
+import pathspec
+
+from syftbox.client.plugins.sync.local_snapshot import LocalSnapshot
 from syftbox.client.utils.dir_tree import create_dir_tree
-from syftbox.lib.hash import collect_files
+from syftbox.lib import hash as hash_module
+from syftbox.lib.hash import HashCache, HashPool, collect_files, hash_file, walk_files
 
 
 def test_collect_files(tmp_path: Path):
@@ -74,3 +80,106 @@ def test_collect_files(tmp_path: Path):
     regular_file = test_dir / "just_a_file"
     regular_file.touch()
     assert collect_files(regular_file) == []
+
+
+def test_hash_cache(tmp_path: Path):
+    cache = HashCache()
+    file = tmp_path / "file.txt"
+    file.write_text("content")
+
+    metadata = cache.hash_file(file, tmp_path)
+    assert metadata == hash_file(file, tmp_path)
+    assert cache.get(file, file.stat()) is metadata
+    assert cache.hash_file(file, tmp_path) is metadata
+
+    # a changed file is hashed again
+    file.write_text("new content")
+    assert cache.get(file, file.stat()) is None
+    assert cache.hash_file(file, tmp_path).hash != metadata.hash
+
+
+def test_hash_cache_file_written_during_read(tmp_path: Path, monkeypatch):
+    cache = HashCache()
+    file = tmp_path / "file.txt"
+    file.write_text("content")
+    stat = file.stat()
+
+    def open_and_write(path, mode="r"):
+        data = Path(path).read_bytes()
+        # same size, only the mtime tells the contents changed
+        file.write_text("CONTENT")
+        os.utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        return io.BytesIO(data)
+
+    monkeypatch.setattr(hash_module, "open", open_and_write, raising=False)
+    metadata = cache.hash_file(file, tmp_path)
+    monkeypatch.undo()
+
+    # the old contents are cached with the old size and mtime, so the new contents are hashed again
+    assert metadata.file_size == len("content")
+    assert cache.get(file, file.stat()) is None
+    assert cache.hash_file(file, tmp_path).hash == hash_file(file, tmp_path).hash != metadata.hash
+
+
+def test_local_snapshot_prunes_hash_cache(tmp_path: Path):
+    cache = HashCache()
+    datasite = tmp_path / "alice@openmined.org"
+    other = tmp_path / "bob@openmined.org"
+    create_dir_tree(tmp_path, {datasite.name: {"a.txt": "a", "b.txt": "b"}, other.name: {"c.txt": "c"}})
+    LocalSnapshot(tmp_path, datasite, cache)
+    LocalSnapshot(tmp_path, other, cache)
+    assert cache.get(datasite / "b.txt", (datasite / "b.txt").stat()) is not None
+
+    # deleted files are dropped on the next scan of their datasite, other datasites are untouched
+    stat = (datasite / "b.txt").stat()
+    (datasite / "b.txt").unlink()
+    snapshot = LocalSnapshot(tmp_path, datasite, cache)
+    assert list(snapshot.files) == [Path(datasite.name) / "a.txt"]
+    assert cache.get(datasite / "b.txt", stat) is None
+    assert cache.get(datasite / "a.txt", (datasite / "a.txt").stat()) is not None
+    assert cache.get(other / "c.txt", (other / "c.txt").stat()) is not None
+
+
+def test_walk_files_prunes_ignored_dirs(tmp_path: Path, monkeypatch):
+    tree = {
+        "file.txt": "content",
+        "__pycache__": {"module.pyc": "bytecode"},
+        "src": {
+            "main.py": "code",
+            "__pycache__": {"main.pyc": "bytecode"},
+        },
+    }
+    create_dir_tree(tmp_path, tree)
+    ignore_rules = pathspec.PathSpec.from_lines("gitwildmatch", ["__pycache__/"])
+
+    scanned = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, "scandir", lambda path: scanned.append(Path(path)) or scandir(path))
+
+    entries = list(walk_files(tmp_path, ignore_rules=ignore_rules))
+    assert sorted(Path(entry.path).relative_to(tmp_path).as_posix() for entry in entries) == ["file.txt", "src/main.py"]
+    assert sorted(scanned) == [tmp_path, tmp_path / "src"]
+    assert all(entry.stat().st_size > 0 for entry in entries)
+
+
+def test_hash_pool(tmp_path: Path):
+    files = {f"small_{i}.txt": f"content {i}" for i in range(10)}
+    files["large.bin"] = "x" * 2000
+    create_dir_tree(tmp_path, files)
+    paths = [tmp_path / name for name in files] + [tmp_path / "missing.txt"]
+
+    pool = HashPool(workers=2, large_file_threshold=1000, max_pending=3)
+    try:
+        results = list(pool.hash_files([(path, None) for path in paths], root_dir=tmp_path))
+        assert [path for path, _ in results] == paths
+        for path, metadata in results[:-1]:
+            assert metadata == hash_file(path, tmp_path)
+        assert results[-1][1] is None
+        # large files are hashed in a process pool
+        assert pool._processes is not None
+    finally:
+        pool.shutdown()
+
+    # the pool is restarted after shutdown
+    assert pool.submit(paths[0], tmp_path).result() == hash_file(paths[0], tmp_path)
+    pool.shutdown()
@@ -0,0 +1,24 @@
+import io
+import random
+
+from syftbox.lib.chunks import CDC_MIN_SIZE, CHUNK_SIZE, iter_chunks
+
+
+def chunk_hashes(data: bytes) -> list[str]:
+    return [chunk.hash for chunk, _ in iter_chunks(io.BytesIO(data))]
+
+
+def test_chunks_are_content_defined():
+    data = random.Random(0).randbytes(20 * 1024 * 1024)
+    chunks = list(iter_chunks(io.BytesIO(data)))
+    assert b"".join(contents for _, contents in chunks) == data
+    assert all(CDC_MIN_SIZE < chunk.size <= CHUNK_SIZE for chunk, _ in chunks[:-1])
+
+    # inserting data only changes the chunks around the insert
+    original = set(chunk_hashes(data))
+    inserted = chunk_hashes(data[:5_000_000] + b"inserted" + data[5_000_000:])
+    assert len([h for h in inserted if h not in original]) <= 2
+
+    # appending data keeps all chunks but the last one
+    appended = chunk_hashes(data + b"appended")
+    assert appended[: len(original) - 1] == chunk_hashes(data)[:-1]
@@ -1,5 +1,6 @@
 from pathlib import Path
 
+import httpx
 import pytest
 
 from syftbox.lib.client_config import SyftClientConfig
@@ -69,3 +70,23 @@ def test_makedirs_existing(client, tmp_path):
     # Should not raise error when directory exists
     client.makedirs(test_path)
     assert test_path.exists()
+
+
+def test_materialize(client, monkeypatch):
+    requests = []
+
+    def mock_post(url, json, **kwargs):
+        requests.append((url, json))
+        return httpx.Response(200, json=[json["path"]], request=httpx.Request("POST", url))
+
+    monkeypatch.setattr(httpx, "post", mock_post)
+    path = client.datasites / "other@example.com" / "data.csv"
+
+    assert client.materialize(path, pin=True) == path
+    assert client.evict("other@example.com/data.csv") == [path]
+    assert requests == [
+        ("http://test:8080/sync/materialize", {"path": "other@example.com/data.csv", "pin": True}),
+        ("http://test:8080/sync/evict", {"path": "other@example.com/data.csv"}),
+    ]
+    with pytest.raises(ValueError):
+        client.materialize("/outside/datasites")
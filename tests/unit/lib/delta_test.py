@@ -0,0 +1,84 @@
+import hashlib
+import io
+import os
+import random
+from pathlib import Path
+
+import py_fast_rsync
+import pytest
+from py_fast_rsync import signature
+
+from syftbox.lib import delta
+from syftbox.lib.delta import apply_delta, compute_delta, map_file
+
+
+def mutate(data: bytes, rng: random.Random) -> bytes:
+    result = bytearray(data)
+    for _ in range(rng.randint(0, 5)):
+        pos = rng.randint(0, len(result))
+        result[pos : pos + rng.randint(0, 3000)] = os.urandom(rng.randint(0, 3000))
+    return bytes(result)
+
+
+@pytest.mark.parametrize("size", [0, 1, 5_000, 300_000])
+def test_apply_delta_matches_py_fast_rsync(tmp_path: Path, monkeypatch, size: int):
+    monkeypatch.setattr(delta, "DELTA_CHUNK_SIZE", 777)
+    rng = random.Random(size)
+    for _ in range(10):
+        old = os.urandom(size)
+        new = mutate(old, rng)
+        diff = py_fast_rsync.diff(signature.calculate(old, rng.choice([64, 512, 4096])), new)
+
+        base_path = tmp_path / "base"
+        base_path.write_bytes(old)
+        out = io.BytesIO()
+        with map_file(base_path) as base:
+            new_hash = apply_delta(base, diff, out)
+
+        assert out.getvalue() == new == py_fast_rsync.apply(old, diff)
+        assert new_hash == hashlib.sha256(new).hexdigest()
+
+
+@pytest.mark.parametrize("size", [0, 1, 5_000, 300_000])
+def test_compute_delta_in_windows(tmp_path: Path, monkeypatch, size: int):
+    monkeypatch.setattr(delta, "DIFF_WINDOW_SIZE", 10_000)
+    rng = random.Random(size)
+    for _ in range(10):
+        old = os.urandom(size)
+        new = mutate(old, rng)
+        sig = signature.calculate(old, rng.choice([64, 512, 4096]))
+
+        new_path = tmp_path / "new"
+        new_path.write_bytes(new)
+        with map_file(new_path) as data:
+            diff = compute_delta(sig, data)
+
+        assert py_fast_rsync.apply(old, diff) == new
+        out = io.BytesIO()
+        apply_delta(old, diff, out)
+        assert out.getvalue() == new
+
+    # unchanged windows are copied from the old file
+    old = os.urandom(100_000)
+    assert len(compute_delta(signature.calculate(old, 512), old)) < 1000
+
+
+def test_apply_delta_rejects_invalid_delta():
+    old = os.urandom(10_000)
+    diff = py_fast_rsync.diff(signature.calculate(old), old)
+
+    with pytest.raises(ValueError):
+        apply_delta(old, b"not a delta", io.BytesIO())
+    with pytest.raises(ValueError):
+        apply_delta(old, diff[:-1], io.BytesIO())
+    with pytest.raises(ValueError):
+        # copies out of range of a shorter base
+        apply_delta(old[:100], diff, io.BytesIO())
+
+
+def test_compute_delta_rejects_invalid_signature():
+    valid = signature.calculate(os.urandom(10_000), 512, 8)
+    zero_block_size = valid[:4] + bytes(4) + valid[8:]
+    for invalid in [b"", valid[:3], valid[:-3], b"not a signature", zero_block_size]:
+        with pytest.raises(ValueError):
+            compute_delta(invalid, b"data")
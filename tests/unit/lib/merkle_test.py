@@ -0,0 +1,63 @@
+from datetime import datetime, timezone
+from pathlib import Path
+
+from syftbox.lib.merkle import EMPTY_TREE_HASH, MerkleTree, hash_entries
+from syftbox.server.models.sync_models import FileMetadata
+
+
+def make_file(path: str, content_hash: str = "hash") -> FileMetadata:
+    return FileMetadata(
+        path=Path(path),
+        hash=content_hash,
+        signature="sig",
+        last_modified=datetime.now(timezone.utc),
+    )
+
+
+FILES = [
+    make_file("alice/a.txt"),
+    make_file("alice/dir/b.txt"),
+    make_file("alice/dir/nested/c.txt"),
+    make_file("alice/other/d.txt"),
+]
+
+
+def test_tree_is_order_independent():
+    root = Path("alice")
+    assert MerkleTree(root, FILES).root_hash == MerkleTree(root, reversed(FILES)).root_hash
+
+
+def test_changed_file_only_changes_ancestors():
+    root = Path("alice")
+    tree = MerkleTree(root, FILES)
+    changed = MerkleTree(root, FILES[:2] + [make_file("alice/dir/nested/c.txt", "changed")] + FILES[3:])
+
+    for path in ["alice", "alice/dir", "alice/dir/nested"]:
+        assert tree.hash(Path(path)) != changed.hash(Path(path))
+    for path in ["alice/a.txt", "alice/dir/b.txt", "alice/other"]:
+        assert tree.hash(Path(path)) == changed.hash(Path(path))
+
+
+def test_tree_nodes():
+    tree = MerkleTree(Path("alice"), FILES)
+
+    node = tree.node(Path("alice/dir"))
+    assert [(entry.name, entry.is_dir) for entry in node.children] == [("b.txt", False), ("nested", True)]
+    assert node.children[0].metadata == FILES[1]
+    assert node.hash == hash_entries(node.children)
+
+    assert {f.path for f in tree.iter_files(Path("alice/dir"))} == {FILES[1].path, FILES[2].path}
+    assert tree.hash(Path("alice/missing")) == EMPTY_TREE_HASH
+    assert tree.children(Path("alice/missing")) == []
+
+
+def test_tree_skips_files_outside_root():
+    tree = MerkleTree(Path("alice"), FILES + [make_file("alice2/a.txt"), make_file("bob/a.txt")])
+    assert tree.root_hash == MerkleTree(Path("alice"), FILES).root_hash
+    assert MerkleTree(Path("bob"), FILES).root_hash == EMPTY_TREE_HASH
+
+
+def test_tree_over_all_datasites():
+    tree = MerkleTree(Path("."), FILES + [make_file("bob/a.txt")])
+    assert [entry.name for entry in tree.children(Path("."))] == ["alice", "bob"]
+    assert tree.hash(Path("alice")) == MerkleTree(Path("alice"), FILES).root_hash
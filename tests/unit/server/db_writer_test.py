@@ -0,0 +1,70 @@
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from syftbox.server.db.schema import get_db
+from syftbox.server.db.writer import DBWriter
+
+
+def insert_row(i: int):
+    def fn(conn: sqlite3.Connection) -> int:
+        conn.execute("INSERT INTO datasite_versions (datasite, version) VALUES (?, ?)", (f"datasite_{i}", i))
+        return i
+
+    return fn
+
+
+def test_writer_group_commit(tmp_path):
+    db_path = tmp_path / "test.db"
+    writer = DBWriter(db_path)
+    batch_sizes = []
+    commit_batch = writer._commit_batch
+    writer._commit_batch = lambda conn, batch: batch_sizes.append(len(batch)) or commit_batch(conn, batch)
+
+    # block the writer, so all writes below are queued and committed as one batch
+    started, release = threading.Event(), threading.Event()
+    blocked = writer.submit(lambda conn: started.set() or release.wait())
+    started.wait()
+    futures = [writer.submit(insert_row(i)) for i in range(100)]
+    release.set()
+
+    assert blocked.result() is True
+    assert [f.result() for f in futures] == list(range(100))
+    writer.close()
+    assert batch_sizes == [1, 100]
+
+    rows = get_db(db_path).execute("SELECT COUNT(*) FROM datasite_versions").fetchone()[0]
+    assert rows == 100
+
+
+def test_writer_failed_write_only_fails_caller(tmp_path):
+    db_path = tmp_path / "test.db"
+    writer = DBWriter(db_path)
+
+    started, release = threading.Event(), threading.Event()
+    writer.submit(lambda conn: started.set() or release.wait())
+    started.wait()
+
+    ok_before = writer.submit(insert_row(0))
+    failing = writer.submit(insert_row(0))  # duplicate primary key
+    ok_after = writer.submit(insert_row(1))
+    release.set()
+
+    assert ok_before.result() == 0
+    assert ok_after.result() == 1
+    with pytest.raises(sqlite3.IntegrityError):
+        failing.result()
+    writer.close()
+
+    rows = get_db(db_path).execute("SELECT datasite FROM datasite_versions ORDER BY datasite").fetchall()
+    assert [row["datasite"] for row in rows] == ["datasite_0", "datasite_1"]
+
+
+def test_writer_concurrent_writes(tmp_path):
+    writer = DBWriter(tmp_path / "test.db")
+    with ThreadPoolExecutor(max_workers=50) as executor:
+        results = list(executor.map(lambda i: writer.write(insert_row(i)), range(500)))
+    writer.close()
+    assert results == list(range(500))
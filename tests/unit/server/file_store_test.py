@@ -1,9 +1,22 @@
+import hashlib
+import os
+import time
 import uuid
 from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from pathlib import Path
 
+import pytest
+import yaml
+from fastapi import HTTPException
+
 from syftbox.lib.hash import hash_file
-from syftbox.server.db.file_store import FileStore
+from syftbox.lib.merkle import MerkleTree
+from syftbox.lib.permissions import PermissionType
+from syftbox.server.db import file_store
+from syftbox.server.db.file_store import FileStore, MerkleTreeCache
+from syftbox.server.migrations import run_migrations
+from syftbox.server.models.sync_models import ChunkInfo, FileMetadata
 from syftbox.server.settings import ServerSettings
 
 
@@ -25,3 +38,414 @@ def test_put_atomic(tmpdir):
     assert system_path.exists()
     metadata = FileStore(settings).get_metadata(syft_path, user, skip_permission_check=True)
     assert metadata.hash_bytes == hash_file(system_path).hash_bytes
+
+
+def test_put_readers_see_complete_files(tmpdir):
+    settings = ServerSettings.from_data_folder(tmpdir)
+    store = FileStore(settings)
+    path = Path("alice@openmined.org/a.txt")
+    versions = [bytes([i]) * 1_000_000 for i in range(10)]
+    store.put(path, versions[0], "", skip_permission_check=True)
+
+    def read(_):
+        data = (settings.snapshot_folder / path).read_bytes()
+        return data in versions
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        writes = [executor.submit(store.put, path, v, "", skip_permission_check=True) for v in versions]
+        assert all(executor.map(read, range(50)))
+        [w.result() for w in writes]
+
+    # no temporary files are left behind, and the metadata matches the last version on disk
+    assert [p.name for p in (settings.snapshot_folder / path.parent).iterdir()] == [path.name]
+    metadata = store.get_metadata(path, "", skip_permission_check=True)
+    assert metadata == hash_file(settings.snapshot_folder / path, settings.snapshot_folder)
+
+
+def test_put_many_checks_all_permissions_first(tmpdir):
+    settings = ServerSettings.from_data_folder(tmpdir)
+    store = FileStore(settings)
+    files = {
+        Path("alice@openmined.org/a.txt"): b"a",
+        Path("bob@openmined.org/b.txt"): b"b",
+    }
+    with pytest.raises(HTTPException):
+        store.put_many(files, "alice@openmined.org", check_permission=PermissionType.CREATE)
+    assert not (settings.snapshot_folder / "alice@openmined.org/a.txt").exists()
+
+    store.put_many(files, "", skip_permission_check=True)
+    assert [store.get(path, path.parts[0]).data for path in files] == [b"a", b"b"]
+
+
+def make_chunks(*parts: bytes) -> list[ChunkInfo]:
+    offsets = [sum(len(p) for p in parts[:i]) for i in range(len(parts))]
+    return [
+        ChunkInfo(offset=offset, size=len(part), hash=hashlib.sha256(part).hexdigest())
+        for offset, part in zip(offsets, parts)
+    ]
+
+
+def test_put_chunks(tmpdir):
+    settings = ServerSettings.from_data_folder(tmpdir)
+    store = FileStore(settings)
+    user = "alice@openmined.org"
+    path = Path(user) / "large.bin"
+    a, b, c = b"a" * 1000, b"b" * 2000, b"c" * 500
+
+    # nothing is written until all chunks are staged
+    store.stage_chunk(user, hashlib.sha256(a).hexdigest(), a)
+    result = store.put_chunks(path, make_chunks(a, b), hashlib.sha256(a + b).hexdigest(), user)
+    assert result.current_hash is None
+    assert result.missing_chunks == [hashlib.sha256(b).hexdigest()]
+    assert not store.exists(path)
+
+    store.stage_chunk(user, hashlib.sha256(b).hexdigest(), b)
+    result = store.put_chunks(path, make_chunks(a, b), hashlib.sha256(a + b).hexdigest(), user)
+    assert result.current_hash == hashlib.sha256(a + b).hexdigest()
+    assert (settings.snapshot_folder / path).read_bytes() == a + b
+    assert list(store.staging_dir_for(user).iterdir()) == []
+
+    # chunks of the current file are reused without uploading them again
+    store.stage_chunk(user, hashlib.sha256(c).hexdigest(), c)
+    result = store.put_chunks(path, make_chunks(b, c), hashlib.sha256(b + c).hexdigest(), user)
+    assert result.previous_hash == hashlib.sha256(a + b).hexdigest()
+    assert (settings.snapshot_folder / path).read_bytes() == b + c
+    manifest = store.get_chunk_manifest(path, user)
+    assert manifest.chunks == make_chunks(b, c)
+    assert store.read_chunk(path, user, manifest.hash, 1) == c
+
+    # a wrong hash is rejected, and the file is not changed
+    with pytest.raises(HTTPException):
+        store.put_chunks(path, make_chunks(c), "wrong_hash", user)
+    assert (settings.snapshot_folder / path).read_bytes() == b + c
+
+
+def test_staged_chunks_are_limited(tmp_path: Path):
+    settings = ServerSettings(data_folder=tmp_path, chunk_staging_max_bytes=2500)
+    store = FileStore(settings)
+    user = "alice@openmined.org"
+    a, b, c = b"a" * 1000, b"b" * 1000, b"c" * 1000
+    store.stage_chunk(user, hashlib.sha256(a).hexdigest(), a)
+    store.stage_chunk(user, hashlib.sha256(b).hexdigest(), b)
+    # staging the same chunk again does not count twice
+    store.stage_chunk(user, hashlib.sha256(b).hexdigest(), b)
+    with pytest.raises(HTTPException) as e:
+        store.stage_chunk(user, hashlib.sha256(c).hexdigest(), c)
+    assert e.value.status_code == 413
+    # other users have their own limit
+    store.stage_chunk("bob@openmined.org", hashlib.sha256(c).hexdigest(), c)
+
+    # chunks that are never committed expire
+    expired = time.time() - settings.chunk_staging_ttl.total_seconds() - 1
+    for path in store.staging_dir_for(user).iterdir():
+        os.utime(path, (expired, expired))
+    store.stage_chunk(user, hashlib.sha256(c).hexdigest(), c)
+    assert [p.name for p in store.staging_dir_for(user).iterdir()] == [hashlib.sha256(c).hexdigest()]
+
+    bob_chunk = store.staging_dir_for("bob@openmined.org") / hashlib.sha256(c).hexdigest()
+    os.utime(bob_chunk, (expired, expired))
+    assert store.expire_staged_chunks() == 1
+    assert not bob_chunk.exists()
+
+
+def test_put_chunks_dedup(tmp_path: Path):
+    settings = ServerSettings(data_folder=tmp_path, chunk_dedup_enabled=True)
+    store = FileStore(settings)
+    user = "alice@openmined.org"
+    a, b, c = b"a" * 1000, b"b" * 2000, b"c" * 500
+    for chunk in (a, b):
+        store.stage_chunk(user, hashlib.sha256(chunk).hexdigest(), chunk)
+    store.put_chunks(Path(user) / "v1.bin", make_chunks(a, b), hashlib.sha256(a + b).hexdigest(), user)
+
+    # chunks of other files are reused, only the new chunk has to be uploaded
+    result = store.put_chunks(Path(user) / "v2.bin", make_chunks(b, c, a), hashlib.sha256(b + c + a).hexdigest(), user)
+    assert result.missing_chunks == [hashlib.sha256(c).hexdigest()]
+
+    store.stage_chunk(user, hashlib.sha256(c).hexdigest(), c)
+    store.put_chunks(Path(user) / "v2.bin", make_chunks(b, c, a), hashlib.sha256(b + c + a).hexdigest(), user)
+    assert (settings.snapshot_folder / user / "v2.bin").read_bytes() == b + c + a
+
+    # without dedup, only chunks of the same file are reused
+    store = FileStore(ServerSettings(data_folder=tmp_path, chunk_dedup_enabled=False))
+    result = store.put_chunks(Path(user) / "v3.bin", make_chunks(a), hashlib.sha256(a).hexdigest(), user)
+    assert result.missing_chunks == [hashlib.sha256(a).hexdigest()]
+
+
+def test_merkle_tree_cache_is_bounded_by_files():
+    def make_tree(datasite: str, num_files: int) -> MerkleTree:
+        files = [
+            FileMetadata(
+                path=Path(datasite, f"{i}.txt"),
+                hash=f"hash{i}",
+                signature="sig",
+                last_modified=datetime.now(timezone.utc),
+            )
+            for i in range(num_files)
+        ]
+        return MerkleTree(Path(datasite), files)
+
+    cache = MerkleTreeCache(max_files=10, max_root_hashes=2)
+    cache.put(("a",), make_tree("a", 4))
+    cache.put(("b",), make_tree("b", 4))
+    assert cache.get(("a",)) is not None
+    # "b" is least recently used and evicted to make room
+    cache.put(("c",), make_tree("c", 4))
+    assert cache.get(("b",)) is None
+    assert cache.get(("a",)) is not None and cache.get(("c",)) is not None
+
+    # trees larger than the cache are not cached, but their root hash is
+    big = make_tree("big", 11)
+    cache.put(("big",), big)
+    assert cache.get(("big",)) is None
+    assert cache.get_root_hash(("big",)) == big.root_hash
+    assert cache.get(("a",)) is not None
+
+    assert cache.get_root_hash(("b",)) is None
+    assert cache.get_root_hash(("c",)) is not None
+
+
+def test_iter_datasite_states(tmpdir):
+    settings = ServerSettings.from_data_folder(tmpdir)
+    store = FileStore(settings)
+    paths = [
+        "alice@openmined.org/a.txt",
+        "alice@openmined.org/sub/b.txt",
+        "alice.smith@openmined.org/c.txt",
+        "bob@openmined.org/d.txt",
+    ]
+    for path in paths:
+        store.put(Path(path), b"data", "", skip_permission_check=True)
+
+    # no permission files, so users can only read their own datasite
+    states = list(store.iter_datasite_states("alice@openmined.org"))
+    assert sorted(datasite for datasite, _ in states) == [
+        "alice.smith@openmined.org",
+        "alice@openmined.org",
+        "bob@openmined.org",
+    ]
+    states = dict(states)
+    assert [m.path.as_posix() for m in states["alice@openmined.org"]] == paths[:2]
+    assert states["alice.smith@openmined.org"] == []
+    assert states["bob@openmined.org"] == []
+
+
+def test_iter_datasite_states_closes_connection(tmpdir, monkeypatch):
+    settings = ServerSettings.from_data_folder(tmpdir)
+    store = FileStore(settings)
+    store.put(Path("alice@openmined.org/a.txt"), b"data", "", skip_permission_check=True)
+
+    connections = []
+
+    class TrackedConnection:
+        def __init__(self, conn):
+            self.conn = conn
+            self.closed = False
+            connections.append(self)
+
+        def __getattr__(self, name):
+            return getattr(self.conn, name)
+
+        def __enter__(self):
+            return self.conn.__enter__()
+
+        def __exit__(self, *args):
+            return self.conn.__exit__(*args)
+
+        def close(self):
+            self.closed = True
+            self.conn.close()
+
+    get_db = file_store.get_db
+    monkeypatch.setattr(file_store, "get_db", lambda path: TrackedConnection(get_db(path)))
+
+    # the listing is streamed to clients, no connection may be open while a datasite is sent
+    states = store.iter_datasite_states("alice@openmined.org")
+    assert next(states)[0] == "alice@openmined.org"
+    assert connections[-1].closed
+
+
+def test_datasite_states_page(tmpdir):
+    settings = ServerSettings.from_data_folder(tmpdir)
+    store = FileStore(settings)
+    paths = [
+        "alice@openmined.org/a.txt",
+        "alice@openmined.org/b.txt",
+        "bob@openmined.org/c.txt",
+        "charlie@openmined.org/d.txt",
+    ]
+    for path in paths:
+        store.put(Path(path), b"data", "", skip_permission_check=True)
+
+    pages = []
+    cursor = None
+    while True:
+        page, cursor = store.datasite_states_page("alice@openmined.org", cursor=cursor, page_size=1)
+        pages.append(page)
+        if cursor is None:
+            break
+
+    # every page examines one file, alice can only read her own files
+    assert len(pages) == 5
+    assert [list(page.keys()) for page in pages[:-1]] == [["alice@openmined.org"]] * 2 + [[]] * 2
+    # the last page lists every datasite to mark the listing as complete
+    assert pages[-1] == {"alice@openmined.org": [], "bob@openmined.org": [], "charlie@openmined.org": []}
+
+    # a listing that fits in a single page also includes datasites without readable files
+    page, cursor = store.datasite_states_page("alice@openmined.org", cursor=None, page_size=10)
+    assert cursor is None
+    assert {datasite: len(files) for datasite, files in page.items()} == {
+        "alice@openmined.org": 2,
+        "bob@openmined.org": 0,
+        "charlie@openmined.org": 0,
+    }
+
+
+def test_datasite_states_etag(tmpdir):
+    settings = ServerSettings.from_data_folder(tmpdir)
+    store = FileStore(settings)
+    store.put(Path("alice@openmined.org/a.txt"), b"data", "", skip_permission_check=True)
+
+    etag = store.get_datasite_states_etag("alice@openmined.org")
+    assert etag == store.get_datasite_states_etag("alice@openmined.org")
+    assert etag != store.get_datasite_states_etag("bob@openmined.org")
+
+    # writes and permission changes in any datasite change the etag
+    store.put(Path("bob@openmined.org/b.txt"), b"data", "", skip_permission_check=True)
+    etag_after_write = store.get_datasite_states_etag("alice@openmined.org")
+    assert etag_after_write != etag
+
+    permfile = yaml.safe_dump([{"path": "**", "user": "*", "permissions": ["read"]}]).encode()
+    store.put(Path("bob@openmined.org/syftperm.yaml"), permfile, "", skip_permission_check=True)
+    etag_after_permission = store.get_datasite_states_etag("alice@openmined.org")
+    assert etag_after_permission != etag_after_write
+
+    store.delete(Path("bob@openmined.org/b.txt"), "bob@openmined.org")
+    assert store.get_datasite_states_etag("alice@openmined.org") != etag_after_permission
+
+
+def test_get_many(tmpdir):
+    settings = ServerSettings.from_data_folder(tmpdir)
+    store = FileStore(settings)
+    paths = [Path("alice@openmined.org/a.txt"), Path("alice@openmined.org/b.txt")]
+    for path in paths:
+        store.put(path, path.name.encode(), "", skip_permission_check=True)
+
+    files = store.get_many(paths + [Path("alice@openmined.org/missing.txt")], "alice@openmined.org")
+    assert [(f.metadata.path, f.data) for f in files] == [(path, path.name.encode()) for path in paths]
+
+
+def test_sharded_file_store(tmpdir):
+    paths = [
+        "alice@openmined.org/a.txt",
+        "alice@openmined.org/sub/b.txt",
+        "alice.smith@openmined.org/c.txt",
+        "bob@openmined.org/d.txt",
+    ]
+    stores = []
+    for shard_db_by_datasite in [False, True]:
+        settings = ServerSettings(data_folder=Path(tmpdir) / str(shard_db_by_datasite))
+        settings.shard_db_by_datasite = shard_db_by_datasite
+        settings.data_folder.mkdir()
+        store = FileStore(settings, executor=ThreadPoolExecutor(max_workers=2))
+        for path in paths:
+            store.put(Path(path), path.encode(), "", skip_permission_check=True)
+        stores.append(store)
+    store, sharded_store = stores
+
+    # every datasite has its own database, the main database is only a catalog
+    assert sorted(p.name for p in sharded_store.server_settings.datasite_db_folder.iterdir() if p.suffix == ".db") == [
+        "alice.smith@openmined.org.db",
+        "alice@openmined.org.db",
+        "bob@openmined.org.db",
+    ]
+    assert sharded_store.list_datasites() == store.list_datasites()
+
+    user = "alice@openmined.org"
+    path = Path("alice@openmined.org/sub/b.txt")
+    assert sharded_store.get(path, user).data == store.get(path, user).data
+    assert dict(sharded_store.iter_datasite_states(user)) == dict(store.iter_datasite_states(user))
+    assert sharded_store.list_for_user(Path(user), user) == store.list_for_user(Path(user), user)
+    assert sharded_store.get_tree_node(Path("."), user) == store.get_tree_node(Path("."), user)
+
+    # pages continue across datasite databases
+    pages, cursor = [], None
+    while True:
+        page, cursor = sharded_store.datasite_states_page(user, cursor=cursor, page_size=1)
+        pages.append(page)
+        if cursor is None:
+            break
+    assert [f.path.as_posix() for page in pages for files in page.values() for f in files] == paths[:2]
+
+    etag = sharded_store.get_datasite_states_etag(user)
+    sharded_store.delete(Path("bob@openmined.org/d.txt"), "bob@openmined.org")
+    assert sharded_store.get_datasite_states_etag(user) != etag
+
+
+def test_sharded_migrations(tmpdir):
+    settings = ServerSettings(data_folder=Path(tmpdir), shard_db_by_datasite=True)
+    for path in ["alice@openmined.org/a.txt", "bob@openmined.org/sub/b.txt"]:
+        (settings.snapshot_folder / path).parent.mkdir(parents=True, exist_ok=True)
+        (settings.snapshot_folder / path).write_bytes(b"data")
+    run_migrations(settings)
+
+    store = FileStore(settings)
+    assert store.list_datasites() == ["alice@openmined.org", "bob@openmined.org"]
+    assert store.exists(Path("bob@openmined.org/sub/b.txt"))
+    assert settings.datasite_db_path("bob@openmined.org").is_file()
+
+
+@pytest.mark.parametrize("shard_db_by_datasite", [False, True])
+def test_subscriptions(tmp_path: Path, shard_db_by_datasite: bool):
+    settings = ServerSettings(data_folder=tmp_path)
+    settings.shard_db_by_datasite = shard_db_by_datasite
+    store = FileStore(settings, executor=ThreadPoolExecutor(max_workers=2))
+    public = yaml.safe_dump([{"path": "**", "user": "*", "permissions": ["read"]}]).encode()
+    for datasite in ["bob@openmined.org", "charlie@openmined.org"]:
+        store.put(Path(datasite) / "syftperm.yaml", public, "", skip_permission_check=True)
+    paths = [
+        "alice@openmined.org/a.txt",
+        "bob@openmined.org/app/a.txt",
+        "bob@openmined.org/app_data/b.txt",
+        "bob@openmined.org/other/c.txt",
+        "charlie@openmined.org/d.txt",
+    ]
+    for path in paths:
+        store.put(Path(path), b"data", "", skip_permission_check=True)
+
+    user = "alice@openmined.org"
+    etag = store.get_datasite_states_etag(user)
+    tree = store.get_tree_node(Path("."), user)
+    subscriptions = store.set_subscriptions(user, [Path("bob@openmined.org/app"), Path("bob@openmined.org/app/sub")])
+    assert subscriptions.paths == [Path("bob@openmined.org/app")]
+    assert store.get_subscriptions(user).paths == subscriptions.paths
+    # other users still sync everything
+    assert store.get_subscriptions("bob@openmined.org").is_everything
+
+    # unsubscribed datasites are not listed at all, the own datasite is always listed
+    states = dict(store.iter_datasite_states(user))
+    assert {datasite: [f.path.as_posix() for f in files] for datasite, files in states.items()} == {
+        "alice@openmined.org": ["alice@openmined.org/a.txt"],
+        "bob@openmined.org": ["bob@openmined.org/app/a.txt"],
+    }
+    page, cursor = store.datasite_states_page(user, cursor=None, page_size=100)
+    assert cursor is None
+    assert page == states
+    # the last of many pages only lists subscribed datasites
+    cursor = None
+    while True:
+        page, cursor = store.datasite_states_page(user, cursor=cursor, page_size=1)
+        if cursor is None:
+            break
+    assert list(page.keys()) == ["alice@openmined.org", "bob@openmined.org"]
+    assert store.list_for_user(Path("bob@openmined.org"), user) == states["bob@openmined.org"]
+
+    root = store.get_tree_node(Path("."), user)
+    assert [child.name for child in root.children] == ["alice@openmined.org", "bob@openmined.org"]
+    assert root != tree
+    assert [child.name for child in store.get_tree_node(Path("bob@openmined.org"), user).children] == ["app"]
+    assert store.get_datasite_states_etag(user) != etag
+
+    # an empty list subscribes to everything again
+    assert store.set_subscriptions(user, []).is_everything
+    assert store.get_tree_node(Path("."), user) == tree
+    assert store.get_datasite_states_etag(user) == etag
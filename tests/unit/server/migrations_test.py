@@ -0,0 +1,86 @@
+from pathlib import Path
+
+import pytest
+
+from syftbox.server import migrations
+from syftbox.server.db import db
+from syftbox.server.db.schema import get_db
+from syftbox.server.migrations import run_migrations
+from syftbox.server.settings import ServerSettings
+
+PATHS = [
+    "alice@openmined.org/a.txt",
+    "alice@openmined.org/sub/b.txt",
+    "alice@openmined.org/sub/c.txt",
+    "bob@openmined.org/d.txt",
+]
+
+
+@pytest.fixture
+def settings(tmp_path: Path) -> ServerSettings:
+    settings = ServerSettings.from_data_folder(tmp_path)
+    for path in PATHS:
+        (settings.snapshot_folder / path).parent.mkdir(parents=True, exist_ok=True)
+        (settings.snapshot_folder / path).write_text(path)
+    return settings
+
+
+@pytest.fixture
+def hashed_files(monkeypatch) -> list[str]:
+    """Record every file hashed by the migration."""
+    hashed = []
+    hash_files_parallel = migrations.hash_files_parallel
+
+    def recording_hash_files_parallel(files, root_dir, *args, **kwargs):
+        hashed.extend(file.relative_to(root_dir).as_posix() for file in files)
+        return hash_files_parallel(files, root_dir, *args, **kwargs)
+
+    monkeypatch.setattr(migrations, "hash_files_parallel", recording_hash_files_parallel)
+    return hashed
+
+
+def get_paths(settings: ServerSettings) -> list[str]:
+    conn = get_db(settings.file_db_path)
+    paths = sorted(m.path.as_posix() for m in db.get_all_metadata(conn))
+    conn.close()
+    return paths
+
+
+def test_migration_skips_unchanged_files(settings: ServerSettings, hashed_files: list[str]):
+    run_migrations(settings, workers=2)
+    assert sorted(hashed_files) == PATHS
+    assert get_paths(settings) == PATHS
+
+    hashed_files.clear()
+    run_migrations(settings, workers=2)
+    assert hashed_files == []
+
+    (settings.snapshot_folder / PATHS[0]).write_text("new content")
+    (settings.snapshot_folder / PATHS[1]).unlink()
+    run_migrations(settings, workers=2)
+    assert hashed_files == [PATHS[0]]
+    assert get_paths(settings) == [PATHS[0]] + PATHS[2:]
+
+
+def test_migration_is_resumable(settings: ServerSettings, hashed_files: list[str], monkeypatch):
+    monkeypatch.setattr(migrations, "MIGRATION_BATCH_SIZE", 2)
+    batches = 0
+    save_many_file_metadata = db.save_many_file_metadata
+
+    def interrupted_save(conn, metadata):
+        nonlocal batches
+        batches += 1
+        if batches == 2:
+            raise RuntimeError("interrupted")
+        save_many_file_metadata(conn, metadata)
+
+    monkeypatch.setattr(db, "save_many_file_metadata", interrupted_save)
+    with pytest.raises(RuntimeError):
+        run_migrations(settings, workers=1)
+    assert len(get_paths(settings)) == 2
+
+    monkeypatch.setattr(db, "save_many_file_metadata", save_many_file_metadata)
+    hashed_files.clear()
+    run_migrations(settings, workers=1)
+    assert len(hashed_files) == 2
+    assert get_paths(settings) == PATHS
@@ -26,7 +26,7 @@ def insert_file_metadata(cursor: sqlite3.Cursor, fileid: int, path: str):
     cursor.execute(
         """
     INSERT INTO file_metadata (id, path, datasite, hash, signature, file_size, last_modified) VALUES
-        (?, ?, ?, 'hash1', 'signature1', 100, '2024-01-01')
+        (?, ?, ?, zeroblob(32), 'signature1', 100, 0)
     """,
         (fileid, path, path.split("/")[0]),
     )
@@ -88,7 +88,7 @@ def insert_file_mock(connection: sqlite3.Connection, path: str):
         INSERT INTO file_metadata (path, datasite, hash, signature, file_size, last_modified)
         VALUES (?, ?, ?, ?, ?, ?)
         """,
-        (path, path.split("/")[0], "hash", "sig", 0, "2021-01-01"),
+        (path, path.split("/")[0], bytes(32), "sig", 0, 0),
     )
     connection.commit()
 
@@ -0,0 +1,113 @@
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+from syftbox.lib.constants import PERM_FILE
+from syftbox.lib.permissions import SyftPermission
+from syftbox.server.db import db
+from syftbox.server.db.schema import get_db
+
+TABLES = ["file_metadata", "f", "rules", "rule_files"]
+
+
+@pytest.fixture
+def connection_with_tables():
+    return get_db(":memory:")
+
+
+def traced_queries(connection: sqlite3.Connection, fn) -> list[str]:
+    """Run fn and return every query it executed, with parameters expanded."""
+    queries = []
+    connection.set_trace_callback(queries.append)
+    try:
+        fn()
+    finally:
+        connection.set_trace_callback(None)
+    return [q for q in queries if q.lstrip().upper().startswith(("SELECT", "WITH"))]
+
+
+def assert_no_full_scan(connection: sqlite3.Connection, fn):
+    queries = traced_queries(connection, fn)
+    assert len(queries) > 0
+    for query in queries:
+        plan = [row["detail"] for row in connection.execute(f"EXPLAIN QUERY PLAN {query}")]
+        for detail in plan:
+            for table in TABLES:
+                assert not detail.startswith(f"SCAN {table}"), f"full scan on {table}:\n{query}\n{plan}"
+
+
+def test_prefix_range():
+    assert db.prefix_range("alice@openmined.org/") == ("alice@openmined.org/", "alice@openmined.org0")
+    assert db.prefix_range("a_b") == ("a_b", "a_c")
+    with pytest.raises(ValueError):
+        db.prefix_range("")
+
+
+def test_prefix_range_matches_like(connection_with_tables: sqlite3.Connection):
+    for path in ["a/x.txt", "a_b/x.txt", "ab/x.txt", "a/b/c.txt", "a0", "b/x.txt"]:
+        connection_with_tables.execute(
+            """
+            INSERT INTO file_metadata (path, datasite, hash, signature, file_size, last_modified)
+            VALUES (?, ?, zeroblob(32), 'sig', 0, 0)
+            """,
+            (path, path.split("/")[0]),
+        )
+    metadata = db.get_all_metadata(connection_with_tables, path_like="a/")
+    assert sorted(m.path.as_posix() for m in metadata) == ["a/b/c.txt", "a/x.txt"]
+
+
+def test_get_all_metadata_uses_index(connection_with_tables: sqlite3.Connection):
+    assert_no_full_scan(
+        connection_with_tables,
+        lambda: db.get_all_metadata(connection_with_tables, path_like="alice@openmined.org/"),
+    )
+
+
+def test_get_all_files_under_syftperm_uses_index(connection_with_tables: sqlite3.Connection):
+    permfile = SyftPermission(relative_filepath=Path("alice@openmined.org/test") / PERM_FILE, rules=[])
+    assert_no_full_scan(
+        connection_with_tables,
+        lambda: db.get_all_files_under_syftperm(connection_with_tables.cursor(), permfile),
+    )
+
+
+def test_get_rules_for_path_uses_index(connection_with_tables: sqlite3.Connection):
+    assert_no_full_scan(
+        connection_with_tables,
+        lambda: db.get_rules_for_path(connection_with_tables, Path("alice@openmined.org/a/b/c.txt")),
+    )
+
+
+def test_get_read_permissions_for_user_uses_index(connection_with_tables: sqlite3.Connection):
+    assert_no_full_scan(
+        connection_with_tables,
+        lambda: db.get_read_permissions_for_user(
+            connection_with_tables, "bob@openmined.org", path_like="alice@openmined.org/"
+        ),
+    )
+
+
+def test_get_one_metadata_uses_index(connection_with_tables: sqlite3.Connection):
+    def fn():
+        with pytest.raises(ValueError):
+            db.get_one_metadata(connection_with_tables, "alice@openmined.org/a.txt")
+
+    assert_no_full_scan(connection_with_tables, fn)
+
+
+def test_get_all_datasites_uses_index(connection_with_tables: sqlite3.Connection):
+    assert_no_full_scan(connection_with_tables, lambda: db.get_all_datasites(connection_with_tables))
+
+
+def test_get_filemetadata_page_uses_index(connection_with_tables: sqlite3.Connection):
+    assert_no_full_scan(
+        connection_with_tables,
+        lambda: db.get_filemetadata_page_with_read_access(
+            connection_with_tables,
+            "bob@openmined.org",
+            path=Path("alice@openmined.org"),
+            cursor="alice@openmined.org/a.txt",
+            page_size=100,
+        ),
+    )
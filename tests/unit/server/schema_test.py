@@ -0,0 +1,97 @@
+import hashlib
+import sqlite3
+from datetime import datetime, timezone
+from pathlib import Path
+
+from syftbox.server.db import db
+from syftbox.server.db.schema import get_db
+from syftbox.server.models.sync_models import FileMetadata, datetime_to_ns, ns_to_datetime
+
+
+def test_datetime_ns_roundtrip():
+    dt = datetime(2024, 1, 2, 3, 4, 5, 123456, tzinfo=timezone.utc)
+    assert datetime_to_ns(dt) == 1704164645123456000
+    assert ns_to_datetime(datetime_to_ns(dt)) == dt
+    assert datetime_to_ns(dt.replace(tzinfo=None)) == datetime_to_ns(dt)
+
+
+def test_save_and_load_metadata():
+    conn = get_db(":memory:")
+    metadata = FileMetadata(
+        path=Path("alice@openmined.org/a.txt"),
+        hash=hashlib.sha256(b"a").hexdigest(),
+        signature="sig",
+        file_size=1,
+        last_modified=datetime(2024, 1, 2, 3, 4, 5, 123456, tzinfo=timezone.utc),
+    )
+    db.save_file_metadata(conn, metadata)
+
+    row = conn.execute("SELECT hash, last_modified FROM file_metadata").fetchone()
+    assert row["hash"] == hashlib.sha256(b"a").digest()
+    assert row["last_modified"] == datetime_to_ns(metadata.last_modified)
+
+    loaded = db.get_one_metadata(conn, "alice@openmined.org/a.txt")
+    assert loaded.model_dump() == metadata.model_dump()
+
+
+def test_migrate_text_columns(tmp_path):
+    db_path = tmp_path / "file.db"
+    conn = sqlite3.connect(db_path)
+    conn.executescript(
+        f"""
+        CREATE TABLE file_metadata (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            datasite TEXT NOT NULL,
+            path TEXT NOT NULL UNIQUE,
+            hash TEXT NOT NULL,
+            signature TEXT NOT NULL,
+            file_size INTEGER NOT NULL,
+            last_modified TEXT NOT NULL
+        );
+        INSERT INTO file_metadata VALUES (
+            7, 'alice', 'alice/a.txt', '{hashlib.sha256(b"a").hexdigest()}', 'sig', 1, '2024-01-02T03:04:05.123456+00:00'
+        );
+        CREATE TABLE rules (
+            permfile_path varchar(1000) NOT NULL,
+            permfile_dir varchar(1000) NOT NULL,
+            permfile_depth INTEGER NOT NULL,
+            priority INTEGER NOT NULL,
+            path varchar(1000) NOT NULL,
+            user varchar(1000) NOT NULL,
+            can_read bool NOT NULL,
+            can_create bool NOT NULL,
+            can_write bool NOT NULL,
+            admin bool NOT NULL,
+            disallow bool NOT NULL,
+            PRIMARY KEY (permfile_path, priority)
+        );
+        CREATE TABLE rule_files (
+            permfile_path varchar(1000) NOT NULL,
+            priority INTEGER NOT NULL,
+            file_id INTEGER NOT NULL,
+            match_for_email varchar(1000),
+            PRIMARY KEY (permfile_path, priority, file_id),
+            FOREIGN KEY (permfile_path, priority) REFERENCES rules(permfile_path, priority) ON DELETE CASCADE,
+            FOREIGN KEY (file_id) REFERENCES file_metadata(id) ON DELETE CASCADE
+        );
+        INSERT INTO rules VALUES ('alice/syftperm.yaml', 'alice', 2, 0, '**', '*', 1, 0, 0, 0, 0);
+        INSERT INTO rule_files VALUES ('alice/syftperm.yaml', 0, 7, NULL);
+        """
+    )
+    conn.close()
+
+    get_db(db_path).close()
+
+    # migrating again is a no-op, rule_files that reference file_metadata are kept
+    conn = get_db(db_path)
+    types = {row["name"]: row["type"] for row in conn.execute("PRAGMA table_info(file_metadata)")}
+    assert types["hash"] == "BLOB"
+    assert types["last_modified"] == "INTEGER"
+
+    metadata = db.get_one_metadata(conn, "alice/a.txt")
+    assert metadata.hash == hashlib.sha256(b"a").hexdigest()
+    assert metadata.last_modified == datetime(2024, 1, 2, 3, 4, 5, 123456, tzinfo=timezone.utc)
+    assert [tuple(row) for row in conn.execute("SELECT permfile_path, file_id FROM rule_files")] == [
+        ("alice/syftperm.yaml", 7)
+    ]
+    assert conn.execute("PRAGMA foreign_key_check").fetchall() == []
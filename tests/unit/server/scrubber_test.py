@@ -0,0 +1,132 @@
+import os
+from pathlib import Path
+
+from fastapi.testclient import TestClient
+
+from syftbox.lib.hash import hash_file
+from syftbox.server.db import scrubber as scrubber_module
+from syftbox.server.db.file_store import FileStore, path_lock
+from syftbox.server.db.scrubber import SnapshotScrubber
+from syftbox.server.settings import ServerSettings
+
+USER = "alice@openmined.org"
+
+
+def test_scrubber_repairs_snapshot(tmp_path: Path):
+    settings = ServerSettings(data_folder=tmp_path, scrubber_sample_rate=1.0, scrubber_repair=True)
+    store = FileStore(settings)
+    for name in ["a.txt", "deleted.txt", "corrupt.txt"]:
+        store.put(Path(USER) / name, name.encode(), USER, skip_permission_check=True)
+
+    # a file without a row, a row without a file, and a file whose content changed without changing size and mtime
+    orphan = settings.snapshot_folder / USER / "sub" / "orphan.txt"
+    orphan.parent.mkdir()
+    orphan.write_bytes(b"orphan")
+    (settings.snapshot_folder / USER / "deleted.txt").unlink()
+    corrupt = settings.snapshot_folder / USER / "corrupt.txt"
+    stat = corrupt.stat()
+    corrupt.write_bytes(b"CORRUPT.txt")
+    os.utime(corrupt, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    scrubber = SnapshotScrubber(settings)
+    scrubber.scrub()
+
+    assert scrubber.stats.passes == 1
+    assert scrubber.stats.progress == 1.0
+    assert scrubber.stats.files_checked == 4
+    assert scrubber.stats.orphan_files_added == 1
+    assert scrubber.stats.orphan_rows_deleted == 1
+    assert scrubber.stats.files_repaired == 1
+
+    assert store.exists(Path(USER) / "sub" / "orphan.txt")
+    assert not store.exists(Path(USER) / "deleted.txt")
+    metadata = store.get_metadata(Path(USER) / "corrupt.txt", USER, skip_permission_check=True)
+    assert metadata.file_size == len(b"CORRUPT.txt")
+
+    # a consistent snapshot is not repaired again
+    scrubber.scrub()
+    assert scrubber.stats.passes == 2
+    assert scrubber.stats.orphan_files_added == 1
+    assert scrubber.stats.orphan_rows_deleted == 1
+    assert scrubber.stats.files_repaired == 1
+
+
+def test_scrubber_only_reports_by_default(tmp_path: Path):
+    settings = ServerSettings(data_folder=tmp_path)
+    assert not settings.scrubber_repair
+    store = FileStore(settings)
+    store.put(Path(USER) / "deleted.txt", b"deleted", USER, skip_permission_check=True)
+    (settings.snapshot_folder / USER / "deleted.txt").unlink()
+    (settings.snapshot_folder / USER / "orphan.txt").write_bytes(b"orphan")
+
+    scrubber = SnapshotScrubber(settings)
+    scrubber.scrub()
+
+    assert scrubber.stats.orphan_rows_deleted == 1
+    assert scrubber.stats.orphan_files_added == 1
+    assert store.exists(Path(USER) / "deleted.txt")
+    assert not store.exists(Path(USER) / "orphan.txt")
+
+
+def test_scrubber_skips_temp_files(tmp_path: Path):
+    settings = ServerSettings(data_folder=tmp_path, scrubber_sample_rate=1.0, scrubber_repair=True)
+    store = FileStore(settings)
+    store.put(Path(USER) / "a.txt", b"a", USER, skip_permission_check=True)
+    scrubber = SnapshotScrubber(settings)
+
+    # a write in progress during the pass, see `write_files_atomic`
+    temp_file = settings.snapshot_folder / USER / ".b.txt.0123456789abcdef.tmp"
+    scrub_datasite = scrubber.scrub_datasite
+
+    def write_during_pass(datasite: str) -> None:
+        temp_file.write_bytes(b"partial")
+        scrub_datasite(datasite)
+
+    scrubber.scrub_datasite = write_during_pass
+    scrubber.scrub()
+
+    assert scrubber.stats.files_checked == 1
+    assert scrubber.stats.orphan_files_added == 0
+    assert temp_file.read_bytes() == b"partial"
+    assert not store.exists(temp_file.relative_to(settings.snapshot_folder))
+
+
+def test_scrubber_hashes_without_lock(tmp_path: Path, monkeypatch):
+    settings = ServerSettings(data_folder=tmp_path, scrubber_sample_rate=1.0, scrubber_repair=True)
+    store = FileStore(settings)
+    path = Path(USER) / "a.txt"
+    store.put(path, b"a", USER, skip_permission_check=True)
+    abs_path = settings.snapshot_folder / path
+    # a file without a row, written again while it is hashed
+    orphan = Path(USER) / "orphan.txt"
+    (settings.snapshot_folder / orphan).write_bytes(b"orphan")
+
+    def hash_and_write(file_path: Path, root_dir: Path):
+        lock = path_lock(file_path.relative_to(root_dir))
+        assert lock.acquire(blocking=False)
+        lock.release()
+        metadata = hash_file(file_path, root_dir)
+        if file_path.name == "orphan.txt":
+            stat = file_path.stat()
+            file_path.write_bytes(b"ORPHAN")
+            os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        return metadata
+
+    monkeypatch.setattr(scrubber_module, "hash_file", hash_and_write)
+    scrubber = SnapshotScrubber(settings)
+    scrubber.scrub()
+
+    # the changed file is left to the next pass
+    assert scrubber.stats.files_hashed == 2
+    assert scrubber.stats.orphan_files_added == 0
+    assert not store.exists(orphan)
+    assert abs_path.read_bytes() == b"a"
+
+
+def test_scrubber_info(client: TestClient):
+    response = client.get("/info/scrubber")
+    response.raise_for_status()
+    stats = response.json()
+    assert stats["enabled"] is True
+    assert stats["repair"] is False
+    assert stats["passes"] == 0
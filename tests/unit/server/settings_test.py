@@ -12,3 +12,12 @@ def test_server_settings_from_env():
     assert settings.data_folder == Path("data_folder").resolve()
     assert settings.snapshot_folder == Path("data_folder/snapshot").resolve()
     assert settings.user_file_path == Path("data_folder/users.json").resolve()
+
+
+def test_server_settings_pool_sizes(monkeypatch):
+    monkeypatch.setenv("SYFTBOX_THREADPOOL_SIZE", "10")
+    monkeypatch.setenv("SYFTBOX_DB_POOL_SIZE", "4")
+
+    settings = ServerSettings()
+    assert settings.threadpool_size == 10
+    assert settings.db_pool_size == 4
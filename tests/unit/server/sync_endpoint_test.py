@@ -1,5 +1,6 @@
 import base64
 import hashlib
+import threading
 import zipfile
 from io import BytesIO
 from pathlib import Path
@@ -11,8 +12,18 @@ from fastapi.testclient import TestClient
 from py_fast_rsync import signature
 
 from syftbox.client.exceptions import SyftServerError
+from syftbox.client.plugins.sync.datasite_state import DatasiteState
 from syftbox.client.plugins.sync.sync_client import SyncClient
-from syftbox.server.models.sync_models import ApplyDiffResponse, DiffResponse, FileMetadata
+from syftbox.lib.http import HEADER_SYFTBOX_NEXT_CURSOR, NDJSON_MEDIA_TYPE
+from syftbox.lib.merkle import MerkleTree
+from syftbox.server.db.file_store import FileStore
+from syftbox.server.models.sync_models import (
+    ApplyDiffRequest,
+    ApplyDiffResponse,
+    DatasiteStateResponse,
+    DiffResponse,
+    FileMetadata,
+)
 from tests.unit.server.conftest import PERM_FILE, TEST_DATASITE_NAME, TEST_FILE
 
 
@@ -84,11 +95,63 @@ def test_syft_client_push_flow(client: TestClient):
 
 
 def test_get_remote_state(sync_client: SyncClient):
-    metadata = sync_client.get_remote_state(Path(TEST_DATASITE_NAME))
+    metadata = list(sync_client.get_remote_state(Path(TEST_DATASITE_NAME)))
 
     assert len(metadata) == 3
 
 
+def test_get_remote_state_paginated(sync_client: SyncClient):
+    expected = list(sync_client.get_remote_state(Path(TEST_DATASITE_NAME)))
+
+    sync_client.page_size = 1
+    metadata = list(sync_client.get_remote_state(Path(TEST_DATASITE_NAME)))
+    assert [m.path for m in metadata] == [m.path for m in expected]
+
+
+def test_dir_state_pages(client: TestClient):
+    all_paths = []
+    cursor = None
+    num_pages = 0
+    while True:
+        params = {"dir": TEST_DATASITE_NAME, "page_size": 2}
+        if cursor is not None:
+            params["cursor"] = cursor
+        response = client.post("/sync/dir_state", params=params)
+        response.raise_for_status()
+        all_paths.extend(item["path"] for item in response.json())
+        num_pages += 1
+
+        cursor = response.headers.get(HEADER_SYFTBOX_NEXT_CURSOR)
+        if cursor is None:
+            break
+
+    assert num_pages == 2
+    assert all_paths == sorted(all_paths)
+    assert len(all_paths) == 3
+
+    response = client.post("/sync/dir_state", params={"dir": TEST_DATASITE_NAME, "page_size": 0})
+    assert response.status_code == 422
+
+
+@pytest.mark.parametrize(
+    "chunk_hash", ["../../snapshot/test_datasite@openmined.org/test_file.txt", "/etc/passwd", "A" * 64]
+)
+def test_commit_chunks_rejects_invalid_chunk_hash(client: TestClient, chunk_hash: str):
+    chunks = [{"offset": 0, "size": 1, "hash": chunk_hash}]
+    response = client.post(
+        "/sync/chunks/commit",
+        json={"path": f"{TEST_DATASITE_NAME}/new_file.txt", "expected_hash": "0" * 64, "chunks": chunks},
+    )
+    assert response.status_code == 422
+
+
+@pytest.mark.parametrize("sig", [b"", b"short", b"rs\x016" + bytes(8)])
+def test_get_diff_rejects_invalid_signature(client: TestClient, sig: bytes):
+    path = f"{TEST_DATASITE_NAME}/{TEST_FILE}"
+    response = client.post("/sync/get_diff", json={"path": path, "signature": base64.b85encode(sig).decode()})
+    assert response.status_code == 400
+
+
 def test_get_metadata(sync_client: SyncClient):
     metadata = sync_client.get_metadata(Path(TEST_DATASITE_NAME) / TEST_FILE)
     assert metadata.path == Path(TEST_DATASITE_NAME) / TEST_FILE
@@ -171,6 +234,69 @@ def test_create_file(sync_client: SyncClient):
     assert path.exists()
 
 
+def test_upload_bulk(sync_client: SyncClient):
+    snapshot_folder = sync_client.server_client.app_state["server_settings"].snapshot_folder
+    new_files = {Path(TEST_DATASITE_NAME) / "bulk" / f"{i}.txt": f"file {i}".encode() for i in range(10)}
+    existing = Path(TEST_DATASITE_NAME) / TEST_FILE
+    wrong_hash = Path(TEST_DATASITE_NAME) / "bulk" / "wrong_hash.txt"
+    forbidden = Path("other@openmined.org") / "file.txt"
+
+    files = {**new_files, existing: b"existing", wrong_hash: b"contents", forbidden: b"contents"}
+    hashes = {path: hashlib.sha256(data).hexdigest() for path, data in files.items()}
+    hashes[wrong_hash] = hashlib.sha256(b"other contents").hexdigest()
+    response = sync_client.upload_bulk(files, hashes)
+
+    status_codes = {result.path: result.status_code for result in response.results}
+    assert status_codes == {**{path: 200 for path in new_files}, existing: 400, wrong_hash: 400, forbidden: 403}
+    for path, data in new_files.items():
+        assert (snapshot_folder / path).read_bytes() == data
+        assert sync_client.get_metadata(path).hash == hashes[path]
+    assert (snapshot_folder / existing).read_bytes() == b"Hello, World!"
+    assert not (snapshot_folder / wrong_hash).exists()
+    assert not (snapshot_folder / forbidden).exists()
+
+
+def test_apply_diff_bulk(sync_client: SyncClient):
+    path = Path(TEST_DATASITE_NAME) / TEST_FILE
+    missing = Path(TEST_DATASITE_NAME) / "missing.txt"
+    wrong_hash = Path(TEST_DATASITE_NAME) / TEST_DATASITE_NAME / TEST_FILE
+    # exists, but cannot be read without a permission file in its datasite
+    forbidden = Path("other@openmined.org") / "file.txt"
+    settings = sync_client.server_client.app_state["server_settings"]
+    FileStore(settings).put(forbidden, b"Hello, World!", "", skip_permission_check=True)
+    new_data = b"Hello, Batch!"
+
+    remote_signature = signature.calculate(b"Hello, World!")
+    diff = base64.b85encode(py_fast_rsync.diff(remote_signature, new_data)).decode("utf-8")
+    diffs = []
+    for diff_path in [path, missing, wrong_hash, forbidden]:
+        expected_hash = hashlib.sha256(new_data if diff_path != wrong_hash else b"other").hexdigest()
+        diffs.append(ApplyDiffRequest(path=diff_path, diff=diff, expected_hash=expected_hash))
+    response = sync_client.apply_diff_bulk(diffs)
+
+    # the same status codes as /sync/apply_diff
+    status_codes = {result.path: result.status_code for result in response.results}
+    assert status_codes == {path: 200, missing: 404, wrong_hash: 400, forbidden: 403}
+    response = sync_client.server_client.post("/sync/apply_diff", json=diffs[-1].model_dump(mode="json"))
+    assert response.status_code == 403
+    assert sync_client.download(path) == new_data
+    assert sync_client.download(wrong_hash) == b"Hello, World!"
+
+
+def test_delete_bulk(sync_client: SyncClient):
+    snapshot_folder = sync_client.server_client.app_state["server_settings"].snapshot_folder
+    paths = [Path(TEST_DATASITE_NAME) / TEST_FILE, Path(TEST_DATASITE_NAME) / TEST_DATASITE_NAME / TEST_FILE]
+    forbidden = Path("other@openmined.org") / "file.txt"
+    response = sync_client.delete_bulk([*paths, forbidden])
+
+    status_codes = {result.path: result.status_code for result in response.results}
+    assert status_codes == {paths[0]: 200, paths[1]: 200, forbidden: 403}
+    for path in paths:
+        assert not (snapshot_folder / path).exists()
+        with pytest.raises(SyftServerError):
+            sync_client.get_metadata(path)
+
+
 def test_create_permfile(sync_client: SyncClient):
     invalid_contents = b"wrong permfile"
     folder = "test"
@@ -234,7 +360,7 @@ def test_list_datasites(client: TestClient):
 
 
 def test_get_all_datasite_states(sync_client: SyncClient):
-    response = sync_client.get_datasite_states()
+    response = dict(sync_client.get_datasite_states())
     assert len(response) == 1
 
     metadatas = response[TEST_DATASITE_NAME]
@@ -242,14 +368,182 @@ def test_get_all_datasite_states(sync_client: SyncClient):
     assert all(isinstance(m, FileMetadata) for m in metadatas)
 
 
+def test_get_all_datasite_states_paginated(sync_client: SyncClient):
+    sync_client.page_size = 1
+    response = list(sync_client.get_datasite_states())
+    assert len(response) == 1
+
+    datasite, metadatas = response[0]
+    assert datasite == TEST_DATASITE_NAME
+    assert len(metadatas) == 3
+
+
+def test_datasite_states_ndjson(client: TestClient):
+    response = client.post("/sync/datasite_states", headers={"Accept": NDJSON_MEDIA_TYPE})
+    response.raise_for_status()
+    assert response.headers["content-type"].startswith(NDJSON_MEDIA_TYPE)
+
+    lines = [DatasiteStateResponse.model_validate_json(line) for line in response.text.splitlines()]
+    assert len(lines) == 1
+    assert lines[0].datasite == TEST_DATASITE_NAME
+    assert len(lines[0].files) == 3
+
+    # without NDJSON, the response is a single JSON object
+    response = client.post("/sync/datasite_states")
+    response.raise_for_status()
+    assert list(response.json().keys()) == [TEST_DATASITE_NAME]
+
+
+def test_datasite_states_etag(sync_client: SyncClient):
+    client = sync_client.server_client
+    response = client.post("/sync/datasite_states")
+    response.raise_for_status()
+    etag = response.headers["etag"]
+
+    response = client.post("/sync/datasite_states", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    # any change to the datasite invalidates the etag
+    sync_client.create(Path(TEST_DATASITE_NAME) / "new_file.txt", b"new")
+    response = client.post("/sync/datasite_states", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert len(response.json()[TEST_DATASITE_NAME]) == 4
+
+
+def test_get_datasite_states_uses_cache(sync_client: SyncClient):
+    states = list(sync_client.get_datasite_states())
+    assert sync_client._datasite_states_cache is not None
+
+    status_codes = []
+    sync_client.server_client.event_hooks["response"].append(lambda r: status_codes.append(r.status_code))
+    assert list(sync_client.get_datasite_states()) == states
+    assert status_codes == [304]
+
+    sync_client.create(Path(TEST_DATASITE_NAME) / "new_file.txt", b"new")
+    states = dict(sync_client.get_datasite_states())
+    assert len(states[TEST_DATASITE_NAME]) == 4
+
+
+def test_get_tree_node(sync_client: SyncClient):
+    remote_state = list(sync_client.get_remote_state(Path(TEST_DATASITE_NAME)))
+    expected = MerkleTree(Path(TEST_DATASITE_NAME), remote_state)
+
+    root = sync_client.get_tree_node(Path("."))
+    assert [(entry.name, entry.hash, entry.is_dir) for entry in root.children] == [
+        (TEST_DATASITE_NAME, expected.root_hash, True)
+    ]
+
+    node = sync_client.get_tree_node(Path(TEST_DATASITE_NAME))
+    assert node.model_copy(update={"contents": {}}) == expected.node(Path(TEST_DATASITE_NAME))
+
+    # only the changed directory and its ancestors change
+    sync_client.create(Path(TEST_DATASITE_NAME) / "a" / "b" / "new_file.txt", b"new")
+    changed = sync_client.get_tree_node(Path(TEST_DATASITE_NAME))
+    assert changed.hash != node.hash
+    assert {e.name for e in changed.children if e.hash != expected.hash(Path(TEST_DATASITE_NAME) / e.name)} == {"a"}
+
+    assert sync_client.get_tree_node(Path(TEST_DATASITE_NAME) / "missing").children == []
+
+
+def test_tree_root_etag(sync_client: SyncClient):
+    root = sync_client.get_tree_node(Path("."))
+    assert sync_client._tree_root_cache is not None
+
+    status_codes = []
+    sync_client.server_client.event_hooks["response"].append(lambda r: status_codes.append(r.status_code))
+    assert sync_client.get_tree_node(Path(".")) == root
+    assert status_codes == [304]
+
+    # directories below the root are not cached
+    sync_client.get_tree_node(Path(TEST_DATASITE_NAME))
+    assert status_codes == [304, 200]
+
+    sync_client.create(Path(TEST_DATASITE_NAME) / "new_file.txt", b"new")
+    changed = sync_client.get_tree_node(Path("."))
+    assert status_codes[-1] == 200
+    assert changed.hash != root.hash
+
+
+def test_inline_contents(sync_client: SyncClient):
+    path = Path(TEST_DATASITE_NAME) / TEST_FILE
+    large_path = Path(TEST_DATASITE_NAME) / "large.txt"
+    sync_client.create(large_path, b"x" * (sync_client.inline_max_size + 1))
+
+    node = sync_client.get_tree_node(Path(TEST_DATASITE_NAME))
+    assert set(node.contents) == {path, Path(TEST_DATASITE_NAME) / PERM_FILE}
+    assert sync_client.get_inline_content(sync_client.get_metadata(path)) == b"Hello, World!"
+    assert sync_client.get_inline_content(sync_client.get_metadata(large_path)) is None
+
+    # contents of a file that changed after it was listed are not used
+    sync_client.inline_contents.clear()
+    list(sync_client.get_datasite_states())
+    assert sync_client.get_inline_content(sync_client.get_metadata(path)) == b"Hello, World!"
+    sync_client.delete(path)
+    sync_client.create(path, b"changed")
+    assert sync_client.get_inline_content(sync_client.get_metadata(path)) is None
+
+    # inlining is optional
+    sync_client.inline_contents.clear()
+    sync_client.inline_max_size = 0
+    assert sync_client.get_tree_node(Path(TEST_DATASITE_NAME)).contents == {}
+    assert sync_client.inline_contents == {}
+
+
+def test_tree_only_descends_into_changed_dirs(sync_client: SyncClient):
+    for i in range(5):
+        sync_client.create(Path(TEST_DATASITE_NAME) / f"dir_{i}" / "sub" / "file.txt", f"data {i}".encode())
+    local_state = list(sync_client.get_remote_state(Path(TEST_DATASITE_NAME)))
+    changed_path = Path(TEST_DATASITE_NAME) / "dir_3" / "sub" / "file.txt"
+    sync_client.apply_diff(
+        changed_path,
+        py_fast_rsync.diff(signature.calculate(b"data 3"), b"changed"),
+        hashlib.sha256(b"changed").hexdigest(),
+    )
+
+    root_hash = sync_client.get_tree_node(Path(".")).children[0].hash
+    datasite_state = DatasiteState(sync_client, TEST_DATASITE_NAME, remote_tree_hash=root_hash)
+
+    requested = []
+    sync_client.server_client.event_hooks["request"].append(lambda r: requested.append(r.url.params.get("dir")))
+    local_files, remote_files = datasite_state.get_changed_subtrees(local_state)
+
+    # one request per directory level
+    assert requested == [TEST_DATASITE_NAME, f"{TEST_DATASITE_NAME}/dir_3", f"{TEST_DATASITE_NAME}/dir_3/sub"]
+    assert [f.path for f in local_files] == [changed_path]
+    assert [(f.path, f.hash) for f in remote_files] == [(changed_path, hashlib.sha256(b"changed").hexdigest())]
+
+    # nothing is requested if the root hashes match
+    requested.clear()
+    datasite_state.remote_tree_hash = MerkleTree(Path(TEST_DATASITE_NAME), local_state).root_hash
+    assert datasite_state.get_changed_subtrees(local_state) == ([], [])
+    assert requested == []
+
+
 def test_download_snapshot(sync_client: SyncClient):
-    metadata = sync_client.get_remote_state(Path(TEST_DATASITE_NAME))
+    metadata = list(sync_client.get_remote_state(Path(TEST_DATASITE_NAME)))
     paths = [m.path for m in metadata]
     data = sync_client.download_bulk(paths)
     zip_file = zipfile.ZipFile(BytesIO(data))
     assert len(zip_file.filelist) == 3
 
 
+def test_download_bulk_runs_on_db_executor(sync_client: SyncClient, monkeypatch):
+    thread_names = []
+    get_many = FileStore.get_many
+
+    def get_many_in_thread(self, *args, **kwargs):
+        thread_names.append(threading.current_thread().name)
+        return get_many(self, *args, **kwargs)
+
+    monkeypatch.setattr(FileStore, "get_many", get_many_in_thread)
+    data = sync_client.download_bulk([Path(TEST_DATASITE_NAME) / TEST_FILE])
+    assert zipfile.ZipFile(BytesIO(data)).namelist() == [f"{TEST_DATASITE_NAME}/{TEST_FILE}"]
+    assert len(thread_names) == 1
+    assert thread_names[0].startswith("syftbox-db")
+
+
 def test_whoami(client: TestClient):
     response = client.post("/auth/whoami")
     response.raise_for_status()